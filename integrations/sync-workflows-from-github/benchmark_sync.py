@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""Benchmark sync_to_sandgarden against synthetic workspaces.
+
+Generates workflows/*/steps/*/prompts trees of increasing size, syncs them
+against a fake sand CLI with a configurable latency, and records the end to
+end and per-phase timings of each sync. Everything runs locally.
+
+    python benchmark_sync.py --sizes 1x2x1,10x5x2,50x10x2 --latency 0.05
+
+Each size is WORKFLOWSxSTEPSxPROMPTS. Every size is synced twice: a cold
+sync where everything is new, and a warm sync after changing a fraction of
+the steps. Pass --output to save the results and --baseline to fail when a
+run is slower than a saved one.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from typing import Dict, Any, List, Tuple
+from pathlib import Path
+from unittest.mock import patch
+
+import sync_to_sandgarden
+
+FAKE_SAND = '''#!{python}
+"""Stand-in for the sand CLI, keeping its state in $FAKE_SAND_STATE."""
+import fcntl
+import json
+import os
+import sys
+import time
+
+time.sleep(float(os.environ.get("FAKE_SAND_LATENCY", "0")))
+
+args = sys.argv[1:]
+resource_type = args[0]
+name = args[args.index("--name") + 1] if "--name" in args else None
+
+with open(os.environ["FAKE_SAND_STATE"], "a+") as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    f.seek(0)
+    state = json.loads(f.read() or "{{}}")
+    resources = state.setdefault(resource_type, [])
+
+    if args[1] == "list":
+        print(json.dumps({{resource_type: [r for r in resources if name in (None, r["name"])]}}))
+        sys.exit(0)
+
+    resource = {{"name": name, "version": 1 + sum(1 for r in resources if r["name"] == name)}}
+    if resource_type == "steps":
+        resource["image"] = args[args.index("--image") + 1] if "--image" in args else f"fake/{{name}}:{{resource['version']}}"
+    resources.append(resource)
+
+    f.seek(0)
+    f.truncate()
+    f.write(json.dumps(state))
+    print(json.dumps(resource))
+'''
+
+def write_fake_sand(directory: Path) -> Path:
+    """Write the fake sand executable.
+
+    Returns:
+        Path: The executable, which reads FAKE_SAND_STATE and FAKE_SAND_LATENCY
+    """
+    path = directory / "sand"
+    path.write_text(FAKE_SAND.format(python=sys.executable))
+    path.chmod(0o755)
+    return path
+
+def parse_size(size: str) -> Tuple[int, int, int]:
+    """Parse a WORKFLOWSxSTEPSxPROMPTS size."""
+    workflows, steps, prompts = (int(n) for n in size.split("x"))
+    return workflows, steps, prompts
+
+def generate_workspace(root: Path, workflows: int, steps: int, prompts: int) -> List[Path]:
+    """Generate a synthetic workspace.
+
+    Args:
+        root: Workspace directory, created if needed
+        workflows: Number of workflows
+        steps: Number of steps per workflow
+        prompts: Number of prompts per step
+
+    Returns:
+        List[Path]: Step directories, in order
+    """
+    step_dirs = []
+    for w in range(workflows):
+        workflow_dir = root / "workflows" / f"workflow-{w}"
+        workflow_dir.mkdir(parents=True, exist_ok=True)
+        (workflow_dir / "config.yml").write_text(f"name: workflow-{w}\ndescription: Synthetic workflow {w}\n")
+        for s in range(steps):
+            step_dir = workflow_dir / "steps" / f"{s:04d}_w{w}-step-{s}"
+            (step_dir / "prompts").mkdir(parents=True, exist_ok=True)
+            (step_dir / "main.py").write_text(f"def handler(input, sandgarden):\n    return {{'step': {s}}}\n")
+            (step_dir / "requirements.txt").write_text("requests\n")
+            (step_dir / "config.yml").write_text(f"description: Step {s} of workflow {w}\nconnectors:\n  - fake-connector\n")
+            if s == 0:
+                (step_dir / "input.json").write_text('{"type": "object"}')
+            for p in range(prompts):
+                (step_dir / "prompts" / f"w{w}-s{s}-prompt-{p}.txt").write_text(f"Prompt {p} of step {s} in workflow {w}\n" * 20)
+            step_dirs.append(step_dir)
+    return step_dirs
+
+def change_steps(step_dirs: List[Path], fraction: float) -> int:
+    """Change the code of a fraction of the steps, returning how many changed."""
+    count = int(len(step_dirs) * fraction)
+    for step_dir in step_dirs[:count]:
+        with open(step_dir / "main.py", "a") as f:
+            f.write(f"# changed at {time.time()}\n")
+    return count
+
+def run_sync(workspace: Path, jobs: int) -> Dict[str, Any]:
+    """Sync a workspace and return its timings."""
+    start = time.perf_counter()
+    with patch("sync_to_sandgarden.get_changed_files", return_value=[]), \
+         patch("builtins.print"):
+        synced = sync_to_sandgarden.sync_to_sandgarden("main", jobs=jobs, backend=sync_to_sandgarden.CliBackend())
+    return {
+        "seconds": time.perf_counter() - start,
+        "synced": {resource_type: len(names) for resource_type, names in synced.items()},
+        "phases": sync_to_sandgarden.profiler.summary()
+    }
+
+def benchmark(sizes: List[str], latency: float, jobs: int, change_fraction: float) -> List[Dict[str, Any]]:
+    """Run a cold and a warm sync for every size."""
+    results = []
+    for size in sizes:
+        workflows, steps, prompts = parse_size(size)
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            step_dirs = generate_workspace(tmp / "workspace", workflows, steps, prompts)
+            env = {
+                "SAND_API_KEY": "benchmark",
+                "GITHUB_WORKSPACE": str(tmp / "workspace"),
+                "SAND_CLI_PATH": str(write_fake_sand(tmp)),
+                "SAND_SYNC_MANIFEST": str(tmp / "manifest.json"),
+                "FAKE_SAND_STATE": str(tmp / "state.json"),
+                "FAKE_SAND_LATENCY": str(latency)
+            }
+            env_without_github = {k: v for k, v in os.environ.items() if not k.startswith("GITHUB_")}
+            with patch.dict(os.environ, dict(env_without_github, **env), clear=True):
+                cold = run_sync(tmp / "workspace", jobs)
+                changed = change_steps(step_dirs, change_fraction)
+                warm = run_sync(tmp / "workspace", jobs)
+
+        for run, result in (("cold", cold), ("warm", warm)):
+            results.append(dict(result, size=size, run=run, changed_steps=changed if run == "warm" else None))
+    return results
+
+def print_results(results: List[Dict[str, Any]]) -> None:
+    print(f"{'size':<12} {'run':<5} {'total (s)':>10} {'pushed':>8}  phases (s)")
+    for result in results:
+        phases = ", ".join(f"{p['category']} {p['seconds']:.2f}" for p in result["phases"])
+        print(f"{result['size']:<12} {result['run']:<5} {result['seconds']:>10.2f} {sum(result['synced'].values()):>8}  {phases}")
+
+def find_regressions(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    """Compare results with a baseline, returning a line per slower run."""
+    previous = {(r["size"], r["run"]): r["seconds"] for r in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result["size"], result["run"]))
+        if before and result["seconds"] > before * (1 + tolerance):
+            regressions.append(f"{result['size']} {result['run']}: {before:.2f}s -> {result['seconds']:.2f}s")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark sync_to_sandgarden against synthetic workspaces")
+    parser.add_argument("--sizes", default="1x2x1,10x5x2,50x10x2", help="Comma separated WORKFLOWSxSTEPSxPROMPTS sizes")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds each fake sand call takes")
+    parser.add_argument("--jobs", type=int, default=sync_to_sandgarden.DEFAULT_JOBS, help="Number of pushes to run in parallel")
+    parser.add_argument("--change-fraction", type=float, default=0.1, help="Fraction of steps changed before the warm sync")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Fail if a run is slower than in this results file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown against the baseline (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    results = benchmark(args.sizes.split(","), args.latency, args.jobs, args.change_fraction)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\nSlower than the baseline:", file=sys.stderr)
+            for regression in regressions:
+                print(f"  - {regression}", file=sys.stderr)
+            sys.exit(1)
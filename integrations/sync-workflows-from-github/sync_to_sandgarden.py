@@ -5,44 +5,637 @@ import json
 import yaml
 import requests
 import argparse
-from typing import Dict, Any, List
+import asyncio
+from typing import Dict, Any, Iterable, List, Optional, Tuple, Union
 from pathlib import Path
 import re
+import fnmatch
 import subprocess
 import platform
+import random
+import hashlib
+import threading
+import time
+import tempfile
+import ctypes
+import ctypes.util
+import select
+import struct
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
 
-def download_sand_cli() -> str:
+# Use the C YAML parser when PyYAML was built with libyaml
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+RESOURCE_TYPES = ("prompts", "steps", "workflows")
+
+# Sandgarden REST API used by the http backend
+DEFAULT_SAND_API_URL = "https://api.sandgarden.com/api/v1"
+SAND_API_POOL_SIZE = 16
+
+# Default number of pushes to run at the same time
+DEFAULT_JOBS = 4
+# Most sand CLI processes to run at the same time
+SAND_CLI_MAX_PROCESSES = 8
+
+# Sandgarden CLI downloads
+SAND_CLI_CHUNK_SIZE = 1024 * 1024
+# How long a cached 'latest' CLI is used before downloading it again, in seconds
+SAND_CLI_LATEST_MAX_AGE = 24 * 60 * 60
+
+# GitHub REST API
+GITHUB_API_URL = "https://api.github.com"
+GITHUB_PAGE_SIZE = 100
+# Most pages of a list endpoint to fetch at the same time
+GITHUB_MAX_PARALLEL_PAGES = 8
+# Longest we will wait for a GitHub rate limit to reset, in seconds
+GITHUB_MAX_RATE_LIMIT_WAIT = 300
+
+# Retries of failed remote calls, with exponential backoff between them
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+# HTTP statuses worth retrying
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# sand CLI errors worth retrying
+SAND_CLI_TRANSIENT_ERRORS = re.compile(r"rate limit|too many requests|timed? ?out|temporar|connection (refused|reset)|unavailable|\b(429|502|503|504)\b", re.IGNORECASE)
+# sand CLI errors that mean the request was turned away before it did anything,
+# the only ones worth retrying for pushes since a push may not be made twice
+SAND_CLI_REJECTED_ERRORS = re.compile(r"rate limit|too many requests|\b429\b", re.IGNORECASE)
+# Calls in a row that ran out of retries after which calls to a service pause, and for how long
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_COOLDOWN = 30.0
+
+# Where the content hashes of the last sync are kept, relative to the workspace
+DEFAULT_MANIFEST_PATH = ".sandgarden/sync-manifest.json"
+# Where the ETags and bodies of GitHub responses are kept between syncs, relative to the workspace
+GITHUB_CACHE_PATH = ".sandgarden/github-cache.json"
+
+# How long a remote state snapshot kept with --remote-cache is trusted without asking Sandgarden, in seconds
+REMOTE_CACHE_TTL = 600
+# Format of the remote state snapshots, older ones are ignored
+REMOTE_CACHE_VERSION = 1
+
+# Above this many resources of a type, --only lists the type whole instead of looking them up by name
+REMOTE_NAMED_LOOKUPS = 20
+
+# How long files must stay unchanged before --watch pushes them, in seconds
+WATCH_DEBOUNCE = 0.5
+# How often the polling watcher looks for changes when inotify is not available
+WATCH_POLL_INTERVAL = 1.0
+
+# Format of the plans written by --plan, bumped when apply can't read older ones
+SYNC_PLAN_VERSION = 1
+
+def current_lane() -> int:
+    """Identify the asyncio task, or else the thread, running the caller."""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return id(task) if task else threading.get_ident()
+
+class Profiler:
+    """Records the wall time, size and result of every phase of a sync.
+    
+    Phases can nest and run on several threads or asyncio tasks. The
+    recording can be written as JSON or as a Chrome trace (chrome://tracing,
+    Perfetto), and summarized as a markdown table.
+    """
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self) -> None:
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self.phases: List[Dict[str, Any]] = []
+    
+    @contextmanager
+    def phase(self, name: str, category: str, **args):
+        """Time a block of code.
+        
+        Yields a dict in which the block can set "bytes" and "result".
+        """
+        record = {"name": name, "category": category, "args": args, "bytes": 0}
+        start = time.perf_counter()
+        try:
+            yield record
+            record.setdefault("result", "ok")
+        except BaseException as e:
+            record["result"] = f"error: {e}"
+            raise
+        finally:
+            record["start"] = start - self._start
+            record["duration"] = time.perf_counter() - start
+            record["thread"] = current_lane()
+            with self._lock:
+                self.phases.append(record)
+    
+    def elapsed(self) -> float:
+        """Seconds since the recording started."""
+        return time.perf_counter() - self._start
+    
+    def summary(self) -> List[Dict[str, Any]]:
+        """Totals per category, in the order categories were first seen."""
+        totals = {}
+        for record in sorted(self.phases, key=lambda r: r["start"]):
+            total = totals.setdefault(record["category"], {"category": record["category"], "calls": 0, "seconds": 0.0, "longest": 0.0, "bytes": 0, "errors": 0})
+            total["calls"] += 1
+            total["seconds"] += record["duration"]
+            total["longest"] = max(total["longest"], record["duration"])
+            total["bytes"] += record["bytes"]
+            if str(record["result"]).startswith("error"):
+                total["errors"] += 1
+        return list(totals.values())
+    
+    def summary_table(self) -> str:
+        """Markdown table of the time spent in each category."""
+        lines = [
+            f"Total: {self.elapsed():.2f}s",
+            "",
+            "| Phase | Calls | Total (s) | Longest (s) | Bytes | Errors |",
+            "| --- | ---: | ---: | ---: | ---: | ---: |"
+        ]
+        for total in self.summary():
+            lines.append(f"| {total['category']} | {total['calls']} | {total['seconds']:.2f} | {total['longest']:.2f} | {total['bytes']} | {total['errors']} |")
+        return "\n".join(lines)
+    
+    def chrome_trace(self) -> Dict[str, Any]:
+        """The recorded phases in Chrome trace event format."""
+        events = []
+        for record in self.phases:
+            events.append({
+                "name": record["name"],
+                "cat": record["category"],
+                "ph": "X",
+                "ts": record["start"] * 1e6,
+                "dur": record["duration"] * 1e6,
+                "pid": os.getpid(),
+                "tid": record["thread"],
+                "args": dict(record["args"], bytes=record["bytes"], result=record["result"])
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+    
+    def write(self, path: str, format: str = "json") -> None:
+        """Write the recording to a file, as 'json' or 'chrome' trace."""
+        if format == "chrome":
+            data = self.chrome_trace()
+        else:
+            data = {"phases": sorted(self.phases, key=lambda r: r["start"]), "summary": self.summary()}
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2, default=str)
+
+# Shared by everything a sync does
+profiler = Profiler()
+
+class RetryableError(ValueError):
+    """A remote call failed in a way that may succeed if it is made again.
+    
+    Args:
+        message: What went wrong
+        retry_after: Seconds the service asked to wait before the next try, if any
+        result: What the call returned, handed back if every retry fails
+    """
+    
+    def __init__(self, message: str, retry_after: Optional[float] = None, result: Any = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.result = result
+
+class RetryPolicy:
+    """Retries failed calls to one service (the sand CLI, the Sandgarden API or GitHub).
+    
+    A call that raises RetryableError is made again, up to `attempts` times.
+    Between tries it waits for as long as the service asked (Retry-After or
+    a rate limit reset), or else for an exponential backoff with full
+    jitter. A wait longer than `max_wait` is not worth it and ends the
+    retries. After `breaker_threshold` calls in a row ran out of retries,
+    the circuit opens: calls wait until `breaker_cooldown` seconds have
+    passed, and then a single call is let through to probe the service
+    while the others keep waiting for its outcome. Rate limits don't count
+    as failures, the service is only busy.
+    """
+    
+    def __init__(self, name: str, attempts: int = RETRY_ATTEMPTS, base_delay: float = RETRY_BASE_DELAY, max_delay: float = RETRY_MAX_DELAY, max_wait: float = GITHUB_MAX_RATE_LIMIT_WAIT, breaker_threshold: int = CIRCUIT_BREAKER_THRESHOLD, breaker_cooldown: float = CIRCUIT_BREAKER_COOLDOWN):
+        self.name = name
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+    
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Seconds to wait before try number attempt + 1."""
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+    
+    def circuit_wait(self) -> float:
+        """Seconds a call must wait before it may go ahead, 0 if it can go now."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            remaining = self._opened_at + self.breaker_cooldown - time.monotonic()
+            if remaining > 0:
+                return remaining
+            if self._probing:
+                # Another call is probing the service, wait for its outcome
+                return min(1.0, self.breaker_cooldown)
+            self._probing = True
+            return 0.0
+    
+    def record(self, error: Optional[RetryableError]) -> None:
+        """Record the outcome of a call, once its retries are over, for the circuit breaker."""
+        with self._lock:
+            probing, self._probing = self._probing, False
+            if error is None:
+                self._failures = 0
+                self._opened_at = None
+            elif error.retry_after is None:
+                self._failures += 1
+                # A failed probe opens the circuit again for another cooldown
+                if probing or self._failures >= self.breaker_threshold:
+                    if self._opened_at is None:
+                        print(f"{self.name}: {self._failures} calls in a row failed, pausing calls for {self.breaker_cooldown:.0f}s")
+                    self._opened_at = time.monotonic()
+    
+    def end_probe(self) -> None:
+        """Let another call probe the service, when a probe ended without telling if it recovered."""
+        with self._lock:
+            self._probing = False
+    
+    def _next_wait(self, attempt: int, error: RetryableError) -> Optional[float]:
+        """Seconds to wait before the next try, or None to give up."""
+        if attempt + 1 >= self.attempts:
+            return None
+        wait = self.delay(attempt, error.retry_after)
+        if wait > self.max_wait:
+            return None
+        print(f"{self.name}: {error}, retrying in {wait:.1f}s")
+        return wait
+    
+    def _give_up(self, error: RetryableError) -> Any:
+        self.record(error)
+        if error.result is not None:
+            return error.result
+        raise error
+    
+    def call(self, attempt_call):
+        """Call attempt_call() until it doesn't raise RetryableError or retries run out.
+        
+        Returns:
+            What attempt_call returned, or the result carried by its last
+            RetryableError if there is one
+            
+        Raises:
+            RetryableError: If every try failed without a result
+        """
+        while (wait := self.circuit_wait()) > 0:
+            time.sleep(wait)
+        for attempt in range(self.attempts):
+            try:
+                result = attempt_call()
+            except RetryableError as e:
+                wait = self._next_wait(attempt, e)
+                if wait is None:
+                    return self._give_up(e)
+                time.sleep(wait)
+                continue
+            except BaseException:
+                # Not a failure of the service, but don't leave the others waiting for a probe
+                self.end_probe()
+                raise
+            self.record(None)
+            return result
+    
+    async def call_async(self, attempt_call):
+        """Async version of call, for a coroutine function."""
+        while (wait := self.circuit_wait()) > 0:
+            await asyncio.sleep(wait)
+        for attempt in range(self.attempts):
+            try:
+                result = await attempt_call()
+            except RetryableError as e:
+                wait = self._next_wait(attempt, e)
+                if wait is None:
+                    return self._give_up(e)
+                await asyncio.sleep(wait)
+                continue
+            except BaseException:
+                # Not a failure of the service, but don't leave the others waiting for a probe
+                self.end_probe()
+                raise
+            self.record(None)
+            return result
+
+def retry_after_seconds(response: requests.Response) -> Optional[float]:
+    """Parse the Retry-After header of a response, given in seconds or as a date."""
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def published_sand_cli_checksum(url: str) -> Optional[str]:
+    """Fetch the SHA-256 published next to a CLI binary, if there is one."""
+    try:
+        response = requests.get(f"{url}.sha256", timeout=30)
+    except requests.exceptions.RequestException:
+        return None
+    if response.status_code != 200 or not response.text.strip():
+        return None
+    return response.text.split()[0].lower()
+
+def download_sand_cli(version: str = "latest", cache_dir: Optional[Path] = None, sha256: Optional[str] = None, max_age: float = SAND_CLI_LATEST_MAX_AGE) -> str:
     """Download and setup the Sandgarden CLI.
     
+    Binaries are cached by version and platform, so a cached one is used
+    without downloading anything, once it is hashed again and matches the
+    checksum it was verified against. 'latest' is downloaded again once the
+    cached copy is older than max_age. Downloads go to a temporary file that
+    is renamed into place once its checksum is verified, so concurrent jobs
+    never see a partial binary. A download with no checksum to verify it
+    against is used with a warning.
+    
+    Args:
+        version: CLI version to download
+        cache_dir: Cache directory (default: SAND_CLI_CACHE or ~/.cache/sandgarden-cli)
+        sha256: Expected checksum (default: SAND_CLI_SHA256, or the one published with the binary)
+        max_age: Seconds a cached 'latest' binary is used for
+    
     Returns:
         str: Path to the downloaded CLI binary
+        
+    Raises:
+        ValueError: If the downloaded binary doesn't match the expected checksum
     """
-    cli_dir = Path("/tmp/sandgarden-cli")
-    cli_dir.mkdir(exist_ok=True)
-    
     # Determine OS and architecture
     system = platform.system().lower()
     arch = platform.machine().lower()
     if arch == "x86_64":
         arch = "amd64"
     
+    if cache_dir is None:
+        default_cache = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "sandgarden-cli"
+        cache_dir = Path(os.environ.get("SAND_CLI_CACHE", default_cache))
+    cli_dir = cache_dir / version / f"{system}_{arch}"
+    cli_dir.mkdir(parents=True, exist_ok=True)
+    cli_path = cli_dir / "sand"
+    checksum_path = cli_dir / "sand.sha256"
+    sha256 = (sha256 or os.environ.get("SAND_CLI_SHA256") or "").lower() or None
+    
+    # Use the cached binary if it is still valid, and still the binary that was verified
+    if cli_path.exists() and checksum_path.exists():
+        cached_sha256 = checksum_path.read_text().strip()
+        expired = version == "latest" and time.time() - cli_path.stat().st_mtime > max_age
+        if not expired and (sha256 is None or sha256 == cached_sha256):
+            with open(cli_path, "rb") as f:
+                if hashlib.file_digest(f, "sha256").hexdigest() == cached_sha256:
+                    return str(cli_path)
+            print(f"Cached Sandgarden CLI {cli_path} doesn't match its checksum, downloading it again")
+    
     # Download URL
-    url = f"https://api.sandgarden.com/api/v1/assets/sand/latest/sand_{system}_{arch}"
+    url = f"https://api.sandgarden.com/api/v1/assets/sand/{version}/sand_{system}_{arch}"
+    if sha256 is None:
+        sha256 = published_sand_cli_checksum(url)
+    if sha256 is None:
+        print(f"Warning: no checksum is published for {url} and SAND_CLI_SHA256 is not set, the download can't be verified")
     
-    # Download the CLI
-    cli_path = cli_dir / "sand"
-    response = requests.get(url, stream=True)
+    # Download the CLI to a temporary file next to its final location
+    response = requests.get(url, stream=True, timeout=60)
     response.raise_for_status()
     
-    with open(cli_path, "wb") as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=cli_dir, prefix=".sand-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in response.iter_content(chunk_size=SAND_CLI_CHUNK_SIZE):
+                f.write(chunk)
+                digest.update(chunk)
+        
+        downloaded_sha256 = digest.hexdigest()
+        if sha256 and downloaded_sha256 != sha256:
+            raise ValueError(f"Checksum mismatch for {url}: expected {sha256}, got {downloaded_sha256}")
+        
+        # Make it executable
+        os.chmod(tmp_path, 0o755)
+        os.replace(tmp_path, cli_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
     
-    # Make it executable
-    cli_path.chmod(0o755)
+    # Written after the binary, so a cache hit always has a complete binary
+    fd, tmp_checksum_path = tempfile.mkstemp(dir=cli_dir, prefix=".sand-")
+    with os.fdopen(fd, "w") as f:
+        f.write(downloaded_sha256)
+    os.replace(tmp_checksum_path, checksum_path)
     
     return str(cli_path)
 
+def github_rate_limit_wait(response: requests.Response) -> Optional[float]:
+    """Return how long to wait before retrying a rate limited GitHub response.
+    
+    Returns:
+        Optional[float]: Seconds to wait, or None if the response is not rate limited
+    """
+    if response.status_code not in (403, 429):
+        return None
+    retry_after = retry_after_seconds(response)
+    if retry_after is not None:
+        return retry_after
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        reset = response.headers.get("X-RateLimit-Reset")
+        if reset:
+            return max(0.0, float(reset) - time.time()) + 1
+        return 60.0
+    return None
+
+class GitHubClient:
+    """GitHub REST API client shared by everything the sync asks GitHub.
+    
+    Connections are reused through a single Session, list endpoints are
+    followed through their Link headers, GETs are made conditional on the
+    ETag of the last response, and rate limited requests wait for the limit
+    to reset instead of failing. With a cache path, the ETags and bodies
+    are kept there between syncs, so a sync run again for the same PR gets
+    304s, which don't count against the rate limit.
+    """
+    
+    def __init__(self, token: str, max_rate_limit_wait: float = GITHUB_MAX_RATE_LIMIT_WAIT, cache_path: Optional[Path] = None):
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"token {token}",
+            "Accept": "application/vnd.github.v3+json"
+        })
+        self.retry = RetryPolicy("GitHub", max_wait=max_rate_limit_wait)
+        self.cache_path = cache_path
+        # url -> (etag, parsed body, next and last page links), and the urls requested by this sync
+        self._etags: Dict[str, Any] = {}
+        self._used: set = set()
+        if cache_path and cache_path.exists():
+            try:
+                with open(cache_path) as f:
+                    for url, (etag, data, *links) in json.load(f).get("responses", {}).items():
+                        # Caches written before links were kept have none
+                        self._etags[url] = (etag, data, links[0] if links else {})
+            except Exception as e:
+                print(f"Error reading GitHub cache {cache_path}: {e}")
+    
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Make a request, waiting out rate limits and retrying server and connection errors.
+        
+        Raises:
+            requests.RequestException: If the connection keeps failing
+        """
+        def attempt() -> requests.Response:
+            with profiler.phase(f"{method} {url}", "github") as record:
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    raise RetryableError(f"{method} {url} failed: {e}") from e
+                record["bytes"] = int(response.headers.get("Content-Length") or 0)
+                record["result"] = "ok" if response.status_code < 400 else f"error: HTTP {response.status_code}"
+            wait = github_rate_limit_wait(response)
+            if wait is not None:
+                raise RetryableError("GitHub rate limit reached", retry_after=wait, result=response)
+            if response.status_code in RETRY_STATUS_CODES:
+                raise RetryableError(f"{method} {url} returned HTTP {response.status_code}", result=response)
+            return response
+        
+        try:
+            return self.retry.call(attempt)
+        except RetryableError as e:
+            # Callers handle request errors, as they did before retries
+            raise e.__cause__ or e
+    
+    def get(self, url: str, params: Optional[Dict[str, Any]] = None) -> requests.Response:
+        """Make a conditional GET, serving a 304 from the cached body.
+        
+        The parsed body is available as `response.data`, and the URLs of the
+        next and last pages as `response.page_links`. A 304 doesn't always
+        repeat the Link header, so those are cached with the body.
+        """
+        cache_key = requests.Request("GET", url, params=params).prepare().url
+        self._used.add(cache_key)
+        headers = {}
+        cached = self._etags.get(cache_key)
+        if cached:
+            headers["If-None-Match"] = cached[0]
+        
+        response = self.request("GET", url, params=params, headers=headers)
+        if response.status_code == 304 and cached:
+            response.data = cached[1]
+            response.page_links = cached[2]
+        elif response.status_code == 200:
+            response.data = response.json()
+            response.page_links = {rel: link["url"] for rel, link in response.links.items() if rel in ("next", "last")}
+            etag = response.headers.get("ETag")
+            if etag:
+                self._etags[cache_key] = (etag, response.data, response.page_links)
+        else:
+            response.data = None
+            response.page_links = {}
+        return response
+    
+    def get_page(self, url: str, params: Optional[Dict[str, Any]] = None) -> requests.Response:
+        """GET one page of a list endpoint.
+        
+        Raises:
+            ValueError: If the page can't be fetched
+        """
+        response = self.get(url, params=params)
+        if response.data is None:
+            raise ValueError(f"Error fetching {url}: {response.text}")
+        return response
+    
+    def get_all(self, url: str) -> List[Any]:
+        """GET every page of a list endpoint.
+        
+        When the first page links to the last one, the remaining pages are
+        fetched at the same time, otherwise they are followed one by one.
+        
+        Raises:
+            ValueError: If any page can't be fetched
+        """
+        response = self.get_page(url, params={"per_page": GITHUB_PAGE_SIZE})
+        items = list(response.data)
+        
+        last = response.page_links.get("last", "")
+        last_page = re.search(r"[?&]page=(\d+)", last)
+        if last_page:
+            urls = [re.sub(r"([?&]page=)\d+", rf"\g<1>{page}", last) for page in range(2, int(last_page.group(1)) + 1)]
+            with ThreadPoolExecutor(max_workers=GITHUB_MAX_PARALLEL_PAGES) as pool:
+                for page in pool.map(self.get_page, urls):
+                    items.extend(page.data)
+            return items
+        
+        # The next link already carries the query parameters
+        url = response.page_links.get("next")
+        while url:
+            response = self.get_page(url)
+            items.extend(response.data)
+            url = response.page_links.get("next")
+        return items
+    
+    def post(self, url: str, json: Dict[str, Any]) -> requests.Response:
+        return self.request("POST", url, json=json)
+    
+    def save(self) -> None:
+        """Write the responses requested by this sync to the cache path, if there is one."""
+        if not self.cache_path:
+            return
+        responses = {url: list(entry) for url, entry in self._etags.items() if url in self._used}
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_path, "w") as f:
+            json.dump({"responses": responses}, f, sort_keys=True)
+
+_github_clients: Dict[str, GitHubClient] = {}
+
+def github_client(token: str) -> GitHubClient:
+    """Return the shared GitHub client for a token, caching responses in the workspace if there is one."""
+    if token not in _github_clients:
+        workspace = os.environ.get("GITHUB_WORKSPACE")
+        _github_clients[token] = GitHubClient(token, cache_path=Path(workspace) / GITHUB_CACHE_PATH if workspace else None)
+    return _github_clients[token]
+
+def event_pull_request(event_data: Dict[str, Any], client: GitHubClient) -> Optional[int]:
+    """Return the number of the PR a GitHub event is for.
+    
+    A push event is matched to the merged PR that the pushed commit belongs
+    to, so a sync run on the push of a merge still knows its PR.
+    
+    Returns:
+        The PR number, or None if the push is not the merge of a PR
+    
+    Raises:
+        ValueError: If the PRs of the pushed commit can't be fetched
+    """
+    if "pull_request" in event_data:
+        return event_data["pull_request"]["number"]
+    repo = event_data["repository"]["full_name"]
+    response = client.get_page(f"{GITHUB_API_URL}/repos/{repo}/commits/{event_data['after']}/pulls")
+    merged = [pr["number"] for pr in response.data if pr.get("merged_at")]
+    return merged[0] if merged else None
+
 def get_changed_files() -> List[str]:
     """Get list of files changed in the PR using GitHub API."""
     event_path = os.environ.get("GITHUB_EVENT_PATH")
@@ -54,12 +647,11 @@ def get_changed_files() -> List[str]:
         with open(event_path) as f:
             event_data = json.load(f)
             
-        # For PR merge events, we need to get the PR number from the event
-        if "pull_request" not in event_data:
+        # For PR merge events, we need to get the PR number from the event, or from the pushed commit
+        if "pull_request" not in event_data and "after" not in event_data:
             print("No PR data found in event")
             return []
             
-        pr_number = event_data["pull_request"]["number"]
         repo = event_data["repository"]["full_name"]
         github_token = os.environ.get("GITHUB_TOKEN")
         
@@ -67,27 +659,116 @@ def get_changed_files() -> List[str]:
             print("No GitHub token found")
             return []
             
-        headers = {
-            "Authorization": f"token {github_token}",
-            "Accept": "application/vnd.github.v3+json"
-        }
-        
-        url = f"https://api.github.com/repos/{repo}/pulls/{pr_number}/files"
-        response = requests.get(url, headers=headers)
+        client = github_client(github_token)
+        pr_number = event_pull_request(event_data, client)
+        if pr_number is None:
+            print(f"No merged PR found for {event_data['after']}")
+            client.save()
+            return []
+        url = f"{GITHUB_API_URL}/repos/{repo}/pulls/{pr_number}/files"
+        files = [file["filename"] for file in client.get_all(url)]
+        client.save()
         
-        if response.status_code == 200:
-            print(f"PR files:")
-            for file in response.json():
-                print(f"  - {file['filename']}")
-            return [file["filename"] for file in response.json()]
-        else:
-            print(f"Error fetching PR files: {response.text}")
+        print(f"PR files:")
+        for filename in files:
+            print(f"  - {filename}")
+        return files
             
     except Exception as e:
         print(f"Error processing event data: {e}")
         
     return []
 
+def get_changed_files_since(ref: str, repo_path: Path) -> List[str]:
+    """Get list of files changed since a git ref, using the local repository.
+    
+    Compares the ref with the working tree, with rename detection, so both
+    the old and new path of a renamed file are included. Untracked files
+    are included as well.
+    
+    Args:
+        ref: Any git revision (branch, tag, commit, e.g. 'origin/main')
+        repo_path: Path inside the git repository
+        
+    Returns:
+        List[str]: Changed paths relative to the repository root
+        
+    Raises:
+        ValueError: If git fails (e.g. the ref doesn't exist)
+    """
+    diff = subprocess.run(
+        ["git", "-C", str(repo_path), "diff", "--name-status", "-z", "-M", ref, "--"],
+        capture_output=True,
+        text=True
+    )
+    if diff.returncode != 0:
+        raise ValueError(f"Failed to diff against {ref}: {diff.stderr.strip()}")
+    
+    changed_files = []
+    fields = diff.stdout.split("\0")
+    i = 0
+    while i < len(fields) and fields[i]:
+        status = fields[i]
+        # Renames and copies are followed by the old and the new path
+        path_count = 2 if status[0] in ("R", "C") else 1
+        changed_files.extend(fields[i + 1:i + 1 + path_count])
+        i += 1 + path_count
+    
+    untracked = subprocess.run(
+        ["git", "-C", str(repo_path), "ls-files", "--others", "--exclude-standard", "--full-name", "-z"],
+        capture_output=True,
+        text=True
+    )
+    if untracked.returncode == 0:
+        changed_files.extend(path for path in untracked.stdout.split("\0") if path)
+    
+    print(f"Files changed since {ref}:")
+    for changed_file in changed_files:
+        print(f"  - {changed_file}")
+    return changed_files
+
+class ConcurrencyBudget:
+    """Bounds how many calls to a service run at the same time, adapting to its pressure.
+    
+    Starts at `maximum` calls, halves when a call is throttled or fails,
+    and grows back by one with every call that succeeds, so a busy service
+    is called as fast as it currently allows. Used with `async with`.
+    """
+    
+    def __init__(self, maximum: int):
+        self.maximum = maximum
+        self.limit = maximum
+        self.active = 0
+        self._loop = None
+        self._condition: Optional[asyncio.Condition] = None
+    
+    def _wakeup(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+            self.active = 0
+        return self._condition
+    
+    async def __aenter__(self) -> "ConcurrencyBudget":
+        condition = self._wakeup()
+        async with condition:
+            await condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        return self
+    
+    async def __aexit__(self, *exc_info) -> None:
+        condition = self._wakeup()
+        async with condition:
+            self.active -= 1
+            condition.notify_all()
+    
+    def shrink(self) -> None:
+        self.limit = max(1, self.limit // 2)
+    
+    def grow(self) -> None:
+        self.limit = min(self.maximum, self.limit + 1)
+
 def sand_command() -> str:
     """Returns the path to the sand command."""
     if os.environ.get("SAND_CLI_PATH"):
@@ -95,50 +776,1095 @@ def sand_command() -> str:
     else:
         return "sand"
 
-def find_prompts(step_dir: Path, changed_files: List[str]) -> List[Dict[str, Any]]:
-    """Find all prompts for a step."""
+class SandBackend(ABC):
+    """Interface to the Sandgarden API used by the sync.
+    
+    Implementations list every resource of a type and push new versions of
+    prompts, steps and workflows. The async versions of those calls run the
+    blocking ones on a worker thread unless a backend overrides them, and
+    every backend bounds how many of its calls run at the same time with
+    its concurrency budget.
+    """
+    
+    # Most calls to the backend to make at the same time
+    max_concurrency = SAND_CLI_MAX_PROCESSES
+    
+    def budget(self) -> ConcurrencyBudget:
+        """Return the budget bounding concurrent calls to this backend."""
+        if getattr(self, "_budget", None) is None:
+            self._budget = ConcurrencyBudget(self.max_concurrency)
+        return self._budget
+    
+    @abstractmethod
+    def list_resources(self, resource_type: str, name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """List every resource of a type in Sandgarden, following pages.
+        
+        Args:
+            resource_type: Type of resource (prompts, steps, workflows)
+            name: Only list the versions of the resource with this name
+            
+        Returns:
+            List[Dict[str, Any]]: All versions of all resources of that type
+            
+        Raises:
+            ValueError: If the listing fails
+        """
+        raise NotImplementedError
+    
+    @abstractmethod
+    def push(self, resource_type: str, name: str, data: Dict[str, Any], tag: str) -> Dict[str, Any]:
+        """Push a new version of a resource.
+        
+        Returns:
+            Dict[str, Any]: The created resource, including its version
+            
+        Raises:
+            ValueError: If the push fails
+        """
+        raise NotImplementedError
+    
+    @abstractmethod
+    def describe(self, resource_type: str, name: str, data: Dict[str, Any], tag: str) -> str:
+        """Describe what push would do, for dry runs."""
+        raise NotImplementedError
+    
+    def list_resources_if_changed(self, resource_type: str, etag: Optional[str] = None) -> Tuple[Optional[List[Dict[str, Any]]], Optional[str]]:
+        """List every resource of a type, unless nothing changed since the listing that returned etag.
+        
+        Backends that can't tell list everything every time.
+        
+        Returns:
+            The resources, or None if nothing changed, and the ETag of this
+            listing, or None if the backend has none
+        """
+        return self.list_resources(resource_type), None
+    
+    async def list_resources_async(self, resource_type: str, name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Async version of list_resources."""
+        async with self.budget():
+            return await asyncio.to_thread(self.list_resources, resource_type, name)
+    
+    async def list_resources_if_changed_async(self, resource_type: str, etag: Optional[str] = None) -> Tuple[Optional[List[Dict[str, Any]]], Optional[str]]:
+        """Async version of list_resources_if_changed."""
+        async with self.budget():
+            return await asyncio.to_thread(self.list_resources_if_changed, resource_type, etag)
+    
+    async def push_async(self, resource_type: str, name: str, data: Dict[str, Any], tag: str) -> Dict[str, Any]:
+        """Async version of push."""
+        async with self.budget():
+            return await asyncio.to_thread(self.push, resource_type, name, data, tag)
+
+class CliBackend(SandBackend):
+    """Backend that runs the sand CLI for every call.
+    
+    Commands that fail with what looks like a transient error (a rate
+    limit, a timeout, a 5xx from the API) are run again following the
+    backend's retry policy. Pushes create a new version every time, and a
+    timeout or a 5xx doesn't tell whether it was created, so they are only
+    run again when they were rate limited.
+    """
+    
+    def __init__(self, retry: Optional[RetryPolicy] = None):
+        self.retry = retry or RetryPolicy("sand CLI")
+    
+    @staticmethod
+    def check_transient(result: subprocess.CompletedProcess, idempotent: bool = True) -> None:
+        """Raise RetryableError, carrying the result, if a command failed transiently.
+        
+        Args:
+            result: The finished command
+            idempotent: Whether running the command twice is harmless. If not,
+                only failures that mean it was turned away are transient.
+        """
+        if result.returncode == 0:
+            return
+        output = "\n".join(out for out in (result.stderr, result.stdout) if isinstance(out, str))
+        if (SAND_CLI_TRANSIENT_ERRORS if idempotent else SAND_CLI_REJECTED_ERRORS).search(output):
+            raise RetryableError(f"sand exited with code {result.returncode}: {output.strip()[:200]}", result=result)
+    
+    def run(self, cmd: List[str], idempotent: bool = True) -> subprocess.CompletedProcess:
+        """Run a sand command, retrying transient failures and recording it in the profile."""
+        def attempt() -> subprocess.CompletedProcess:
+            with profiler.phase(" ".join(cmd[1:4]), "cli") as record:
+                result = subprocess.run(cmd, capture_output=True, text=True)
+                if isinstance(result.stdout, str):
+                    record["bytes"] = len(result.stdout)
+                record["result"] = "ok" if result.returncode == 0 else f"error: exit code {result.returncode}"
+            self.check_transient(result, idempotent)
+            return result
+        return self.retry.call(attempt)
+    
+    async def run_async(self, cmd: List[str], idempotent: bool = True) -> subprocess.CompletedProcess:
+        """Run a sand command without blocking the event loop."""
+        async def attempt() -> subprocess.CompletedProcess:
+            budget = self.budget()
+            async with budget:
+                with profiler.phase(" ".join(cmd[1:4]), "cli") as record:
+                    process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+                    stdout, stderr = await process.communicate()
+                    result = subprocess.CompletedProcess(cmd, process.returncode, stdout.decode(), stderr.decode())
+                    record["bytes"] = len(result.stdout)
+                    record["result"] = "ok" if result.returncode == 0 else f"error: exit code {result.returncode}"
+            try:
+                self.check_transient(result, idempotent)
+            except RetryableError:
+                budget.shrink()
+                raise
+            budget.grow()
+            return result
+        return await self.retry.call_async(attempt)
+    
+    def list_command(self, resource_type: str, page_token: Optional[str] = None, name: Optional[str] = None) -> List[str]:
+        """Build the sand command that lists a page of resources."""
+        cmd = [sand_command(), resource_type, "list", "--json"]
+        if name:
+            cmd.extend(["--name", name])
+        if page_token:
+            cmd.extend(["--page-token", page_token])
+        return cmd
+    
+    def parse_page(self, resource_type: str, result: subprocess.CompletedProcess) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Parse a page of resources, returning them and the next page token."""
+        if result.returncode != 0:
+            raise ValueError(f"Failed to list {resource_type}: {result.stderr}")
+        try:
+            page = json.loads(result.stdout)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON response from sand command: {e}")
+        
+        if isinstance(page, list):
+            return page, None
+        return page.get(resource_type) or [], page.get("nextPageToken")
+    
+    def list_resources(self, resource_type: str, name: Optional[str] = None) -> List[Dict[str, Any]]:
+        resources = []
+        page_token = None
+        while True:
+            page, page_token = self.parse_page(resource_type, self.run(self.list_command(resource_type, page_token, name)))
+            resources.extend(page)
+            if not page_token:
+                return resources
+    
+    async def list_resources_async(self, resource_type: str, name: Optional[str] = None) -> List[Dict[str, Any]]:
+        resources = []
+        page_token = None
+        while True:
+            page, page_token = self.parse_page(resource_type, await self.run_async(self.list_command(resource_type, page_token, name)))
+            resources.extend(page)
+            if not page_token:
+                return resources
+    
+    async def list_resources_if_changed_async(self, resource_type: str, etag: Optional[str] = None) -> Tuple[Optional[List[Dict[str, Any]]], Optional[str]]:
+        # The CLI has no conditional listing
+        return await self.list_resources_async(resource_type), None
+    
+    def command(self, resource_type: str, name: str, data: Dict[str, Any], tag: str) -> List[str]:
+        """Build the sand command that pushes a resource."""
+        if resource_type == "prompts":
+            cmd = [
+                sand_command(), "prompts", "create",
+                "--content", data["content"],
+                "--name", name,
+                "--json"
+            ]
+        elif resource_type == "steps":
+            if data.get("image"):
+                # The build context is unchanged, so register the existing image
+                cmd = [
+                    sand_command(), "steps", "create", "docker",
+                    "--name", name,
+                    "--description", "Updated via GitHub sync",
+                    "--image", data["image"],
+                    "--tag", tag,
+                    "--json"
+                ]
+            else:
+                cmd = [
+                    sand_command(), "steps", "push", "docker",
+                    "--name", name,
+                    "--description", "Updated via GitHub sync",
+                    "--file", os.path.relpath(data["path"]),
+                    "--sync",
+                    "--tag", tag,
+                    "--json"
+                ]
+            # Add any prompts associated with this step
+            for prompt in data.get("prompts", []):
+                cmd.extend(["--prompt", f"{prompt['name']}:{prompt['version']}"])
+            # Add any connectors associated with this step
+            for connector in data.get("connectors", []):
+                cmd.extend(["--connector", connector])
+        elif resource_type == "workflows":
+            cmd = [
+                sand_command(), "workflows", "push",
+                "--name", name,
+                "--description", "Updated via GitHub sync",
+                "--stages", json.dumps(data["stages"]),
+                "--tag", tag,
+                "--json"
+            ]
+        else:
+            raise ValueError(f"Invalid resource type: {resource_type}")
+        return cmd
+    
+    def parse_push(self, resource_type: str, name: str, result: subprocess.CompletedProcess) -> Dict[str, Any]:
+        """Parse the output of a push command."""
+        if result.returncode != 0:
+            print(f"Error updating {resource_type} {name}: {result.stdout}\n{result.stderr}")
+            raise ValueError(f"Failed to update {resource_type} {name}")
+            
+        try:
+            return json.loads(result.stdout)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON response from sand command: {e}")
+    
+    def push(self, resource_type: str, name: str, data: Dict[str, Any], tag: str) -> Dict[str, Any]:
+        return self.parse_push(resource_type, name, self.run(self.command(resource_type, name, data, tag), idempotent=False))
+    
+    async def push_async(self, resource_type: str, name: str, data: Dict[str, Any], tag: str) -> Dict[str, Any]:
+        return self.parse_push(resource_type, name, await self.run_async(self.command(resource_type, name, data, tag), idempotent=False))
+    
+    def describe(self, resource_type: str, name: str, data: Dict[str, Any], tag: str) -> str:
+        return ' '.join(self.command(resource_type, name, data, tag))
+
+class HttpBackend(SandBackend):
+    """Backend that calls the Sandgarden REST API directly.
+    
+    Uses one keep-alive session for every call and sends prompt content in
+    the request body. Steps that need a new image still go through the CLI
+    because that builds the docker image locally. Async calls run on worker
+    threads, as many at a time as the session has connections.
+    """
+    
+    max_concurrency = SAND_API_POOL_SIZE
+    
+    def __init__(self, api_key: str, base_url: str = DEFAULT_SAND_API_URL, cli: Optional[CliBackend] = None, retry: Optional[RetryPolicy] = None):
+        self.base_url = base_url.rstrip("/")
+        self.cli = cli or CliBackend()
+        self.retry = retry or RetryPolicy("Sandgarden API")
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Accept": "application/json"
+        })
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=SAND_API_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+    
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Make a request to the API, retrying throttled and failed requests and recording it in the profile.
+        
+        Only GET requests are retried after a timeout, a dropped connection or
+        a 5xx. Other requests create something and may have done so before
+        failing, so they are only retried when they were rate limited or
+        never reached the API.
+        
+        Raises:
+            RetryableError: If the connection keeps failing
+        """
+        idempotent = method == "GET"
+        retry_status_codes = RETRY_STATUS_CODES if idempotent else (429,)
+        retry_errors = (requests.ConnectionError, requests.Timeout) if idempotent else (requests.ConnectTimeout,)
+        def attempt() -> requests.Response:
+            with profiler.phase(f"{method} {url}", "http") as record:
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except retry_errors as e:
+                    self.budget().shrink()
+                    raise RetryableError(f"{method} {url} failed: {e}") from e
+                record["bytes"] = len(response.content)
+                record["result"] = "ok" if response.status_code < 400 else f"error: HTTP {response.status_code}"
+            if response.status_code in retry_status_codes:
+                self.budget().shrink()
+                raise RetryableError(f"{method} {url} returned HTTP {response.status_code}", retry_after=retry_after_seconds(response), result=response)
+            self.budget().grow()
+            return response
+        return self.retry.call(attempt)
+    
+    def list_resources(self, resource_type: str, name: Optional[str] = None) -> List[Dict[str, Any]]:
+        resources, _ = self.list_resources_if_changed(resource_type, name=name)
+        return resources
+    
+    def list_resources_if_changed(self, resource_type: str, etag: Optional[str] = None, name: Optional[str] = None) -> Tuple[Optional[List[Dict[str, Any]]], Optional[str]]:
+        resources = []
+        base_params = {"name": name} if name else {}
+        params = dict(base_params)
+        headers = {"If-None-Match": etag} if etag else {}
+        while True:
+            response = self.request("GET", f"{self.base_url}/{resource_type}", params=params, headers=headers)
+            if response.status_code == 304:
+                return None, etag
+            if response.status_code != 200:
+                raise ValueError(f"Failed to list {resource_type}: {response.text}")
+            page = response.json()
+            resources.extend(page.get(resource_type) or [])
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                # The ETag of a page only covers that page
+                return resources, response.headers.get("ETag") if "pageToken" not in params else None
+            params = dict(base_params, pageToken=page_token)
+            headers = {}
+    
+    def request_body(self, resource_type: str, name: str, data: Dict[str, Any], tag: str) -> Dict[str, Any]:
+        """Build the body of the request that pushes a resource."""
+        if resource_type == "prompts":
+            return {"name": name, "content": data["content"]}
+        if resource_type == "steps" and data.get("image"):
+            return {
+                "name": name,
+                "description": "Updated via GitHub sync",
+                "image": data["image"],
+                "tags": [tag],
+                "prompts": [f"{prompt['name']}:{prompt['version']}" for prompt in data.get("prompts", [])],
+                "connectors": data.get("connectors", [])
+            }
+        if resource_type == "workflows":
+            return {
+                "name": name,
+                "description": "Updated via GitHub sync",
+                "stages": data["stages"],
+                "tags": [tag]
+            }
+        raise ValueError(f"Invalid resource type: {resource_type}")
+    
+    def push(self, resource_type: str, name: str, data: Dict[str, Any], tag: str) -> Dict[str, Any]:
+        if resource_type == "steps" and not data.get("image"):
+            return self.cli.push(resource_type, name, data, tag)
+        
+        body = self.request_body(resource_type, name, data, tag)
+        response = self.request("POST", f"{self.base_url}/{resource_type}", json=body)
+        if response.status_code not in (200, 201):
+            print(f"Error updating {resource_type} {name}: {response.text}")
+            raise ValueError(f"Failed to update {resource_type} {name}")
+        
+        try:
+            return response.json()
+        except ValueError as e:
+            raise ValueError(f"Invalid JSON response from Sandgarden API: {e}")
+    
+    async def push_async(self, resource_type: str, name: str, data: Dict[str, Any], tag: str) -> Dict[str, Any]:
+        if resource_type == "steps" and not data.get("image"):
+            return await self.cli.push_async(resource_type, name, data, tag)
+        return await super().push_async(resource_type, name, data, tag)
+    
+    def describe(self, resource_type: str, name: str, data: Dict[str, Any], tag: str) -> str:
+        if resource_type == "steps" and not data.get("image"):
+            return self.cli.describe(resource_type, name, data, tag)
+        body = self.request_body(resource_type, name, data, tag)
+        return f"POST {self.base_url}/{resource_type} {json.dumps(body)}"
+
+def get_backend(name: Optional[str] = None) -> SandBackend:
+    """Return the backend to use, 'cli' (default) or 'http'.
+    
+    The backend can also be chosen with SAND_BACKEND, and the API URL of the
+    http backend with SAND_API_URL.
+    """
+    name = name or os.environ.get("SAND_BACKEND", "cli")
+    if name == "cli":
+        return CliBackend()
+    if name == "http":
+        return HttpBackend(os.environ.get("SAND_API_KEY", ""), os.environ.get("SAND_API_URL", DEFAULT_SAND_API_URL))
+    raise ValueError(f"Invalid backend: {name}")
+
+class RemoteStateCache:
+    """Remote state kept between syncs, e.g. in the Actions cache.
+    
+    For each resource type, records the latest version of every resource,
+    when the type was listed and the ETag of the listing. A type listed less
+    than ttl seconds ago is used without asking Sandgarden. After that it is
+    revalidated with its ETag where the backend supports it, or listed
+    again. Pushes of this sync are recorded as they happen, and a type is
+    dropped when a push shows someone else pushed to it in between.
+    """
+    
+    def __init__(self, path: Optional[Path] = None, ttl: float = REMOTE_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._types: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        if path and path.exists():
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+                if snapshot.get("version") == REMOTE_CACHE_VERSION:
+                    self._types = snapshot.get("types", {})
+            except Exception as e:
+                print(f"Error reading remote state cache {path}: {e}")
+    
+    def fresh(self, resource_type: str) -> Optional[Dict[str, Dict[str, Any]]]:
+        """Return the cached resources of a type if they are younger than the TTL."""
+        entry = self._types.get(resource_type)
+        if entry is None or time.time() - entry["listed_at"] >= self.ttl:
+            return None
+        return dict(entry["resources"])
+    
+    def etag(self, resource_type: str) -> Optional[str]:
+        """Return the ETag of the cached listing of a type, if any."""
+        return self._types.get(resource_type, {}).get("etag")
+    
+    def revalidated(self, resource_type: str) -> Dict[str, Dict[str, Any]]:
+        """Mark the cached resources of a type as just listed and return them."""
+        with self._lock:
+            entry = self._types[resource_type]
+            entry["listed_at"] = time.time()
+            return dict(entry["resources"])
+    
+    def store(self, resource_type: str, resources: Dict[str, Dict[str, Any]], etag: Optional[str] = None) -> None:
+        """Record a listing of a type, indexed by name."""
+        with self._lock:
+            self._types[resource_type] = {"listed_at": time.time(), "etag": etag, "resources": dict(resources)}
+    
+    def pushed(self, resource_type: str, resource: Dict[str, Any], previous: Optional[Dict[str, Any]]) -> None:
+        """Record a version this sync pushed, given the version that was the latest before."""
+        with self._lock:
+            entry = self._types.get(resource_type)
+            if entry is None:
+                return
+            if resource.get("version") != (previous or {}).get("version", 0) + 1:
+                # Someone else pushed since the type was listed
+                del self._types[resource_type]
+                return
+            entry["resources"][resource["name"]] = resource
+            # Listings changed, so the ETag no longer matches them
+            entry["etag"] = None
+    
+    def save(self) -> None:
+        """Write the cache back to its path."""
+        if not self.path:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            with open(self.path, "w") as f:
+                json.dump({"version": REMOTE_CACHE_VERSION, "types": self._types}, f, sort_keys=True)
+
+class RemoteState:
+    """Snapshot of the prompts, steps and workflows that exist in Sandgarden.
+    
+    Each resource type is listed once, the first time it is looked up or
+    when load_async lists them all up front, and indexed by name with the
+    latest version resolved. Lookups after that are served from memory.
+    
+    load_async can also look up only some resources by name. Their types are
+    then partially loaded, and other names of them are looked up one by one.
+    
+    With a cache, whole types are read from it while they are fresh, and
+    revalidated or listed again after that.
+    """
+    
+    def __init__(self, backend: Optional[SandBackend] = None, cache: Optional[RemoteStateCache] = None):
+        self.backend = backend or CliBackend()
+        self.cache = cache
+        self._index: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        # Names looked up so far of the partially loaded types
+        self._names: Dict[str, set] = {}
+    
+    def _load(self, resource_type: str, name: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        with profiler.phase(f"list {resource_type}" + (f" {name}" if name else ""), "remote lookups") as record:
+            try:
+                if name:
+                    resources = self.backend.list_resources(resource_type, name)
+                    record["result"] = f"{len(resources)} {resource_type}"
+                    return self._latest_versions(resources)
+                etag = self.cache.etag(resource_type) if self.cache else None
+                return self._listed(resource_type, *self.backend.list_resources_if_changed(resource_type, etag), record)
+            except Exception as e:
+                print(f"Error getting {resource_type} from Sandgarden: {e}")
+                record["result"] = f"error: {e}"
+                return {}
+    
+    async def _load_async(self, resource_type: str, name: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        with profiler.phase(f"list {resource_type}" + (f" {name}" if name else ""), "remote lookups") as record:
+            try:
+                if name:
+                    resources = await self.backend.list_resources_async(resource_type, name)
+                    record["result"] = f"{len(resources)} {resource_type}"
+                    return self._latest_versions(resources)
+                etag = self.cache.etag(resource_type) if self.cache else None
+                return self._listed(resource_type, *await self.backend.list_resources_if_changed_async(resource_type, etag), record)
+            except Exception as e:
+                print(f"Error getting {resource_type} from Sandgarden: {e}")
+                record["result"] = f"error: {e}"
+                return {}
+    
+    def _listed(self, resource_type: str, resources: Optional[List[Dict[str, Any]]], etag: Optional[str], record: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """Index a listing of a whole type and keep it in the cache."""
+        if resources is None:
+            record["result"] = "not modified"
+            return self.cache.revalidated(resource_type)
+        record["result"] = f"{len(resources)} {resource_type}"
+        index = self._latest_versions(resources)
+        if self.cache:
+            self.cache.store(resource_type, index, etag)
+        return index
+    
+    def _cached(self, resource_type: str) -> bool:
+        """Load a type from the cache if it is fresh there."""
+        index = self.cache.fresh(resource_type) if self.cache else None
+        if index is None:
+            return False
+        with profiler.phase(f"list {resource_type}", "remote lookups") as record:
+            record["result"] = f"{len(index)} {resource_type} cached"
+        self._index[resource_type] = index
+        return True
+    
+    @staticmethod
+    def _latest_versions(resources: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        index = {}
+        for resource in resources:
+            name = resource.get("name") if isinstance(resource, dict) else None
+            if not name:
+                continue
+            # Keep only the latest version of each resource
+            current = index.get(name)
+            if current is None or resource.get("version", 0) > current.get("version", 0):
+                index[name] = resource
+        return index
+    
+    def _missing(self, resource_type: str, name: str) -> bool:
+        """Whether a resource has not been looked up yet."""
+        if resource_type not in self._index:
+            return True
+        return resource_type in self._names and name not in self._names[resource_type]
+    
+    async def load_async(self, resource_types: Iterable[str] = RESOURCE_TYPES, names: Optional[Dict[str, Iterable[str]]] = None) -> None:
+        """List every resource type not loaded yet, all at the same time.
+        
+        Args:
+            resource_types: Types of resources to load
+            names: Only look up these names of each type, one call per name.
+                Types with more than REMOTE_NAMED_LOOKUPS names are listed whole.
+        """
+        for t in resource_types:
+            if t not in self._index:
+                self._cached(t)
+        names = {t: sorted(set(names.get(t, ()))) for t in resource_types} if names is not None else {}
+        listed = [t for t in resource_types if t not in self._index and (t not in names or len(names[t]) > REMOTE_NAMED_LOOKUPS)]
+        lookups = [(t, name) for t in resource_types if t in names and t not in listed for name in names[t] if self._missing(t, name)]
+        indexes = await asyncio.gather(
+            *(self._load_async(t) for t in listed),
+            *(self._load_async(t, name) for t, name in lookups)
+        )
+        for t, index in zip(listed, indexes):
+            self._index[t] = index
+        for (t, name), index in zip(lookups, indexes[len(listed):]):
+            self._index.setdefault(t, {}).update(index)
+            self._names.setdefault(t, set()).add(name)
+    
+    def latest(self, resource_type: str, name: str) -> Optional[Dict[str, Any]]:
+        """Return the latest version of a resource, or None if it does not exist."""
+        if resource_type not in self._index and not self._cached(resource_type):
+            self._index[resource_type] = self._load(resource_type)
+        elif self._missing(resource_type, name):
+            self._index[resource_type].update(self._load(resource_type, name))
+            self._names[resource_type].add(name)
+        return self._index[resource_type].get(name)
+    
+    def remember(self, resource_type: str, resource: Dict[str, Any]) -> None:
+        """Record a version this sync pushed as the latest one."""
+        if resource_type in self._index:
+            previous = self._index[resource_type].get(resource["name"])
+            self._index[resource_type][resource["name"]] = resource
+            if self.cache:
+                self.cache.pushed(resource_type, resource, previous)
+    
+    def save(self) -> None:
+        """Write the cache, if there is one, for the next sync."""
+        if self.cache:
+            self.cache.save()
+
+class ChangedFileIndex:
+    """Changed file paths, indexed in a trie of path segments.
+    
+    Every node counts the changed files at or below it, so checking a file
+    or whether anything under a directory changed costs one walk down the
+    path, however many files changed.
+    """
+    
+    class _Node:
+        __slots__ = ("children", "count", "is_file")
+        
+        def __init__(self):
+            self.children: Dict[str, "ChangedFileIndex._Node"] = {}
+            self.count = 0
+            self.is_file = False
+    
+    def __init__(self, paths: Iterable[str] = ()):
+        self._root = self._Node()
+        for path in paths:
+            self.add(path)
+    
+    @staticmethod
+    def _segments(path: str) -> List[str]:
+        return [segment for segment in path.split("/") if segment and segment != "."]
+    
+    def add(self, path: str) -> None:
+        node = self._root
+        node.count += 1
+        for segment in self._segments(path):
+            node = node.children.setdefault(segment, self._Node())
+            node.count += 1
+        node.is_file = True
+    
+    def _find(self, path: str) -> Optional["ChangedFileIndex._Node"]:
+        node = self._root
+        for segment in self._segments(path):
+            node = node.children.get(segment)
+            if node is None:
+                return None
+        return node
+    
+    def __contains__(self, path: str) -> bool:
+        node = self._find(path)
+        return node is not None and node.is_file
+    
+    def __len__(self) -> int:
+        return self._root.count
+    
+    def has_changes_under(self, directory: str, exclude: Optional[str] = None) -> bool:
+        """Check whether any file under a directory changed.
+        
+        Args:
+            directory: Directory path, relative to the repository root
+            exclude: Sub-directory of directory whose changes don't count
+        """
+        node = self._find(directory)
+        if node is None:
+            return False
+        count = node.count
+        if exclude and exclude in node.children:
+            count -= node.children[exclude].count
+        return count > 0
+
+def changed_file_index(changed_files: Union[List[str], ChangedFileIndex]) -> ChangedFileIndex:
+    """Return changed_files as an index, building it if needed."""
+    if isinstance(changed_files, ChangedFileIndex):
+        return changed_files
+    return ChangedFileIndex(changed_files)
+
+def file_digests(root: Path, skip: Tuple[str, ...] = (), keep: Tuple[str, ...] = ()) -> Tuple[Dict[Tuple[str, ...], bytes], Dict[str, bytes]]:
+    """Hash every file under a directory, reading each file once.
+    
+    Args:
+        root: Directory to walk
+        skip: Files or sub-directories directly under root to leave out
+        keep: Files directly under root whose contents are returned as well
+        
+    Returns:
+        The SHA-256 of every file keyed by its relative path parts, and the
+        contents of the kept files keyed by name
+    """
+    digests = {}
+    kept = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        relative = Path(dirpath).relative_to(root).parts
+        if not relative:
+            dirnames[:] = [d for d in dirnames if d not in skip]
+            filenames = [f for f in filenames if f not in skip]
+        dirnames[:] = [d for d in dirnames if d != "__pycache__"]
+        for filename in filenames:
+            with open(os.path.join(dirpath, filename), "rb") as f:
+                content = f.read()
+            digests[relative + (filename,)] = hashlib.sha256(content).digest()
+            if not relative and filename in keep:
+                kept[filename] = content
+    return digests, kept
+
+def combine_digests(digests: Dict[Tuple[str, ...], bytes], exclude: Tuple[str, ...] = ()) -> str:
+    """Combine file digests from file_digests into a single hash.
+    
+    Args:
+        digests: File digests keyed by relative path parts
+        exclude: Files or sub-directories of the root to leave out
+        
+    Returns:
+        str: Hex SHA-256 digest of the relative paths and contents
+    """
+    digest = hashlib.sha256()
+    for parts in sorted(digests):
+        if parts[0] in exclude:
+            continue
+        digest.update("/".join(parts).encode())
+        digest.update(b"\0")
+        digest.update(digests[parts])
+    return digest.hexdigest()
+
+def hash_tree(root: Path, exclude: Tuple[str, ...] = ()) -> str:
+    """Hash the contents of a file or of every file under a directory.
+    
+    Args:
+        root: File or directory to hash
+        exclude: Files or sub-directories of root to leave out (e.g. 'prompts')
+        
+    Returns:
+        str: Hex SHA-256 digest of the relative paths and contents
+    """
+    if root.is_file():
+        return hashlib.sha256(root.read_bytes()).hexdigest()
+    return combine_digests(file_digests(root, skip=exclude)[0])
+
+def step_build_fingerprint(step_dir: Path, base_image: Optional[str] = None, digests: Optional[Dict[Tuple[str, ...], bytes]] = None) -> str:
+    """Fingerprint the docker build context of a step.
+    
+    Covers the step's code, its requirements.txt and its base image, but not
+    its prompts or config.yml, which only change what the image is bound to.
+    
+    Args:
+        step_dir: Step directory
+        base_image: Base image from the step's config.yml, if any
+        digests: File digests of the step, without its prompts, if already known
+        
+    Returns:
+        str: Hex SHA-256 digest of the build context
+    """
+    if digests is None:
+        digests = file_digests(step_dir, skip=("prompts",))[0]
+    if ("Dockerfile",) in digests:
+        base_image = " ".join(
+            line.strip() for line in (step_dir / "Dockerfile").read_text().splitlines()
+            if line.strip().upper().startswith("FROM ")
+        )
+    requirements = digests.get(("requirements.txt",))
+    
+    digest = hashlib.sha256()
+    for part in (
+        combine_digests(digests, exclude=("config.yml",)),
+        requirements.hex() if requirements else "",
+        base_image or ""
+    ):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def parse_config(content: Optional[bytes], path: Path) -> Dict[str, Any]:
+    """Parse the contents of a config.yml, empty if missing or invalid."""
+    if content is None:
+        return {}
+    try:
+        return yaml.load(content, Loader=YamlLoader) or {}
+    except Exception as e:
+        print(f"Error reading config.yml in {path}: {e}")
+        return {}
+
+@dataclass(slots=True)
+class PromptSource:
+    """A prompt file of a step."""
+    name: str
+    path: Path
+    content: str
+    hash: str
+
+@dataclass(slots=True)
+class StepSource:
+    """A step directory of a workflow."""
+    name: str
+    path: Path
+    config: Dict[str, Any]
+    prompts: List[PromptSource]
+    input_schema: Optional[str]
+    output_schema: Optional[str]
+    hash: str
+    build_fingerprint: str
+
+@dataclass(slots=True)
+class WorkflowSource:
+    """A workflow directory, with its steps in order."""
+    name: str
+    path: Path
+    config: Dict[str, Any]
+    steps: List[StepSource]
+    hash: str
+
+@dataclass(slots=True)
+class Workspace:
+    """Everything the sync needs to know about the workflows/ tree."""
+    path: Path
+    workflows: List[WorkflowSource]
+
+def scan_step(step_dir: Path) -> StepSource:
+    """Read a step directory, reading every file once."""
+    digests, kept = file_digests(step_dir, skip=("prompts",), keep=("config.yml", "input.json", "output.json"))
+    config = parse_config(kept.get("config.yml"), step_dir)
+    
     prompts = []
     prompts_dir = step_dir / "prompts"
+    if prompts_dir.is_dir():
+        for prompt_file in sorted(prompts_dir.iterdir()):
+            if not prompt_file.is_file():
+                continue
+            content = prompt_file.read_bytes()
+            prompts.append(PromptSource(
+                name=prompt_file.stem,
+                path=prompt_file,
+                content=content.decode(),
+                hash=hashlib.sha256(content).hexdigest()
+            ))
     
-    if not prompts_dir.exists():
-        return prompts
+    input_schema = kept.get("input.json")
+    output_schema = kept.get("output.json")
+    return StepSource(
+        name=format_step_name(step_dir.name),
+        path=step_dir,
+        config=config,
+        prompts=prompts,
+        input_schema=input_schema.decode() if input_schema is not None else None,
+        output_schema=output_schema.decode() if output_schema is not None else None,
+        hash=combine_digests(digests),
+        build_fingerprint=step_build_fingerprint(step_dir, config.get("base_image"), digests)
+    )
+
+def scan_workflow(workflow_dir: Path) -> WorkflowSource:
+    """Read a workflow directory and its steps, reading every file once."""
+    digests, kept = file_digests(workflow_dir, skip=("steps",), keep=("config.yml",))
+    config = parse_config(kept.get("config.yml"), workflow_dir)
     
-    for prompt_file in prompts_dir.glob("*"):
-        prompt_data = None
-        try:
-            # Try to get prompt data from sand CLI
-            result = subprocess.run(
-                [sand_command(), "prompts", "list", "--name", prompt_file.stem, "--json"],
-                capture_output=True,
-                text=True
-            )
-            if result.returncode == 0:
-                prompts_list = json.loads(result.stdout)
-                if prompts_list.get('prompts'):
-                    # Get the latest version
-                    latest_prompt = max(prompts_list.get('prompts'), key=lambda x: x.get("version", 0))
-                    prompt_data = latest_prompt
-        except Exception as e:
-            print(f"Error getting prompt data from sand CLI for {prompt_file.name}: {e}")
+    steps = []
+    steps_dir = workflow_dir / "steps"
+    if steps_dir.is_dir():
+        # Sort step directories to maintain order
+        steps = [scan_step(step_dir) for step_dir in sorted(steps_dir.iterdir()) if step_dir.is_dir()]
+    
+    return WorkflowSource(
+        name=config.get("name", workflow_dir.name),
+        path=workflow_dir,
+        config=config,
+        steps=steps,
+        hash=combine_digests(digests)
+    )
+
+def scan_workspace(workspace_path: Path) -> Workspace:
+    """Walk the workflows/ tree of a workspace once and build its model."""
+    workflows_dir = workspace_path / "workflows"
+    workflows = []
+    if workflows_dir.is_dir():
+        workflows = [scan_workflow(workflow_dir) for workflow_dir in sorted(workflows_dir.iterdir()) if workflow_dir.is_dir()]
+    return Workspace(path=workspace_path, workflows=workflows)
 
-        # Check if this prompt file was changed in the PR or not found in Sandgarden
-        prompt_path = str(prompt_file.relative_to(step_dir.parent.parent.parent.parent))
-        is_updated = prompt_path in changed_files or prompt_data is None
+SELECTOR_TYPES = {"workflow": "workflows", "step": "steps", "prompt": "prompts"}
+
+def parse_selector(value: str) -> Tuple[Optional[str], str]:
+    """Parse an --only selector: 'workflow:NAME', 'step:NAME' or 'prompt:NAME'.
+    
+    NAME can be a glob. Without a type, the selector matches any resource
+    with that name.
+    
+    Returns:
+        (resource type or None, pattern)
+        
+    Raises:
+        ValueError: If the type is unknown or the name is empty
+    """
+    kind, _, pattern = value.rpartition(":")
+    kind = kind.strip().rstrip("s")
+    if kind and kind not in SELECTOR_TYPES:
+        raise ValueError(f"Invalid selector {value}, expected workflow:NAME, step:NAME or prompt:NAME")
+    if not pattern.strip():
+        raise ValueError(f"Invalid selector {value}, the name is empty")
+    return SELECTOR_TYPES.get(kind), pattern.strip()
+
+def select_workflows(workspace_path: Path, selectors: List[Tuple[Optional[str], str]]) -> Tuple[List[Path], Dict[str, List[str]]]:
+    """Find the smallest part of the workspace a sync of the selected resources needs.
+    
+    A selected prompt pulls in the steps that bind it, and a selected step
+    the workflows that use a step with its name, which are pushed again to
+    reference it. Every step and prompt of those workflows is needed to
+    build their stages. Only directory names and the workflow config.yml
+    files are read to find them, nothing is hashed.
+    
+    Returns:
+        The directories of the workflows to sync, and the names of the
+        prompts, steps and workflows in them by resource type
+        
+    Raises:
+        ValueError: If no resource matches the selectors
+    """
+    def selected(resource_type: str, name: str) -> bool:
+        return any(kind in (None, resource_type) and fnmatch.fnmatchcase(name, pattern) for kind, pattern in selectors)
+    
+    outline = []
+    workflows_dir = workspace_path / "workflows"
+    for workflow_dir in sorted(workflows_dir.iterdir()) if workflows_dir.is_dir() else []:
+        if not workflow_dir.is_dir():
+            continue
+        config_file = workflow_dir / "config.yml"
+        config = parse_config(config_file.read_bytes() if config_file.is_file() else None, workflow_dir)
+        steps = {}
+        steps_dir = workflow_dir / "steps"
+        for step_dir in sorted(steps_dir.iterdir()) if steps_dir.is_dir() else []:
+            if step_dir.is_dir():
+                prompts_dir = step_dir / "prompts"
+                steps[format_step_name(step_dir.name)] = [p.stem for p in sorted(prompts_dir.iterdir()) if p.is_file()] if prompts_dir.is_dir() else []
+        outline.append((workflow_dir, config.get("name", workflow_dir.name), steps))
+    
+    selected_steps = {
+        step for _, _, steps in outline for step, prompts in steps.items()
+        if selected("steps", step) or any(selected("prompts", prompt) for prompt in prompts)
+    }
+    closure = [(d, name, steps) for d, name, steps in outline if selected("workflows", name) or selected_steps & steps.keys()]
+    if not closure:
+        raise ValueError("No workflow, step or prompt matches " + ", ".join(f"{kind or 'any'}:{pattern}" for kind, pattern in selectors))
+    
+    names = {
+        "workflows": [name for _, name, _ in closure],
+        "steps": sorted({step for _, _, steps in closure for step in steps}),
+        "prompts": sorted({prompt for _, _, steps in closure for prompts in steps.values() for prompt in prompts})
+    }
+    return [d for d, _, _ in closure], names
+
+class SyncManifest:
+    """Content hashes of resources as they were last pushed to Sandgarden.
+    
+    Entries are keyed by resource type and name, and record the content hash
+    together with the version the push created. A resource is current when
+    its hash is unchanged and that version is still the latest remotely.
+    """
+    
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        self._entries: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        if path and path.exists():
+            try:
+                with open(path) as f:
+                    self._entries = json.load(f).get("resources", {})
+            except Exception as e:
+                print(f"Error reading sync manifest {path}: {e}")
+    
+    def is_current(self, resource_type: str, name: str, content_hash: str, remote_version: Optional[int]) -> Optional[bool]:
+        """Check a resource against the manifest.
+        
+        Returns:
+            Optional[bool]: None if the manifest has no entry for the resource
+        """
+        entry = self._entries.get(resource_type, {}).get(name)
+        if entry is None:
+            return None
+        return entry.get("hash") == content_hash and entry.get("version") == remote_version
+    
+    def record(self, resource_type: str, name: str, content_hash: str, version: Optional[int]) -> None:
+        """Record the hash and version of a resource that is in sync."""
+        with self._lock:
+            self._entries.setdefault(resource_type, {})[name] = {"hash": content_hash, "version": version}
+    
+    def image(self, fingerprint: str) -> Optional[str]:
+        """Return the image built from a step build context, if there is one."""
+        return self._entries.get("images", {}).get(fingerprint, {}).get("image")
+    
+    def record_image(self, fingerprint: str, image: str) -> None:
+        """Record the image built from a step build context."""
+        with self._lock:
+            self._entries.setdefault("images", {})[fingerprint] = {"image": image}
+    
+    def save(self) -> None:
+        """Write the manifest back to its path."""
+        if not self.path:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            with open(self.path, "w") as f:
+                json.dump({"resources": self._entries}, f, indent=2, sort_keys=True)
+
+class ResourceRegistry:
+    """Prompts and steps resolved so far in a sync, keyed by name and content.
+    
+    A prompt or step that several workflows share is resolved once and the
+    same dict is handed to each of them. It is then pushed once, and every
+    workflow references the version that push creates.
+    """
+    
+    def __init__(self):
+        self._resources: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        self._hashes: Dict[Tuple[str, str], set] = defaultdict(set)
+    
+    @staticmethod
+    def step_key(step_hash: str, prompt_hashes: Iterable[str]) -> str:
+        """Identify a step by its code and the prompts it is pushed with."""
+        return ":".join([step_hash, *prompt_hashes])
+    
+    def get(self, resource_type: str, name: str, content_hash: str) -> Optional[Dict[str, Any]]:
+        """Return the resource already resolved for this name and content, if any."""
+        return self._resources.get((resource_type, name, content_hash))
+    
+    def add(self, resource_type: str, resource: Dict[str, Any], content_hash: str) -> Dict[str, Any]:
+        """Register a resolved resource and return it."""
+        hashes = self._hashes[(resource_type, resource["name"])]
+        if hashes and content_hash not in hashes:
+            print(f"Warning: {resource_type} {resource['name']} has different content in different workflows, each version is pushed")
+        hashes.add(content_hash)
+        self._resources[(resource_type, resource["name"], content_hash)] = resource
+        return resource
+
+def is_out_of_sync(manifest: SyncManifest, resource_type: str, name: str, content_hash: str, remote_data: Optional[Dict[str, Any]], changed: bool) -> Optional[bool]:
+    """Decide whether a resource needs to be pushed.
+    
+    The manifest is the source of truth. A resource it doesn't know about yet
+    is compared with Sandgarden when the listing has its content (prompts).
+    Otherwise the changed files (of the PR, or since --since) are used as a
+    hint: a changed resource is pushed, and an unchanged one is left as it
+    is, without anything saying it is in sync.
+    
+    Returns:
+        Optional[bool]: True if it must be pushed, False if it is known to be
+        in sync, None if it is only left alone because it didn't change
+    """
+    if remote_data is None:
+        return True
+    current = manifest.is_current(resource_type, name, content_hash, remote_data.get("version"))
+    if current is None:
+        remote_content = remote_data.get("content")
+        if remote_content is not None:
+            return hashlib.sha256(remote_content.encode()).hexdigest() != content_hash
+        return True if changed else None
+    return not current
+
+def find_prompts(step_dir: Path, changed_files: Union[List[str], ChangedFileIndex], remote: Optional[RemoteState] = None, manifest: Optional[SyncManifest] = None, step: Optional[StepSource] = None, registry: Optional[ResourceRegistry] = None) -> List[Dict[str, Any]]:
+    """Find all prompts for a step.
+    
+    Prompts already in the registry are reused as they are.
+    """
+    prompts = []
+    
+    if step is None:
+        if not (step_dir / "prompts").exists():
+            return prompts
+        step = scan_step(step_dir)
+    
+    if remote is None:
+        remote = RemoteState()
+    if manifest is None:
+        manifest = SyncManifest()
+    if registry is None:
+        registry = ResourceRegistry()
+    changed_files = changed_file_index(changed_files)
+    
+    for prompt in step.prompts:
+        resolved = registry.get("prompts", prompt.name, prompt.hash)
+        if resolved is not None:
+            prompts.append(resolved)
+            continue
+        prompt_data = remote.latest("prompts", prompt.name)
+
+        # Check if this prompt file differs from what was last pushed or is not found in Sandgarden
+        prompt_path = str(prompt.path.relative_to(step_dir.parent.parent.parent.parent))
+        status = is_out_of_sync(manifest, "prompts", prompt.name, prompt.hash, prompt_data, prompt_path in changed_files)
+        is_updated = bool(status)
         updated_content = None
         version = 0
         
         if is_updated:
-            updated_content = prompt_file.read_text()
+            updated_content = prompt.content
         else:
             updated_content = prompt_data.get("content")
             version = prompt_data.get("version", 0)
-        prompts.append({
-            "name": prompt_file.stem,
-            "path": str(prompt_file.relative_to(step_dir)),
+        prompts.append(registry.add("prompts", {
+            "name": prompt.name,
+            "path": str(prompt.path.relative_to(step_dir)),
             "content": updated_content,
             "updated": is_updated or prompt_data is None,
-            "version": version
-        })
+            "verified": status is not None,
+            "version": version,
+            "hash": prompt.hash,
+            "remote_version": prompt_data.get("version") if prompt_data else None
+        }, prompt.hash))
     
     return prompts
 
@@ -154,46 +1880,44 @@ def format_step_name(step_dir_name: str) -> str:
     # Remove any leading digits and underscores
     return re.sub(r'^\d+_', '', step_dir_name)
 
-def find_steps(workflow_dir: Path, changed_files: List[str]) -> List[Dict[str, Any]]:
-    """Find all steps for a workflow."""
+def find_steps(workflow_dir: Path, changed_files: Union[List[str], ChangedFileIndex], remote: Optional[RemoteState] = None, manifest: Optional[SyncManifest] = None, workflow: Optional[WorkflowSource] = None, registry: Optional[ResourceRegistry] = None) -> List[Dict[str, Any]]:
+    """Find all steps for a workflow.
+    
+    Steps already in the registry, with the same code and prompts, are
+    reused as they are.
+    """
     steps = []
-    steps_dir = workflow_dir / "steps"
     
-    if not steps_dir.exists():
-        return steps
+    if workflow is None:
+        if not (workflow_dir / "steps").exists():
+            return steps
+        workflow = scan_workflow(workflow_dir)
+    
+    if remote is None:
+        remote = RemoteState()
+    if manifest is None:
+        manifest = SyncManifest()
+    if registry is None:
+        registry = ResourceRegistry()
+    changed_files = changed_file_index(changed_files)
     
-    for step_dir in steps_dir.iterdir():
-        if not step_dir.is_dir():
+    for step in workflow.steps:
+        step_key = ResourceRegistry.step_key(step.hash, (prompt.hash for prompt in step.prompts))
+        resolved = registry.get("steps", step.name, step_key)
+        if resolved is not None:
+            steps.append(resolved)
             continue
-            
-        step_data = None
-        try:
-            # Try to get step data from sand CLI
-            result = subprocess.run(
-                [sand_command(), "steps", "list", "--name", format_step_name(step_dir.name), "--json"],
-                capture_output=True,
-                text=True
-            )
-            if result.returncode == 0:
-                steps_list = json.loads(result.stdout)
-                if steps_list.get('steps'):
-                    # Get the latest version
-                    latest_step = max(steps_list.get('steps'), key=lambda x: x.get("version", 0))
-                    step_data = latest_step
-        except Exception as e:
-            print(f"Error getting step data from sand CLI for {format_step_name(step_dir.name)}: {e}")
+        step_data = remote.latest("steps", step.name)
         
-        # Check if any files in the step directory (except prompts) have changed
-        step_path = str(step_dir.relative_to(workflow_dir.parent))
-        is_updated = False
-        for changed_file in changed_files:
-            if changed_file.startswith(f"workflows/{step_path}") and not changed_file.startswith(f"workflows/{step_path}/prompts/"):
-                is_updated = True
-                break
+        # Check if the step (except its prompts) differs from what was last pushed
+        step_path = str(step.path.relative_to(workflow_dir.parent))
+        changed = changed_files.has_changes_under(f"workflows/{step_path}", exclude="prompts")
+        status = is_out_of_sync(manifest, "steps", step.name, step.hash, step_data, changed)
+        is_updated = bool(status)
         
         # Find prompts for this step
         # TODO: how to handle prompts that are not in a step?
-        prompts = find_prompts(step_dir, changed_files)
+        prompts = find_prompts(step.path, changed_files, remote, manifest, step, registry)
         
         for prompt in prompts:
             if prompt.get("updated"):
@@ -201,20 +1925,8 @@ def find_steps(workflow_dir: Path, changed_files: List[str]) -> List[Dict[str, A
                 break
         
         # Read config from config.yml if it exists
-        connectors = []
-        description = None
-        config_file = step_dir / "config.yml"
-        if config_file.exists():
-            try:
-                with open(config_file) as f:
-                    config = yaml.safe_load(f)
-                    if config:
-                        if "connectors" in config:
-                            connectors = config["connectors"]
-                        if "description" in config:
-                            description = config["description"]
-            except Exception as e:
-                print(f"Error reading config.yml in {step_dir}: {e}")
+        connectors = step.config.get("connectors", [])
+        description = step.config.get("description")
         
         # If no description in config.yml, try to get it from step_data
         if description is None and step_data and "description" in step_data:
@@ -222,22 +1934,30 @@ def find_steps(workflow_dir: Path, changed_files: List[str]) -> List[Dict[str, A
             
         # If still no description, use placeholder
         if description is None:
-            description = f"Step {format_step_name(step_dir.name)} in workflow {workflow_dir.name}"
+            description = f"Step {step.name} in workflow {workflow_dir.name}"
         
-        steps.append({
-            "name": format_step_name(step_dir.name),
-            "path": str(step_dir),
+        steps.append(registry.add("steps", {
+            "name": step.name,
+            "path": str(step.path),
             "config": step_data,
             "prompts": prompts,
             "connectors": connectors,
             "description": description,
-            "updated": is_updated or step_data is None
-        })
+            "updated": is_updated or step_data is None,
+            "verified": status is not None,
+            "hash": step.hash,
+            "build_fingerprint": step.build_fingerprint,
+            "remote_version": step_data.get("version") if step_data else None
+        }, step_key))
     
     return steps
 
-def find_workflows(workspace_path: Path, changed_files: List[str]) -> List[Dict[str, Any]]:
-    """Find all Sandgarden workflows in the workspace."""
+def find_workflows(workspace_path: Path, changed_files: Union[List[str], ChangedFileIndex], remote: Optional[RemoteState] = None, manifest: Optional[SyncManifest] = None, workspace: Optional[Workspace] = None) -> List[Dict[str, Any]]:
+    """Find all Sandgarden workflows in the workspace.
+    
+    Steps and prompts shared by several workflows are resolved once, and
+    every workflow gets the same dict for them.
+    """
     workflows = []
     workflows_dir = workspace_path / "workflows"
     
@@ -245,177 +1965,115 @@ def find_workflows(workspace_path: Path, changed_files: List[str]) -> List[Dict[
         print(f"No workflows directory found at {workflows_dir}")
         return workflows
     
-    for workflow_dir in workflows_dir.iterdir():
-        if not workflow_dir.is_dir():
-            continue
-        
-        config = {}
-        config_file = workflow_dir / "config.yml"
-        if config_file.exists():
-            try:
-                with open(config_file) as f:
-                    config = yaml.safe_load(f)
-            except Exception as e:
-                print(f"Error reading config.yml in {workflow_dir}: {e}")
-                
-        workflow_name = config.get("name", workflow_dir.name)    
-        workflow_data = None
-        try:
-            # Try to get workflow data from sand CLI
-            result = subprocess.run(
-                [sand_command(), "workflows", "list", "--name", workflow_name, "--json"],
-                capture_output=True,
-                text=True
-            )
-            if result.returncode == 0:
-                workflows_list = json.loads(result.stdout)
-                if workflows_list.get('workflows'):
-                    # Get the latest version
-                    latest_workflow = max(workflows_list.get('workflows'), key=lambda x: x.get("version", 0))
-                    workflow_data = latest_workflow
-        except Exception as e:
-            print(f"Error getting workflow data from sand CLI for {workflow_dir.name}: {e}")
-        
-        
+    if workspace is None:
+        workspace = scan_workspace(workspace_path)
+    if remote is None:
+        remote = RemoteState()
+    if manifest is None:
+        manifest = SyncManifest()
+    # Indexed once and shared by every workflow, step and prompt
+    changed_files = changed_file_index(changed_files)
+    registry = ResourceRegistry()
+    
+    for workflow in workspace.workflows:
+        workflow_data = remote.latest("workflows", workflow.name)
         
-        steps_dir = workflow_dir / "steps"
+        # First stage gets workflow input and the last one the workflow output
         input_schema = {}
         output_schema = {}
-        if steps_dir.exists():
-            # Sort step directories to maintain order
-            step_dirs = sorted([d for d in steps_dir.iterdir() if d.is_dir()])
-            
-            for i, step_dir in enumerate(step_dirs):
-                # First stage gets workflow input and we check for input schema
-                if i == 0:                    
-                    # Check for input schema in first step
-                    input_schema_path = step_dir / "input.json"
-                    if input_schema_path.exists():
-                        try:
-                            with open(input_schema_path) as f:
-                                input_schema = f.read()
-                        except Exception as e:
-                            print(f"Error reading input schema from {input_schema_path}: {e}")
-                # If this is the last step, check for output schema
-                if i == len(step_dirs) - 1:
-                    output_schema_path = step_dir / "output.json"
-                    if output_schema_path.exists():
-                        try:
-                            with open(output_schema_path) as f:
-                                output_schema = f.read()
-                        except Exception as e:
-                            print(f"Error reading output schema from {output_schema_path}: {e}")
+        if workflow.steps:
+            if workflow.steps[0].input_schema is not None:
+                input_schema = workflow.steps[0].input_schema
+            if workflow.steps[-1].output_schema is not None:
+                output_schema = workflow.steps[-1].output_schema
                             
-        # Check if workflow.json has changed (still track changes for sync purposes)
-        workflow_path = str(workflow_dir.relative_to(workflows_dir))
-        is_updated = False
-        for changed_file in changed_files:
-            # Check if changed file starts with workflow path
-            if changed_file.startswith(f"workflows/{workflow_path}") and not changed_file.startswith(f"workflows/{workflow_path}/steps/"):
-                is_updated = True
-                break
+        # Check if the workflow (except its steps) differs from what was last pushed
+        workflow_path = str(workflow.path.relative_to(workflows_dir))
+        changed = changed_files.has_changes_under(f"workflows/{workflow_path}", exclude="steps")
+        status = is_out_of_sync(manifest, "workflows", workflow.name, workflow.hash, workflow_data, changed)
+        is_updated = bool(status)
         
         # Find steps for this workflow
         # TODO: what if it is a step that is not in a workflow?
         # rename steps to functions and add a functions directory at the root for functions not in a workflow
         # keep the workflow directory named steps
         # Figure out how to handle functions shared between workflows
-        steps = find_steps(workflow_dir, changed_files)
+        steps = find_steps(workflow.path, changed_files, remote, manifest, workflow, registry)
         for step in steps:
             if step.get("updated", False):
                 is_updated = True
                 break
 
         workflows.append({
-            "name": config.get("name", workflow_dir.name),
-            "description": config.get("description", ""),
+            "name": workflow.name,
+            "description": workflow.config.get("description", ""),
             "path": str(workflow_path),
+            "config": workflow.config,
             "steps": steps,
             "inputSchema": input_schema,
             "outputSchema": output_schema,
-            "updated": is_updated or workflow_data is None
+            "updated": is_updated or workflow_data is None,
+            "verified": status is not None,
+            "hash": workflow.hash,
+            "remote_version": workflow_data.get("version") if workflow_data else None
         })
     
     return workflows
 
-def update_resource(resource_type: str, name: str, data: Dict[str, Any], tag: str, dry_run: bool = False) -> Dict[str, Any]:
-    """Update a resource in Sandgarden using the sand utility.
+def update_resource(resource_type: str, name: str, data: Dict[str, Any], tag: str, dry_run: bool = False, backend: Optional[SandBackend] = None) -> Dict[str, Any]:
+    """Update a resource in Sandgarden.
     
     Args:
         resource_type: Type of resource (prompts, steps, workflows)
         name: Resource name
         data: Resource data
         tag: tag to apply
-        dry_run: If True, only print commands without executing them
+        dry_run: If True, only print what would be pushed
+        backend: Backend to push with, the sand CLI by default
         
     Returns:
-        Dict[str, Any]: The response from the sand command
+        Dict[str, Any]: The response from Sandgarden
         
     Raises:
-        ValueError: If the command fails or returns invalid JSON
-    """
-    if resource_type == "prompts":
-        cmd = [
-            sand_command(), "prompts", "create",
-            "--content", data["content"],
-            "--name", name,
-            "--json"
-        ]
-    elif resource_type == "steps":
-        cmd = [
-            sand_command(), "steps", "push", "docker",
-            "--name", name,
-            "--description", "Updated via GitHub sync",
-            "--file", os.path.relpath(data["path"]),
-            "--sync",
-            "--tag", tag,
-            "--json"
-        ]
-        # Add any prompts associated with this step
-        for prompt in data.get("prompts", []):
-            cmd.extend(["--prompt", f"{prompt['name']}:{prompt['version']}"])
-        # Add any connectors associated with this step
-        for connector in data.get("connectors", []):
-            cmd.extend(["--connector", connector])
-    elif resource_type == "workflows":  # workflows
-        cmd = [
-            sand_command(), "workflows", "push",
-            "--name", name,
-            "--description", "Updated via GitHub sync",
-            "--stages", json.dumps(data["stages"]),
-            "--tag", tag,
-            "--json"
-        ]
-    else:
+        ValueError: If the push fails or returns invalid JSON
+    """
+    if resource_type not in RESOURCE_TYPES:
         raise ValueError(f"Invalid resource type: {resource_type}")
+    if backend is None:
+        backend = CliBackend()
     
     if dry_run:
-        print(f"\nWould run command:\n{' '.join(cmd)}")
+        print(f"\nWould run:\n{backend.describe(resource_type, name, data, tag)}")
         return {"version": 1, "dry_run": True}
     
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f"Error updating {resource_type} {name}: {result.stdout}\n{result.stderr}")
-        raise ValueError(f"Failed to update {resource_type} {name}")
-        
-    try:
-        return json.loads(result.stdout)
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Invalid JSON response from sand command: {e}")
+    return backend.push(resource_type, name, data, tag)
 
-def build_workflow_config(workflow: Dict[str, Any], workspace_path: str) -> Dict[str, Any]:
-    """Build workflow configuration from workflow data.
+async def update_resource_async(resource_type: str, name: str, data: Dict[str, Any], tag: str, dry_run: bool = False, backend: Optional[SandBackend] = None) -> Dict[str, Any]:
+    """Async version of update_resource."""
+    if resource_type not in RESOURCE_TYPES:
+        raise ValueError(f"Invalid resource type: {resource_type}")
+    if backend is None:
+        backend = CliBackend()
+    
+    if dry_run:
+        print(f"\nWould run:\n{backend.describe(resource_type, name, data, tag)}")
+        return {"version": 1, "dry_run": True}
+    
+    return await backend.push_async(resource_type, name, data, tag)
+
+def load_workflow_config(workflow: Dict[str, Any], workspace_path: str) -> Dict[str, Any]:
+    """Load the config.yml of a workflow.
     
     Args:
-        workflow: Dictionary containing workflow data including steps
+        workflow: Dictionary containing workflow data
         
     Returns:
-        Dict containing workflow configuration with stages
+        Dict containing the parsed config, empty if there is none
     """
-    stages = []
-    steps = workflow.get("steps", [])
+    # Already parsed when the workspace was scanned
+    if "config" in workflow:
+        return workflow["config"]
     
-    # Get workflow config
     workflow_dir = Path(workspace_path / "workflows" / workflow["path"])
     config_file = workflow_dir / "config.yml"
     
@@ -423,9 +2081,24 @@ def build_workflow_config(workflow: Dict[str, Any], workspace_path: str) -> Dict
     if config_file.exists():
         try:
             with open(config_file) as f:
-                workflow_config = yaml.safe_load(f)
+                workflow_config = yaml.safe_load(f) or {}
         except Exception as e:
             print(f"Error reading config.yml in {workflow_dir}: {e}")
+    return workflow_config
+
+def build_workflow_config(workflow: Dict[str, Any], workspace_path: str) -> Dict[str, Any]:
+    """Build workflow configuration from workflow data.
+    
+    Args:
+        workflow: Dictionary containing workflow data including steps
+        
+    Returns:
+        Dict containing workflow configuration with stages
+    """
+    stages = []
+    steps = workflow.get("steps", [])
+    
+    workflow_config = load_workflow_config(workflow, workspace_path)
             
     # Get step_version from workflow config if specified
     step_version = workflow_config.get("step_version")
@@ -433,8 +2106,9 @@ def build_workflow_config(workflow: Dict[str, Any], workspace_path: str) -> Dict
     input_schema = None
     output_schema = None
     for i, step in enumerate(steps):
-        # Use workflow step_version if specified, otherwise use step's own version
-        version = step_version or step.get("config", {}).get("version")
+        # Use workflow step_version if specified, otherwise the version just pushed
+        # or the step's existing version
+        version = step_version or step.get("version") or (step.get("config") or {}).get("version")
         if not version:
             raise ValueError(f"Step {step['name']} has no version in its config and no step_version specified in workflow config")
             
@@ -465,8 +2139,231 @@ def build_workflow_config(workflow: Dict[str, Any], workspace_path: str) -> Dict
         "tags": workflow_config.get("tags", [])
     }
 
-def sync_to_sandgarden(branch: str, dry_run: bool = False) -> Dict[str, Any]:
-    """Sync code to Sandgarden using the provided branch and environment."""
+def iter_resources(workflows: List[Dict[str, Any]]):
+    """Yield (resource type, resource) for every workflow, step and prompt."""
+    for workflow in workflows:
+        yield "workflows", workflow
+        for step in workflow.get("steps", []):
+            yield "steps", step
+            for prompt in step.get("prompts", []):
+                yield "prompts", prompt
+
+def build_push_graph(workflows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Build the graph of pushes needed to sync the updated resources.
+    
+    Prompts come before the steps that use them, and steps before the
+    workflows that reference them. A step or prompt shared by several
+    workflows (the same dict, see ResourceRegistry) gets a single node.
+    
+    Args:
+        workflows: Workflows as returned by find_workflows
+        
+    Returns:
+        List of nodes, each with an id, resource type, the resource itself,
+        its workflow and the ids of the nodes it depends on
+    """
+    nodes = []
+    # id() of each shared resource -> its node id
+    node_ids = {}
+    
+    def add_node(node_id: str, resource_type: str, resource: Dict[str, Any], workflow: Dict[str, Any], deps: List[str]) -> str:
+        if id(resource) not in node_ids:
+            node_ids[id(resource)] = node_id
+            nodes.append({"id": node_id, "type": resource_type, "resource": resource, "workflow": workflow, "deps": deps})
+        return node_ids[id(resource)]
+    
+    for workflow in workflows:
+        step_ids = []
+        for step in workflow.get("steps", []):
+            prompt_ids = []
+            for prompt in step.get("prompts", []):
+                if prompt.get("updated"):
+                    prompt_ids.append(add_node(f"prompts:{workflow['path']}/{step['name']}/{prompt['name']}", "prompts", prompt, workflow, []))
+            if step.get("updated"):
+                step_ids.append(add_node(f"steps:{workflow['path']}/{step['name']}", "steps", step, workflow, prompt_ids))
+        if workflow.get("updated"):
+            add_node(f"workflows:{workflow['path']}", "workflows", workflow, workflow, step_ids)
+    return nodes
+
+async def run_push_graph_async(nodes: List[Dict[str, Any]], push, jobs: int = DEFAULT_JOBS) -> Dict[str, str]:
+    """Run the pushes in a push graph as asyncio tasks.
+    
+    A node starts as soon as everything it depends on has been synced, so
+    independent nodes run at the same time, at most `jobs` of them. When a
+    node fails, only the nodes that depend on it are skipped.
+    
+    Args:
+        nodes: Nodes as returned by build_push_graph
+        push: Coroutine function that pushes a single node, raising on failure
+        jobs: Maximum number of pushes to run at the same time
+        
+    Returns:
+        Dict mapping node ids to "synced", "failed" or "skipped"
+    """
+    statuses = {}
+    pending = {node["id"]: node for node in nodes}
+    waiting_on = {node["id"]: set(node["deps"]) for node in nodes}
+    dependents = defaultdict(list)
+    for node in nodes:
+        for dep in node["deps"]:
+            dependents[dep].append(node["id"])
+    
+    def skip_dependents(node_id: str) -> None:
+        for dependent in dependents[node_id]:
+            if dependent in pending:
+                del pending[dependent]
+                statuses[dependent] = "skipped"
+                print(f"Skipping {dependent} because {node_id} was not synced")
+                skip_dependents(dependent)
+    
+    limit = asyncio.Semaphore(max(1, jobs))
+    running = {}
+    
+    async def run(node: Dict[str, Any]) -> None:
+        async with limit:
+            await push(node)
+    
+    def start_ready() -> None:
+        for node_id in [node_id for node_id in pending if not waiting_on[node_id]]:
+            running[asyncio.ensure_future(run(pending.pop(node_id)))] = node_id
+    
+    start_ready()
+    while running:
+        done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            node_id = running.pop(task)
+            try:
+                task.result()
+                statuses[node_id] = "synced"
+                for dependent in dependents[node_id]:
+                    waiting_on[dependent].discard(node_id)
+            except Exception as e:
+                print(f"Error updating {node_id}: {e}")
+                statuses[node_id] = "failed"
+                skip_dependents(node_id)
+        start_ready()
+    
+    # Anything still pending depends on a node that is not in the graph
+    for node_id in pending:
+        statuses[node_id] = "skipped"
+    
+    return statuses
+
+def run_push_graph(nodes: List[Dict[str, Any]], push, jobs: int = DEFAULT_JOBS) -> Dict[str, str]:
+    """Run a push graph with a blocking push callable on a pool of `jobs` threads.
+    
+    See run_push_graph_async for how the nodes are scheduled.
+    """
+    async def run() -> Dict[str, str]:
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            async def push_on_pool(node: Dict[str, Any]) -> None:
+                await loop.run_in_executor(pool, push, node)
+            return await run_push_graph_async(nodes, push_on_pool, jobs)
+    return asyncio.run(run())
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse a shard given as 'i/N', where i counts from 1.
+    
+    Raises:
+        ValueError: If the value is not a valid shard
+    """
+    match = re.fullmatch(r"(\d+)/(\d+)", value.strip())
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError(f"Invalid shard {value}, expected i/N with 1 <= i <= N")
+    return int(match.group(1)), int(match.group(2))
+
+def stable_hash(key: str) -> int:
+    """Hash a string the same way in every process, unlike hash()."""
+    return int(hashlib.sha256(key.encode()).hexdigest()[:16], 16)
+
+def workflow_components(workflows: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """Group workflows that share a step or a prompt.
+    
+    A shared resource must be pushed by a single shard, so every workflow
+    that uses it has to be in that shard too.
+    
+    Returns:
+        The groups, each sorted by workflow name, sorted by their first name
+    """
+    parent = {workflow["name"]: workflow["name"] for workflow in workflows}
+    
+    def find(name: str) -> str:
+        while parent[name] != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+        return name
+    
+    # First workflow seen using each step and prompt
+    owners = {}
+    for workflow in workflows:
+        for step in workflow.get("steps", []):
+            shared = [("steps", step["name"])] + [("prompts", prompt["name"]) for prompt in step.get("prompts", [])]
+            for key in shared:
+                owner = owners.setdefault(key, workflow["name"])
+                parent[find(workflow["name"])] = find(owner)
+    
+    components = defaultdict(list)
+    for workflow in workflows:
+        components[find(workflow["name"])].append(workflow)
+    return sorted((sorted(component, key=lambda w: w["name"]) for component in components.values()), key=lambda c: c[0]["name"])
+
+def assign_shards(workflows: List[Dict[str, Any]], shards: int, timings: Optional[Dict[str, float]] = None) -> Dict[str, int]:
+    """Assign every workflow to one of `shards` shards.
+    
+    Workflows sharing a step or prompt go to the same shard. Groups are
+    placed largest first on the least loaded shard, weighed by the seconds
+    their workflows took to push in previous runs, or by their number of
+    steps and prompts when there are no timings for them. Ties are broken
+    by a stable hash of the workflow names, so every runner computes the
+    same assignment from the same workspace and timings. A group heavier
+    than an even share of the sync is printed as a warning, since its
+    shard can't finish with the others.
+    
+    Args:
+        workflows: Workflows as returned by find_workflows
+        shards: Number of shards
+        timings: Seconds each workflow took to push, by workflow name
+        
+    Returns:
+        Dict mapping workflow names to shards, counting from 1
+    """
+    timings = timings or {}
+    resource_counts = {
+        workflow["name"]: sum(1 + len(step.get("prompts", [])) for step in workflow.get("steps", []))
+        for workflow in workflows
+    }
+    # Estimate workflows with no timings at the average time per resource
+    timed = [name for name in timings if name in resource_counts]
+    seconds_per_resource = 1.0
+    if timed and sum(resource_counts[name] for name in timed):
+        seconds_per_resource = sum(timings[name] for name in timed) / sum(resource_counts[name] for name in timed)
+    
+    def weight(component: List[Dict[str, Any]]) -> float:
+        return sum(timings.get(w["name"], resource_counts[w["name"]] * seconds_per_resource) for w in component)
+    
+    components = workflow_components(workflows)
+    keys = {id(component): ",".join(w["name"] for w in component) for component in components}
+    components.sort(key=lambda c: (-weight(c), stable_hash(keys[id(c)])))
+    total = sum(weight(component) for component in components)
+    if shards > 1 and components and len(components[0]) > 1 and weight(components[0]) > total / shards:
+        print(f"Warning: workflows {', '.join(w['name'] for w in components[0])} share steps or prompts and take {weight(components[0]) / total:.0%} of the sync, so their shard will take longer than the others")
+    
+    loads = [0.0] * shards
+    assignment = {}
+    for component in components:
+        shard = min(range(shards), key=lambda i: (loads[i], i))
+        loads[shard] += weight(component)
+        for workflow in component:
+            assignment[workflow["name"]] = shard + 1
+    return assignment
+
+def sync_workspace() -> Path:
+    """Check the environment a sync needs and return the workspace path.
+    
+    Raises:
+        ValueError: If SAND_API_KEY or GITHUB_WORKSPACE is not set
+    """
     api_key = os.environ.get("SAND_API_KEY")
     
     if not api_key:
@@ -477,17 +2374,16 @@ def sync_to_sandgarden(branch: str, dry_run: bool = False) -> Dict[str, Any]:
     if not github_workspace:
         raise ValueError("GITHUB_WORKSPACE environment variable must be set")
     
-    workspace_path = Path(github_workspace)
-    
-    # Get list of changed files from PR
-    changed_files = get_changed_files()
+    return Path(github_workspace)
 
-    # Find all workflows
-    workflows = find_workflows(workspace_path, changed_files)
-    if not workflows:
-        raise ValueError("No valid Sandgarden workflows found")
+def open_manifest(workspace_path: Path, manifest_path: Optional[str] = None) -> SyncManifest:
+    """Open the sync manifest at manifest_path, SAND_SYNC_MANIFEST or its default path."""
+    # Content hashes of what was last pushed, the PR file list is only a hint
+    manifest_path = manifest_path or os.environ.get("SAND_SYNC_MANIFEST")
+    return SyncManifest(Path(manifest_path) if manifest_path else workspace_path / DEFAULT_MANIFEST_PATH)
 
-    # Print sync status
+def print_sync_status(workflows: List[Dict[str, Any]]) -> None:
+    """Print the workflows, steps and prompts that will be pushed."""
     for workflow in workflows:
         if workflow.get("updated"):
             print(f"Workflow: {workflow['name']} ⚡")        
@@ -497,53 +2393,326 @@ def sync_to_sandgarden(branch: str, dry_run: bool = False) -> Dict[str, Any]:
             for prompt in step.get("prompts", []):
                 if prompt.get("updated"):
                     print(f"    Prompt: {prompt['name']} ⚡")
+
+async def discover_async(workspace_path: Path, manifest: SyncManifest, remote: RemoteState, since: Optional[str] = None, only: Optional[List[Tuple[Optional[str], str]]] = None) -> List[Dict[str, Any]]:
+    """Find the workflows in the workspace and what needs to be pushed.
+    
+    Change detection, the walk of the workspace and the listing of every
+    resource type in Sandgarden don't depend on each other and run at the
+    same time. With --only selectors, only the workflows select_workflows
+    finds are scanned, and only their resources are looked up.
+    
+    Raises:
+        ValueError: If there are no workflows in the workspace, or none
+            matching the selectors
+    """
+    workflow_dirs = None
+    names = None
+    if only:
+        with profiler.phase("select", "discovery") as record:
+            workflow_dirs, names = select_workflows(workspace_path, only)
+            record["result"] = f"{len(workflow_dirs)} workflows"
+
+    # Get list of changed files from the local git history or from the PR
+    async def detect_changes() -> List[str]:
+        with profiler.phase("changed files", "changed files") as record:
+            if since:
+                changed_files = await asyncio.to_thread(get_changed_files_since, since, workspace_path)
+            else:
+                changed_files = await asyncio.to_thread(get_changed_files)
+            record["result"] = f"{len(changed_files)} files"
+        return changed_files
+    
+    async def scan() -> Workspace:
+        with profiler.phase("scan workspace", "discovery") as record:
+            if workflow_dirs is None:
+                workspace = await asyncio.to_thread(scan_workspace, workspace_path)
+            else:
+                workspace = Workspace(path=workspace_path, workflows=await asyncio.to_thread(lambda: [scan_workflow(d) for d in workflow_dirs]))
+            record["result"] = f"{len(workspace.workflows)} workflows"
+        return workspace
+    
+    changed_files, workspace, _ = await asyncio.gather(detect_changes(), scan(), remote.load_async(names=names))
+    remote.save()
+
+    # Find all workflows
+    with profiler.phase("discovery", "discovery") as record:
+        workflows = find_workflows(workspace_path, changed_files, remote, manifest, workspace)
+        record["result"] = f"{len(workflows)} workflows"
+    if not workflows:
+        raise ValueError("No valid Sandgarden workflows found")
+    return workflows
+
+async def push_workflows_async(branch: str, workspace_path: Path, workflows: List[Dict[str, Any]], manifest: SyncManifest, backend: SandBackend, dry_run: bool = False, jobs: int = DEFAULT_JOBS, remote: Optional[RemoteState] = None) -> Dict[str, Any]:
+    """Push the updated resources of discovered workflows and record them in the manifest.
+    
+    Pushes run as soon as what they depend on is synced. When the remote
+    state is given, it is kept up to date with the versions pushed.
+    
+    Returns:
+        Dict mapping each resource type to the names that were synced
+    """
+    print_sync_status(workflows)
+            
+    # Resources that are not being pushed already match Sandgarden, unless only
+    # the changed files said so
+    for resource_type, resource in iter_resources(workflows):
+        if not resource.get("updated") and resource.get("verified", True):
+            manifest.record(resource_type, resource["name"], resource["hash"], resource["remote_version"])
             
+    nodes = build_push_graph(workflows)
+    
+    async def push(node: Dict[str, Any]) -> None:
+        with profiler.phase(node["id"], "push", workflow=node["workflow"]["name"]) as record:
+            await push_node(node, record)
+    
+    async def push_node(node: Dict[str, Any], record: Dict[str, Any]) -> None:
+        resource = node["resource"]
+        if node["type"] == "prompts":
+            record["bytes"] = len(resource["content"].encode())
+            results = await update_resource_async("prompts", resource["name"], resource, branch, dry_run, backend)
+            resource["version"] = results["version"]
+        elif node["type"] == "steps":
+            tag = load_workflow_config(node["workflow"], workspace_path).get("step_version") or branch
+            step_tags = (resource.get("config") or {}).get("tags")
+            if step_tags:
+                tag = step_tags[0]
+            # Reuse the image built from an identical build context, if any
+            image = manifest.image(resource["build_fingerprint"])
+            step_data = dict(resource, image=image) if image else resource
+            results = await update_resource_async("steps", resource["name"], step_data, tag, dry_run, backend)
+            resource["version"] = results["version"]
+            image = results.get("image") or image
+            if image and not dry_run:
+                manifest.record_image(resource["build_fingerprint"], image)
+            elif not dry_run:
+                print(f"Warning: the push of step {resource['name']} didn't report its image, so steps with the same build context will be built again")
+        else:
+            # Built once the steps are pushed so the stages reference their new versions
+            data = build_workflow_config(resource, workspace_path)
+            tag = branch
+            if data["tags"]:
+                tag = data["tags"][0]
+            results = await update_resource_async("workflows", resource["name"], data, tag, dry_run, backend)
+        manifest.record(node["type"], resource["name"], resource["hash"], results.get("version"))
+        if remote is not None and not dry_run:
+            pushed = dict(results, name=resource["name"])
+            if node["type"] == "prompts":
+                pushed["content"] = resource["content"]
+            remote.remember(node["type"], pushed)
+    
+    statuses = await run_push_graph_async(nodes, push, jobs)
+    if not dry_run:
+        manifest.save()
+        if remote is not None:
+            remote.save()
+    
     # Track synced resources
     synced_resources = {
         "workflows": [],
         "steps": [],
         "prompts": []
     }
+    for node in nodes:
+        if statuses[node["id"]] == "synced":
+            synced_resources[node["type"]].append(node["resource"]["name"])
+    
+    return synced_resources
+
+def build_plan(branch: str, workspace_path: Path, workflows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Build a sync plan from discovered workflows.
+    
+    Returns:
+        Dict with the branch, the remote version and content hash of every
+        resource, the push graph in the order it was built, and the
+        workflows themselves
+    """
+    remote_versions = {resource_type: {} for resource_type in RESOURCE_TYPES}
+    hashes = {resource_type: {} for resource_type in RESOURCE_TYPES}
+    for resource_type, resource in iter_resources(workflows):
+        remote_versions[resource_type][resource["name"]] = resource["remote_version"]
+        hashes[resource_type][resource["name"]] = resource["hash"]
+    
+    return {
+        "version": SYNC_PLAN_VERSION,
+        "branch": branch,
+        "workspace": str(workspace_path),
+        "remote_versions": remote_versions,
+        "hashes": hashes,
+        "graph": [
+            {"id": node["id"], "type": node["type"], "name": node["resource"]["name"], "deps": node["deps"]}
+            for node in build_push_graph(workflows)
+        ],
+        "workflows": workflows
+    }
+
+def planned_resources(plan: Dict[str, Any]) -> Dict[str, List[str]]:
+    """Return the names of the resources a plan pushes, by resource type."""
+    resources = {"workflows": [], "steps": [], "prompts": []}
+    for node in plan["graph"]:
+        resources[node["type"]].append(node["name"])
+    return resources
+
+def write_plan(plan: Dict[str, Any], path: str) -> None:
+    """Write a sync plan as JSON."""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(plan, f, indent=2, default=str)
+
+def read_plan(path: str) -> Dict[str, Any]:
+    """Read a sync plan written by write_plan.
+    
+    Raises:
+        ValueError: If the file is not a plan this version of the script can apply
+    """
+    try:
+        with open(path) as f:
+            plan = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError(f"Can't read sync plan {path}: {e}")
+    if not isinstance(plan, dict) or plan.get("version") != SYNC_PLAN_VERSION:
+        raise ValueError(f"{path} is not a version {SYNC_PLAN_VERSION} sync plan")
+    return plan
+
+def find_plan_drift(plan: Dict[str, Any], remote: RemoteState, workspace_path: Path) -> List[str]:
+    """Find what changed since a plan was made.
+    
+    Checks that every resource still has the latest version in Sandgarden
+    that the plan saw, and that the steps to push still have the content
+    they were planned with, since their image is built from the checkout.
+    
+    Returns:
+        List[str]: One line per difference, empty if the plan still holds
+    """
+    drift = []
+    for resource_type, versions in plan["remote_versions"].items():
+        for name, planned in versions.items():
+            current = remote.latest(resource_type, name)
+            current_version = current.get("version") if current else None
+            if current_version != planned:
+                drift.append(f"{resource_type} {name} is at version {current_version} in Sandgarden, the plan expected {planned}")
     
-    # Update resources in Sandgarden
-    for workflow in workflows:               
-        data = build_workflow_config(workflow, workspace_path)
+    for workflow in plan["workflows"]:
+        for step in workflow["steps"]:
+            if step["updated"]:
+                step_dir = Path(step["path"])
+                if not step_dir.is_dir() or hash_tree(step_dir, exclude=("prompts",)) != step["hash"]:
+                    drift.append(f"steps {step['name']} in {step_dir} differs from the plan")
+    return drift
+
+def share_resources(workflows: List[Dict[str, Any]]) -> None:
+    """Make workflows share one dict per step and prompt again, as find_workflows does.
+    
+    Needed for workflows read back from JSON, where every workflow has its
+    own copy of the steps and prompts it shares with others.
+    """
+    registry = ResourceRegistry()
+    for workflow in workflows:
+        steps = []
         for step in workflow.get("steps", []):
-            for prompt in step.get("prompts", []):
-                if prompt.get("updated"):
-                    try:
-                        results = update_resource("prompts", prompt["name"], prompt, branch, dry_run)
-                        synced_resources["prompts"].append(prompt["name"])
-                        prompt["version"] = results["version"]
-                    except Exception as e:
-                        print(f"Error updating prompt {prompt['name']}: {e}")
-                        continue
-            if step.get("updated"):
-                try:
-                    tag = data["step_version"] or branch
-                    step_data = step.get("config", {})
-                    if step_data["tags"] and len(step_data["tags"]) > 0:
-                        tag = step_data["tags"][0]
-                    results = update_resource("steps", step["name"], step, tag, dry_run)
-                    synced_resources["steps"].append(step["name"])
-                    step["version"] = results["version"]
-                except Exception as e:
-                    print(f"Error updating step {step['name']}: {e}")
-                    continue
+            step["prompts"] = [
+                registry.get("prompts", prompt["name"], prompt["hash"]) or registry.add("prompts", prompt, prompt["hash"])
+                for prompt in step.get("prompts", [])
+            ]
+            key = ResourceRegistry.step_key(step["hash"], (prompt["hash"] for prompt in step["prompts"]))
+            steps.append(registry.get("steps", step["name"], key) or registry.add("steps", step, key))
+        workflow["steps"] = steps
+
+def rebase_plan(plan: Dict[str, Any], workspace_path: Path) -> None:
+    """Point the step paths of a plan made in another checkout at workspace_path."""
+    planned_workspace = Path(plan["workspace"])
+    if planned_workspace == workspace_path:
+        return
+    for workflow in plan["workflows"]:
+        for step in workflow["steps"]:
+            step["path"] = str(workspace_path / Path(step["path"]).relative_to(planned_workspace))
+    plan["workspace"] = str(workspace_path)
+
+async def plan_sync_async(branch: str, manifest_path: Optional[str] = None, since: Optional[str] = None, backend: Optional[SandBackend] = None, only: Optional[List[Tuple[Optional[str], str]]] = None, remote_cache: Optional[RemoteStateCache] = None) -> Dict[str, Any]:
+    """Discover what a sync would push, without pushing anything.
+    
+    Returns:
+        Dict[str, Any]: The plan, see build_plan
+    """
+    workspace_path = sync_workspace()
+    profiler.reset()
+    if backend is None:
+        backend = get_backend()
+    
+    workflows = await discover_async(workspace_path, open_manifest(workspace_path, manifest_path), RemoteState(backend, remote_cache), since, only)
+    print_sync_status(workflows)
+    return build_plan(branch, workspace_path, workflows)
+
+async def apply_plan_async(plan: Dict[str, Any], dry_run: bool = False, jobs: int = DEFAULT_JOBS, manifest_path: Optional[str] = None, backend: Optional[SandBackend] = None) -> Dict[str, Any]:
+    """Push a sync plan made by plan_sync_async, tagging with the plan's branch.
+    
+    Nothing is discovered again: only the remote state is listed to check
+    that it is still the one the plan was made against.
+    
+    Returns:
+        Dict mapping each resource type to the names that were synced
         
-        if workflow.get("updated"):
-            try:
-                tag = branch
-                if data["tags"] and len(data["tags"]) > 0:
-                    tag = data["tags"][0]
-                update_resource("workflows", workflow["name"], data, tag, dry_run)
-                synced_resources["workflows"].append(workflow["name"])
-            except Exception as e:
-                print(f"Error updating workflow {workflow['name']}: {e}")
-                continue
-                    
+    Raises:
+        ValueError: If Sandgarden or the steps to push changed since the plan was made
+    """
+    workspace_path = sync_workspace()
+    profiler.reset()
+    if backend is None:
+        backend = get_backend()
     
-    return synced_resources
+    rebase_plan(plan, workspace_path)
+    share_resources(plan["workflows"])
+    remote = RemoteState(backend)
+    await remote.load_async()
+    with profiler.phase("drift check", "plan") as record:
+        drift = find_plan_drift(plan, remote, workspace_path)
+        record["result"] = f"{len(drift)} differences"
+    if drift:
+        raise ValueError("The plan is out of date, plan the sync again:\n" + "\n".join(f"- {line}" for line in drift))
+    
+    manifest = open_manifest(workspace_path, manifest_path)
+    return await push_workflows_async(plan["branch"], workspace_path, plan["workflows"], manifest, backend, dry_run, jobs)
+
+async def sync_to_sandgarden_async(branch: str, dry_run: bool = False, jobs: int = DEFAULT_JOBS, manifest_path: Optional[str] = None, since: Optional[str] = None, backend: Optional[SandBackend] = None, shard: Optional[Tuple[int, int]] = None, timings: Optional[Dict[str, float]] = None, only: Optional[List[Tuple[Optional[str], str]]] = None, remote_cache: Optional[RemoteStateCache] = None) -> Dict[str, Any]:
+    """Sync code to Sandgarden using the provided branch and environment.
+    
+    Discovers what needs to be pushed and pushes it straight away, see
+    discover_async and push_workflows_async. With a shard (i, N), only the
+    workflows assign_shards puts in shard i are pushed, balanced with the
+    previous push timings of each workflow. With selectors (see
+    parse_selector), only the workflows that contain what they select are
+    synced. With a remote cache, Sandgarden is only listed where the cache
+    is stale, and the cache is updated with what was pushed.
+    """
+    workspace_path = sync_workspace()
+    profiler.reset()
+    manifest = open_manifest(workspace_path, manifest_path)
+    if backend is None:
+        backend = get_backend()
+    
+    remote = RemoteState(backend, remote_cache)
+    workflows = await discover_async(workspace_path, manifest, remote, since, only)
+    if shard:
+        index, shards = shard
+        assignment = assign_shards(workflows, shards, timings)
+        workflows = [workflow for workflow in workflows if assignment[workflow["name"]] == index]
+        print(f"Shard {index}/{shards}: {', '.join(workflow['name'] for workflow in workflows) or 'no workflows'}")
+    return await push_workflows_async(branch, workspace_path, workflows, manifest, backend, dry_run, jobs, remote)
+
+def sync_to_sandgarden(branch: str, dry_run: bool = False, jobs: int = DEFAULT_JOBS, manifest_path: Optional[str] = None, since: Optional[str] = None, backend: Optional[SandBackend] = None, shard: Optional[Tuple[int, int]] = None, timings: Optional[Dict[str, float]] = None, only: Optional[List[Tuple[Optional[str], str]]] = None, remote_cache: Optional[RemoteStateCache] = None) -> Dict[str, Any]:
+    """Sync code to Sandgarden using the provided branch and environment.
+    
+    Blocking wrapper around sync_to_sandgarden_async.
+    """
+    return asyncio.run(sync_to_sandgarden_async(branch, dry_run, jobs, manifest_path, since, backend, shard, timings, only, remote_cache))
+
+def plan_sync(branch: str, manifest_path: Optional[str] = None, since: Optional[str] = None, backend: Optional[SandBackend] = None, only: Optional[List[Tuple[Optional[str], str]]] = None, remote_cache: Optional[RemoteStateCache] = None) -> Dict[str, Any]:
+    """Blocking wrapper around plan_sync_async."""
+    return asyncio.run(plan_sync_async(branch, manifest_path, since, backend, only, remote_cache))
+
+def apply_plan(plan: Dict[str, Any], dry_run: bool = False, jobs: int = DEFAULT_JOBS, manifest_path: Optional[str] = None, backend: Optional[SandBackend] = None) -> Dict[str, Any]:
+    """Blocking wrapper around apply_plan_async."""
+    return asyncio.run(apply_plan_async(plan, dry_run, jobs, manifest_path, backend))
 
 def post_pr_comment(message: str) -> None:
     """Post a comment on the PR using GitHub API."""
@@ -554,27 +2723,28 @@ def post_pr_comment(message: str) -> None:
     try:
         with open(event_path) as f:
             event_data = json.load(f)
-            if "pull_request" not in event_data:
+            if "pull_request" not in event_data and "after" not in event_data:
                 raise ValueError("Invalid event data")
                 
-            pr_number = event_data["pull_request"]["number"]
             repo = event_data["repository"]["full_name"]
             
             # Get GitHub token from environment
             github_token = os.environ.get("GITHUB_TOKEN")
             if not github_token:
                 raise ValueError("GITHUB_TOKEN environment variable must be set")
+            
+            client = github_client(github_token)
+            pr_number = event_pull_request(event_data, client)
+            if pr_number is None:
+                # A direct push to the branch has no PR to comment on
+                print("No PR to comment on")
+                return
                 
             # Post comment using GitHub API
-            headers = {
-                "Authorization": f"token {github_token}",
-                "Accept": "application/vnd.github.v3+json"
-            }
-            
-            url = f"https://api.github.com/repos/{repo}/issues/{pr_number}/comments"
+            url = f"{GITHUB_API_URL}/repos/{repo}/issues/{pr_number}/comments"
             data = {"body": message}
             
-            response = requests.post(url, headers=headers, json=data)
+            response = client.post(url, json=data)
             if response.status_code != 201:
                 raise Exception(f"Failed to post comment: {response.text}")
                 
@@ -583,36 +2753,401 @@ def post_pr_comment(message: str) -> None:
     except Exception as e:
         raise
 
+class InotifyWatcher:
+    """Watches a directory tree for changed files with Linux inotify.
+    
+    inotify watches single directories, so every directory of the tree is
+    watched, including the ones created later.
+    """
+    
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct("iIII")
+    
+    def __init__(self, root: Path):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs: Dict[int, Path] = {}
+        self._watch_tree(root)
+    
+    def _watch_tree(self, root: Path) -> List[str]:
+        """Watch root and every directory below it, returning the files already in them."""
+        files = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.MASK)
+            if wd >= 0:
+                self._dirs[wd] = Path(dirpath)
+            files.extend(os.path.join(dirpath, name) for name in filenames)
+        return files
+    
+    def read(self, timeout: Optional[float]) -> List[str]:
+        """Wait up to timeout seconds for changes, returning the changed paths."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b"\0")
+            offset += self.EVENT.size + length
+            if mask & self.IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None or not name:
+                continue
+            path = directory / os.fsdecode(name)
+            paths.append(str(path))
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                # Files may have been written before the new directory was watched
+                paths.extend(self._watch_tree(path))
+        return paths
+    
+    def close(self) -> None:
+        os.close(self.fd)
+
+class PollingWatcher:
+    """Watches a directory tree by comparing file modification times, where inotify is not available."""
+    
+    def __init__(self, root: Path, interval: float = WATCH_POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self._snapshot = self._scan()
+    
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+    
+    def read(self, timeout: Optional[float]) -> List[str]:
+        """Wait up to timeout seconds for changes, returning the changed paths."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self._scan()
+            changed = [path for path in snapshot.keys() | self._snapshot.keys() if snapshot.get(path) != self._snapshot.get(path)]
+            self._snapshot = snapshot
+            if changed:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return []
+            time.sleep(self.interval if deadline is None else max(0.0, min(self.interval, deadline - time.monotonic())))
+    
+    def close(self) -> None:
+        pass
+
+def file_watcher(root: Path) -> Union[InotifyWatcher, PollingWatcher]:
+    """Watch a directory tree with inotify, or by polling where inotify is not available."""
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError, TypeError) as e:
+            print(f"inotify is not available ({e}), polling for changes instead")
+    return PollingWatcher(root)
+
+def wait_for_changes(watcher: Union[InotifyWatcher, PollingWatcher], debounce: float = WATCH_DEBOUNCE, stop: Optional[threading.Event] = None) -> List[str]:
+    """Wait for files to change, and until they stop changing for `debounce` seconds.
+    
+    The watcher is read with a timeout, so that the wait ends soon after
+    stop is set.
+    
+    Returns:
+        List[str]: The changed paths, each once, or none if stopped first
+    """
+    changed = {}
+    while not changed:
+        if stop is not None and stop.is_set():
+            return []
+        changed = dict.fromkeys(watcher.read(WATCH_POLL_INTERVAL))
+    while True:
+        more = watcher.read(debounce)
+        if not more:
+            return list(changed)
+        changed.update(dict.fromkeys(more))
+
+def classify_change(path: str, workspace_path: Path) -> Optional[Tuple[str, str, Optional[str], Optional[str]]]:
+    """Map a changed path to the smallest resource it belongs to.
+    
+    Follows the layout find_steps and find_prompts read: prompts in
+    workflows/<workflow>/steps/<step>/prompts/, the rest of a step in its
+    directory, and anything else of a workflow outside its steps/.
+    
+    Returns:
+        (resource type, workflow directory, step directory, prompt name),
+        with the parts that don't apply set to None, or None for paths that
+        don't belong to a resource (editor swap files, caches, ...)
+    """
+    try:
+        parts = Path(path).relative_to(workspace_path / "workflows").parts
+    except ValueError:
+        return None
+    if not parts or any(part.startswith(".") or part == "__pycache__" for part in parts) or parts[-1].endswith(("~", ".swp", ".tmp")):
+        return None
+    if len(parts) >= 4 and parts[1] == "steps":
+        if len(parts) == 5 and parts[3] == "prompts":
+            return "prompts", parts[0], parts[2], Path(parts[4]).stem
+        return "steps", parts[0], parts[2], None
+    if len(parts) >= 2 and parts[1] != "steps":
+        return "workflows", parts[0], None, None
+    return None
+
+async def watch_async(branch: str, jobs: int = DEFAULT_JOBS, manifest_path: Optional[str] = None, backend: Optional[SandBackend] = None, debounce: float = WATCH_DEBOUNCE, watcher=None, rounds: Optional[int] = None, remote_cache: Optional[RemoteStateCache] = None) -> None:
+    """Push changes to the workflows as they are saved.
+    
+    Syncs everything once, then waits for files under workflows/ to change.
+    Once they settle, the changed paths are mapped to the prompts, steps and
+    workflows they belong to, only the workflows they are in are scanned
+    again, and the manifest decides which of those resources to push.
+    
+    Args:
+        branch: Branch name for tagging
+        jobs: Maximum number of pushes to run at the same time
+        manifest_path: Path of the sync manifest
+        backend: Backend to push with
+        debounce: Seconds files must stay unchanged before they are pushed
+        watcher: Watcher to read changes from, file_watcher by default
+        rounds: Stop after this many rounds of changes, watch forever if None
+        remote_cache: Cache of the remote state to start from and keep up to date
+    """
+    workspace_path = sync_workspace()
+    manifest = open_manifest(workspace_path, manifest_path)
+    if backend is None:
+        backend = get_backend()
+    remote = RemoteState(backend, remote_cache)
+    
+    profiler.reset()
+    workflows = await discover_async(workspace_path, manifest, remote)
+    await push_workflows_async(branch, workspace_path, workflows, manifest, backend, jobs=jobs, remote=remote)
+    
+    if watcher is None:
+        watcher = file_watcher(workspace_path / "workflows")
+    print(f"👀 Watching {workspace_path / 'workflows'} for changes")
+    # Waiting runs on a worker thread, which asyncio.run waits for on Ctrl-C
+    stop = threading.Event()
+    waiting = None
+    try:
+        while rounds is None or rounds > 0:
+            waiting = asyncio.get_running_loop().run_in_executor(None, wait_for_changes, watcher, debounce, stop)
+            paths = await asyncio.shield(waiting)
+            changes = {change for change in (classify_change(path, workspace_path) for path in paths) if change}
+            if not changes:
+                continue
+            if rounds is not None:
+                rounds -= 1
+            
+            for resource_type, workflow_dir, step_dir, prompt in sorted(changes, key=str):
+                print(f"Changed: {resource_type} {prompt or step_dir or workflow_dir}")
+            profiler.reset()
+            try:
+                workflow_dirs = sorted({workspace_path / "workflows" / change[1] for change in changes})
+                workspace = Workspace(path=workspace_path, workflows=[scan_workflow(d) for d in workflow_dirs if d.is_dir()])
+                changed_files = [str(Path(path).relative_to(workspace_path)) for path in paths if classify_change(path, workspace_path)]
+                workflows = find_workflows(workspace_path, changed_files, remote, manifest, workspace)
+                synced = await push_workflows_async(branch, workspace_path, workflows, manifest, backend, jobs=jobs, remote=remote)
+                manifest.save()
+                count = sum(len(names) for names in synced.values())
+                print(f"✅ Pushed {count} resources in {profiler.elapsed():.1f}s")
+            except Exception as e:
+                print(f"❌ Sync failed: {e}")
+    finally:
+        stop.set()
+        if waiting is not None:
+            # Let the thread return before its watcher is closed
+            await asyncio.wait([waiting])
+        watcher.close()
+
+def summary_message(title: str, intro: str, resources: Dict[str, List[str]], timings: Optional[str] = None) -> str:
+    """Build the markdown PR comment listing resources by type.
+    
+    The comment ends with a timings table, the profile summary by default.
+    """
+    message = f"\n# {title}\n"
+    if sum(len(names) for names in resources.values()) > 0:
+        message += f"{intro}\n\n"
+    
+    for resource_type, names in resources.items():
+        if names:
+            message += f"## {resource_type.title()}\n"
+            for name in names:
+                message += f"- {name}\n"
+            message += "\n"
+    
+    message += f"<details><summary>Timings</summary>\n\n{timings or profiler.summary_table()}\n\n</details>\n"
+    return message
+
+def workflow_timings() -> Dict[str, float]:
+    """Seconds spent pushing the resources of each workflow in the last sync."""
+    timings = defaultdict(float)
+    for record in profiler.phases:
+        if record["category"] == "push" and "workflow" in record["args"]:
+            timings[record["args"]["workflow"]] += record["duration"]
+    return dict(timings)
+
+def build_report(synced: Dict[str, List[str]], shard: Optional[Tuple[int, int]] = None, error: Optional[str] = None) -> Dict[str, Any]:
+    """Build the report of a sync, merged with the other shards by merge_reports."""
+    return {
+        "shard": f"{shard[0]}/{shard[1]}" if shard else None,
+        "synced": synced,
+        "timings": workflow_timings(),
+        "seconds": profiler.elapsed(),
+        "error": error
+    }
+
+def read_timings(path: str) -> Dict[str, float]:
+    """Read the per-workflow timings written by --merge-reports, empty if there are none yet."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def merge_timings(previous: Dict[str, float], reports: List[Dict[str, Any]]) -> Dict[str, float]:
+    """Update per-workflow timings with the workflows pushed in the reports.
+    
+    Workflows that had nothing to push keep their previous timing, which is
+    a better estimate of their next push than zero.
+    """
+    timings = dict(previous)
+    for report in reports:
+        timings.update({name: seconds for name, seconds in report["timings"].items() if seconds > 0})
+    return timings
+
+def merge_reports(reports: List[Dict[str, Any]]) -> Tuple[str, bool]:
+    """Merge shard reports into one PR comment.
+    
+    Returns:
+        Tuple of the comment and whether every shard succeeded
+    """
+    synced = {"workflows": [], "steps": [], "prompts": []}
+    for report in reports:
+        for resource_type, names in report["synced"].items():
+            synced[resource_type].extend(names)
+    failed = [report for report in reports if report.get("error")]
+    
+    lines = [
+        "| Shard | Synced | Total (s) | Result |",
+        "| --- | ---: | ---: | --- |"
+    ]
+    for report in sorted(reports, key=lambda r: r["shard"] or ""):
+        result = "failed" if report.get("error") else "ok"
+        lines.append(f"| {report['shard']} | {sum(len(names) for names in report['synced'].values())} | {report['seconds']:.2f} | {result} |")
+    timings = "\n".join(lines)
+    
+    if not failed:
+        return summary_message("✅ Sync Complete", "Successfully synced the following resources to Sandgarden:", synced, timings), True
+    
+    message = summary_message("❌ Sandgarden Sync Failed", "These resources were synced before the failure:", synced, timings)
+    for report in failed:
+        message += f"\nShard {report['shard']} failed with the following error:\n\n```\n{report['error']}\n```\n"
+    return message, False
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Sync workflows to Sandgarden")
-    parser.add_argument("branch", help="Branch name for tagging")
+    parser.add_argument("branch", help="Branch name for tagging (a plan applied with --apply is tagged with the branch it was planned for)")
     parser.add_argument("--dry-run", action="store_true", help="Print commands without executing them")
+    parser.add_argument("--jobs", type=int, default=DEFAULT_JOBS, help="Number of pushes to run in parallel")
+    parser.add_argument("--manifest", help=f"Path of the sync manifest (default: <workspace>/{DEFAULT_MANIFEST_PATH})")
+    parser.add_argument("--since", metavar="REF", help="Detect changed files with git against REF instead of the GitHub API")
+    parser.add_argument("--backend", choices=["cli", "http"], help="Talk to Sandgarden through the sand CLI or its REST API (default: cli, or SAND_BACKEND)")
+    parser.add_argument("--profile", metavar="PATH", help="Write the timing of every phase of the sync to PATH")
+    parser.add_argument("--profile-format", choices=["json", "chrome"], default="json", help="Write the profile as JSON or as a Chrome trace")
+    parser.add_argument("--shard", type=parse_shard, metavar="I/N", help="Only sync shard I of N, without commenting on the PR")
+    parser.add_argument("--timings", metavar="PATH", help="Per-workflow push times, read by --shard to balance shards and updated by --merge-reports")
+    parser.add_argument("--report", metavar="PATH", help="Write the result of the sync to PATH, for --merge-reports")
+    parser.add_argument("--remote-cache", metavar="PATH", help="Keep the state of Sandgarden in PATH between syncs, to list it again only when stale")
+    parser.add_argument("--remote-cache-ttl", type=float, default=REMOTE_CACHE_TTL, metavar="SECONDS", help="How long the --remote-cache state is used without asking Sandgarden")
+    parser.add_argument("--only", action="append", type=parse_selector, metavar="[TYPE:]NAME", help="Only sync the workflow, step or prompt NAME (a glob) and what depends on it, e.g. prompt:greeting. Can be repeated")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--plan", metavar="PATH", help="Write what would be pushed to a plan file at PATH instead of pushing it")
+    mode.add_argument("--apply", metavar="PATH", help="Push the plan at PATH without discovering anything again, if Sandgarden has not changed since")
+    mode.add_argument("--merge-reports", nargs="+", metavar="PATH", help="Post one PR comment for the reports of every shard instead of syncing")
+    mode.add_argument("--watch", action="store_true", help="Keep running and push workflows, steps and prompts as their files change")
+    parser.add_argument("--debounce", type=float, default=WATCH_DEBOUNCE, help="Seconds files must stay unchanged before --watch pushes them")
     args = parser.parse_args()
+    remote_cache = RemoteStateCache(Path(args.remote_cache), args.remote_cache_ttl) if args.remote_cache else None
+    
+    # Outside of a GitHub Action there is no PR to comment on, and shards leave it to --merge-reports
+    comment_on_pr = (not args.since or bool(os.environ.get("GITHUB_EVENT_PATH"))) and not args.shard
+    
+    if args.merge_reports:
+        reports = []
+        for path in args.merge_reports:
+            with open(path) as f:
+                reports.append(json.load(f))
+        if args.timings:
+            timings = merge_timings(read_timings(args.timings), reports)
+            with open(args.timings, "w") as f:
+                json.dump(timings, f, indent=2)
+        message, succeeded = merge_reports(reports)
+        if comment_on_pr:
+            post_pr_comment(message)
+        print('\n'.join(re.sub(r'^#+\s+', '', line) for line in message.split('\n')))
+        sys.exit(0 if succeeded else 1)
+    
+    if args.watch:
+        try:
+            asyncio.run(watch_async(args.branch, args.jobs, args.manifest, get_backend(args.backend), args.debounce, remote_cache=remote_cache))
+        except KeyboardInterrupt:
+            print("\nStopped watching")
+        sys.exit(0)
     
     print("🔄 Syncing to Sandgarden")
     try:
-        synced = sync_to_sandgarden(args.branch, args.dry_run)
-        
-        # Build success message
-        message = "\n# ✅ Sync Complete\n"
-        if len(synced["workflows"]) + len(synced["steps"]) + len(synced["prompts"]) > 0:
-            message += "Successfully synced the following resources to Sandgarden:\n\n"
-        
-        for resource_type, resources in synced.items():
-            if resources:
-                message += f"## {resource_type.title()}\n"
-                for resource in resources:
-                    message += f"- {resource}\n"
-                message += "\n"
+        if args.plan:
+            plan = plan_sync(args.branch, args.manifest, args.since, get_backend(args.backend), args.only, remote_cache)
+            write_plan(plan, args.plan)
+            message = summary_message("📋 Sync Planned", "Merging will sync the following resources to Sandgarden:", planned_resources(plan))
+        else:
+            if args.apply:
+                synced = apply_plan(read_plan(args.apply), args.dry_run, args.jobs, args.manifest, get_backend(args.backend))
+            else:
+                timings = read_timings(args.timings) if args.timings else None
+                synced = sync_to_sandgarden(args.branch, args.dry_run, args.jobs, args.manifest, args.since, get_backend(args.backend), args.shard, timings, args.only, remote_cache)
+            if args.report:
+                with open(args.report, "w") as f:
+                    json.dump(build_report(synced, args.shard), f, indent=2)
+            message = summary_message("✅ Sync Complete", "Successfully synced the following resources to Sandgarden:", synced)
                             
         # Post success comment
-        post_pr_comment(message)
+        if comment_on_pr:
+            with profiler.phase("PR comment", "pr comment"):
+                post_pr_comment(message)
         print('\n'.join(re.sub(r'^#+\s+', '', line) for line in message.split('\n')))
     except Exception as e:
         error_msg = "# ❌ Sandgarden Sync Failed\n\n"
         error_msg += f"Failed to sync to Sandgarden with the following error:\n\n"
         error_msg += f"```\n{str(e)}\n```"
         print(error_msg.replace("# ", ""), file=sys.stderr)
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(build_report({"workflows": [], "steps": [], "prompts": []}, args.shard, str(e)), f, indent=2)
         # Post error comment
-        post_pr_comment(error_msg)
-        sys.exit(1) 
\ No newline at end of file
+        if comment_on_pr:
+            post_pr_comment(error_msg)
+        sys.exit(1)
+    finally:
+        if args.profile:
+            profiler.write(args.profile, args.profile_format)
@@ -1,11 +1,13 @@
 import os
 import json
-from unittest.mock import patch, mock_open, Mock
+from unittest.mock import patch, mock_open, Mock, AsyncMock
+from contextlib import contextmanager
 import pytest
 import requests
-from sync_to_sandgarden import get_changed_files
+from sync_to_sandgarden import get_changed_files, SandBackend, RESOURCE_TYPES
 import yaml
 import tempfile
+import platform
 
 @pytest.fixture
 def mock_env_vars():
@@ -112,41 +114,208 @@ def test_get_changed_files_no_github_token(mock_env_vars):
         with patch("builtins.open", mock_open(read_data='{}')):
             assert get_changed_files() == []
 
+def make_response(status_code=200, data=None, headers=None, links=None, text=""):
+    """Build a mock requests response."""
+    response = Mock()
+    response.status_code = status_code
+    response.json.return_value = data
+    response.headers = headers or {}
+    response.links = links or {}
+    response.text = text
+    return response
+
+@contextmanager
+def patch_sand_cli(**kwargs):
+    """Patch subprocess.run, and the asyncio subprocesses, that run the sand CLI.
+    
+    Yields the subprocess.run mock, which also answers the async calls.
+    """
+    with patch("subprocess.run", **kwargs) as mock_run:
+        async def create_subprocess_exec(*cmd, **_):
+            result = mock_run(list(cmd), capture_output=True, text=True)
+            stdout = result.stdout if isinstance(result.stdout, str) else ""
+            stderr = result.stderr if isinstance(result.stderr, str) else ""
+            process = Mock(returncode=result.returncode)
+            process.communicate = AsyncMock(return_value=(stdout.encode(), stderr.encode()))
+            return process
+        
+        with patch("asyncio.create_subprocess_exec", create_subprocess_exec):
+            yield mock_run
+
 def test_get_changed_files_success(mock_env_vars, mock_pr_event_data):
     """Test successful retrieval of changed files."""
     expected_files = ["file1.py", "file2.py"]
     mock_response = [{"filename": f} for f in expected_files]
 
     with patch("builtins.open", mock_open(read_data=json.dumps(mock_pr_event_data))):
-        with patch("requests.get") as mock_get:
-            mock_get.return_value.status_code = 200
-            mock_get.return_value.json.return_value = mock_response
+        with patch("requests.Session.request") as mock_request:
+            mock_request.return_value = make_response(200, mock_response)
             
             assert get_changed_files() == expected_files
             
-            mock_get.assert_called_once_with(
-                "https://api.github.com/repos/org/repo/pulls/123/files",
-                headers={
-                    "Authorization": "token fake-token",
-                    "Accept": "application/vnd.github.v3+json"
-                }
-            )
+            mock_request.assert_called_once()
+            method, url = mock_request.call_args[0]
+            assert (method, url) == ("GET", "https://api.github.com/repos/org/repo/pulls/123/files")
+            assert mock_request.call_args[1]["params"] == {"per_page": 100}
+
+def test_get_changed_files_push_event(mock_env_vars):
+    """Test that a push is matched to the PR it merged."""
+    event_data = {"after": "abc123", "repository": {"full_name": "org/repo"}}
+    
+    with patch("builtins.open", mock_open(read_data=json.dumps(event_data))), \
+         patch("requests.Session.request", side_effect=[
+             make_response(200, [{"number": 5, "merged_at": None}, {"number": 7, "merged_at": "2024-01-01T00:00:00Z"}]),
+             make_response(200, [{"filename": "file1.py"}])
+         ]) as mock_request:
+        assert get_changed_files() == ["file1.py"]
+    
+    assert [call[0] for call in mock_request.call_args_list] == [
+        ("GET", "https://api.github.com/repos/org/repo/commits/abc123/pulls"),
+        ("GET", "https://api.github.com/repos/org/repo/pulls/7/files")
+    ]
+
+def test_get_changed_files_direct_push(mock_env_vars):
+    """Test that a push that merged no PR has no changed files."""
+    event_data = {"after": "abc123", "repository": {"full_name": "org/repo"}}
+    
+    with patch("builtins.open", mock_open(read_data=json.dumps(event_data))), \
+         patch("requests.Session.request", return_value=make_response(200, [])) as mock_request:
+        assert get_changed_files() == []
+        mock_request.assert_called_once()
+
+def test_get_changed_files_pagination(mock_env_vars, mock_pr_event_data):
+    """Test that every page of a large PR is fetched."""
+    next_url = "https://api.github.com/repositories/1/pulls/123/files?per_page=100&page=2"
+    pages = [
+        make_response(200, [{"filename": f"file{i}.py"} for i in range(100)], links={"next": {"url": next_url}}),
+        make_response(200, [{"filename": "file100.py"}])
+    ]
+
+    with patch("builtins.open", mock_open(read_data=json.dumps(mock_pr_event_data))):
+        with patch("requests.Session.request", side_effect=pages) as mock_request:
+            files = get_changed_files()
+            
+            assert len(files) == 101
+            assert files[-1] == "file100.py"
+            assert mock_request.call_args_list[1][0][1] == next_url
+            assert mock_request.call_args_list[1][1]["params"] is None
+
+
+def test_get_changed_files_fetches_pages_in_parallel(mock_env_vars, mock_pr_event_data):
+    """Test that the pages after the first are fetched together when the last page is known."""
+    url = "https://api.github.com/repos/org/repo/pulls/123/files"
+    pages = {
+        url: make_response(200, [{"filename": "file0.py"}], links={
+            "next": {"url": f"{url}?per_page=100&page=2"},
+            "last": {"url": f"{url}?per_page=100&page=3"}
+        }),
+        f"{url}?per_page=100&page=2": make_response(200, [{"filename": "file1.py"}]),
+        f"{url}?per_page=100&page=3": make_response(200, [{"filename": "file2.py"}])
+    }
+
+    with patch("builtins.open", mock_open(read_data=json.dumps(mock_pr_event_data))):
+        with patch("requests.Session.request", side_effect=lambda method, url, **kwargs: pages[url]) as mock_request:
+            assert get_changed_files() == ["file0.py", "file1.py", "file2.py"]
+            assert mock_request.call_count == 3
 
 def test_get_changed_files_api_error(mock_env_vars, mock_pr_event_data):
     """Test handling of GitHub API error."""
     with patch("builtins.open", mock_open(read_data=json.dumps(mock_pr_event_data))):
-        with patch("requests.get") as mock_get:
-            mock_get.return_value.status_code = 404
-            mock_get.return_value.text = "Not found"
+        with patch("requests.Session.request") as mock_request:
+            mock_request.return_value = make_response(404, text="Not found")
             
             assert get_changed_files() == []
 
 def test_get_changed_files_request_exception(mock_env_vars, mock_pr_event_data):
     """Test handling of request exception."""
     with patch("builtins.open", mock_open(read_data=json.dumps(mock_pr_event_data))):
-        with patch("requests.get", side_effect=requests.exceptions.RequestException):
+        with patch("requests.Session.request", side_effect=requests.exceptions.RequestException):
             assert get_changed_files() == []
 
+def test_github_client_conditional_get():
+    """Test that a 304 response is served from the ETag cache."""
+    from sync_to_sandgarden import GitHubClient
+    client = GitHubClient("token")
+    responses = [
+        make_response(200, [{"filename": "a.py"}], headers={"ETag": '"v1"'}),
+        make_response(304)
+    ]
+    with patch("requests.Session.request", side_effect=responses) as mock_request:
+        assert client.get("https://api.github.com/x").data == [{"filename": "a.py"}]
+        assert client.get("https://api.github.com/x").data == [{"filename": "a.py"}]
+        
+        assert mock_request.call_args_list[1][1]["headers"] == {"If-None-Match": '"v1"'}
+
+def test_github_client_keeps_etags_between_syncs(tmp_path):
+    """Test that ETags and bodies saved by one sync make the next one's GETs conditional."""
+    from sync_to_sandgarden import GitHubClient
+    cache_path = tmp_path / ".sandgarden" / "github-cache.json"
+    client = GitHubClient("token", cache_path=cache_path)
+    with patch("requests.Session.request", return_value=make_response(200, [{"filename": "a.py"}], headers={"ETag": '"v1"'})):
+        client.get("https://api.github.com/x")
+    client.save()
+    
+    client = GitHubClient("token", cache_path=cache_path)
+    with patch("requests.Session.request", return_value=make_response(304)) as mock_request:
+        assert client.get("https://api.github.com/x").data == [{"filename": "a.py"}]
+        assert mock_request.call_args[1]["headers"] == {"If-None-Match": '"v1"'}
+
+def test_github_client_follows_cached_links_on_304(tmp_path):
+    """Test that every page is still fetched when the 304s of the next sync have no Link header."""
+    from sync_to_sandgarden import GitHubClient
+    url = "https://api.github.com/repos/org/repo/pulls/1/files"
+    next_url = "https://api.github.com/repositories/1/pulls/1/files?per_page=100&page=2"
+    cache_path = tmp_path / "github-cache.json"
+    client = GitHubClient("token", cache_path=cache_path)
+    with patch("requests.Session.request", side_effect=[
+        make_response(200, [{"filename": "a.py"}], headers={"ETag": '"p1"'}, links={"next": {"url": next_url, "rel": "next"}}),
+        make_response(200, [{"filename": "b.py"}], headers={"ETag": '"p2"'})
+    ]):
+        assert client.get_all(url) == [{"filename": "a.py"}, {"filename": "b.py"}]
+    client.save()
+    
+    client = GitHubClient("token", cache_path=cache_path)
+    with patch("requests.Session.request", return_value=make_response(304)) as mock_request:
+        assert client.get_all(url) == [{"filename": "a.py"}, {"filename": "b.py"}]
+        assert mock_request.call_args_list[1][0] == ("GET", next_url)
+
+def test_github_client_reads_cache_without_links(tmp_path):
+    """Test that a cache saved before links were kept is still used."""
+    from sync_to_sandgarden import GitHubClient
+    url = "https://api.github.com/x"
+    cache_path = tmp_path / "github-cache.json"
+    cache_path.write_text(json.dumps({"responses": {url: ['"v1"', [{"filename": "a.py"}]]}}))
+    client = GitHubClient("token", cache_path=cache_path)
+    with patch("requests.Session.request", return_value=make_response(304)):
+        response = client.get(url)
+    assert response.data == [{"filename": "a.py"}]
+    assert response.page_links == {}
+
+def test_github_client_waits_for_rate_limit():
+    """Test that a rate limited request is retried after the reset."""
+    from sync_to_sandgarden import GitHubClient
+    client = GitHubClient("token")
+    responses = [
+        make_response(403, headers={"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "1000"}),
+        make_response(429, headers={"Retry-After": "2"}),
+        make_response(201)
+    ]
+    with patch("requests.Session.request", side_effect=responses), \
+         patch("sync_to_sandgarden.time.time", return_value=995), \
+         patch("sync_to_sandgarden.time.sleep") as mock_sleep:
+        assert client.post("https://api.github.com/x", json={}).status_code == 201
+        
+        assert [c[0][0] for c in mock_sleep.call_args_list] == [6, 2]
+
+def test_github_client_gives_up_on_long_rate_limit():
+    """Test that a rate limit longer than the maximum wait is returned."""
+    from sync_to_sandgarden import GitHubClient
+    client = GitHubClient("token", max_rate_limit_wait=10)
+    with patch("requests.Session.request", return_value=make_response(429, headers={"Retry-After": "60"})), \
+         patch("sync_to_sandgarden.time.sleep") as mock_sleep:
+        assert client.post("https://api.github.com/x", json={}).status_code == 429
+        mock_sleep.assert_not_called()
+
 def test_find_prompts_no_prompts_dir(mock_step_dir):
     """Test when prompts directory doesn't exist."""
     from sync_to_sandgarden import find_prompts
@@ -171,24 +340,92 @@ def test_find_prompts_sand_cli_failure(mock_prompts_dir, mock_step_dir):
         assert len(prompts) == 2
         assert all(prompt["updated"] for prompt in prompts)
 
-def test_find_prompts_changed_files(mock_prompts_dir, mock_step_dir):
-    """Test detection of changed prompt files."""
-    changed_files = [
-        "workflow/workflow_name/steps/0001-test-step/prompts/test1.txt"
-    ]
-    
+def test_find_prompts_compares_unknown_prompts(mock_prompts_dir, mock_step_dir):
+    """Test that prompts the manifest doesn't know are compared with their content in Sandgarden."""
     with patch("subprocess.run") as mock_run:
         mock_run.return_value.returncode = 0
         mock_run.return_value.stdout = json.dumps({ "prompts": [
-            {"version": 1, "content": "Current content"}
+            {"name": "test1", "version": 1, "content": "Current content"},
+            {"name": "test2", "version": 1, "content": "Test prompt 2"}
         ]})
         
         from sync_to_sandgarden import find_prompts
-        prompts = find_prompts(mock_step_dir, changed_files)
+        prompts = find_prompts(mock_step_dir, [])
         
         assert len(prompts) == 2
-        assert prompts[0]["updated"]  # Changed file
-        assert not prompts[1]["updated"]  # Unchanged file
+        assert prompts[0]["updated"]  # Differs from Sandgarden
+        assert not prompts[1]["updated"]  # Same as Sandgarden
+
+def test_find_prompts_lists_remote_once(mock_prompts_dir, mock_step_dir):
+    """Test that prompts are looked up from a single remote listing."""
+    with patch("subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 0
+        mock_run.return_value.stdout = json.dumps({"prompts": []})
+        
+        from sync_to_sandgarden import find_prompts, sand_command
+        find_prompts(mock_step_dir, [])
+        
+        mock_run.assert_called_once()
+        assert mock_run.call_args[0][0] == [sand_command(), "prompts", "list", "--json"]
+
+def test_remote_state_resolves_latest_version():
+    """Test that the remote snapshot keeps the latest version of each name."""
+    with patch("subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 0
+        mock_run.return_value.stdout = json.dumps({"steps": [
+            {"name": "first-step", "version": 1},
+            {"name": "first-step", "version": 3},
+            {"name": "first-step", "version": 2},
+            {"name": "second-step", "version": 1}
+        ]})
+        
+        from sync_to_sandgarden import RemoteState
+        remote = RemoteState()
+        assert remote.latest("steps", "first-step")["version"] == 3
+        assert remote.latest("steps", "second-step")["version"] == 1
+        assert remote.latest("steps", "missing-step") is None
+        mock_run.assert_called_once()
+
+def test_remote_state_follows_pages():
+    """Test that the remote snapshot follows page tokens."""
+    pages = [
+        Mock(returncode=0, stdout=json.dumps({"prompts": [{"name": "a", "version": 1}], "nextPageToken": "p2"})),
+        Mock(returncode=0, stdout=json.dumps({"prompts": [{"name": "b", "version": 2}]}))
+    ]
+    with patch("subprocess.run", side_effect=pages) as mock_run:
+        from sync_to_sandgarden import RemoteState
+        remote = RemoteState()
+        assert remote.latest("prompts", "a")["version"] == 1
+        assert remote.latest("prompts", "b")["version"] == 2
+        
+        assert mock_run.call_count == 2
+        assert mock_run.call_args_list[1][0][0][-2:] == ["--page-token", "p2"]
+
+def test_remote_state_cli_failure():
+    """Test that a failed listing is treated as an empty remote."""
+    with patch("subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 1
+        mock_run.return_value.stderr = "boom"
+        
+        from sync_to_sandgarden import RemoteState
+        assert RemoteState().latest("workflows", "test-workflow") is None
+
+
+def test_remote_state_load_async_runs_the_cli(tmp_path):
+    """Test that every resource type is listed up front through asyncio subprocesses."""
+    sand = tmp_path / "sand"
+    sand.write_text('#!/bin/sh\necho "{\\"$1\\": [{\\"name\\": \\"$1-1\\", \\"version\\": 2}]}"\n')
+    sand.chmod(0o755)
+    
+    import asyncio
+    from sync_to_sandgarden import RemoteState
+    remote = RemoteState()
+    with patch.dict(os.environ, {"SAND_CLI_PATH": str(sand)}), patch("subprocess.run") as mock_run:
+        asyncio.run(remote.load_async())
+        
+        assert remote.latest("prompts", "prompts-1")["version"] == 2
+        assert remote.latest("workflows", "workflows-1")["version"] == 2
+        mock_run.assert_not_called()
 
 def test_find_steps_no_steps_dir(mock_workflow_dir):
     """Test when steps directory doesn't exist."""
@@ -230,7 +467,9 @@ def test_find_steps_success(mock_steps_dir, mock_workflow_dir):
         assert steps[0]["name"] == "0001-first-step"
         assert steps[0]["description"] == "First test step"
         assert steps[0]["connectors"] == ["connector1", "connector2"]
+        # Not in the manifest and not changed, left alone without being verified
         assert not steps[0]["updated"]
+        assert not steps[0]["verified"]
         
         assert steps[1]["name"] == "0002-second-step"
         assert steps[1]["connectors"] == ["connector3"]
@@ -247,20 +486,26 @@ def test_find_steps_sand_cli_failure(mock_steps_dir, mock_workflow_dir):
         assert all(step["updated"] for step in steps)
 
 def test_find_steps_changed_files(mock_steps_dir, mock_workflow_dir):
-    """Test detection of changed step files."""
+    """Test that the changed files decide for steps the manifest doesn't know about."""
     changed_files = [
-        "test-workflow/steps/0001-first-step/main.py"
+        "workflows/test-workflow/steps/0001-first-step/main.py"
     ]
     
     with patch("subprocess.run") as mock_run:
         mock_run.return_value.returncode = 0
-        mock_run.return_value.stdout = "[]"
+        mock_run.return_value.stdout = json.dumps({"steps": [
+            {"name": "0001-first-step", "version": 1},
+            {"name": "0002-second-step", "version": 1}
+        ]})
         
         from sync_to_sandgarden import find_steps
         steps = find_steps(mock_workflow_dir, changed_files)
         
         assert len(steps) == 2
         assert steps[0]["updated"]  # Changed step
+        # Unchanged step, left alone but not known to be in sync
+        assert not steps[1]["updated"]
+        assert not steps[1]["verified"]
 
 def test_find_steps_with_prompts(tmp_path):
     """Test steps with associated prompts."""
@@ -330,20 +575,26 @@ def test_find_workflows_success(mock_workflows_dir, mock_steps_dir):
         assert len(workflow["steps"]) == 2
         
 def test_find_workflows_changed_workflow_json(mock_workflows_dir, mock_steps_dir):
-    """Test detection of changed workflow.json."""
-    changed_files = [
-        "workflows/test-workflow/workflow.json"
-    ]
+    """Test that a changed workflow file, and not a changed step, marks a workflow the manifest doesn't know about."""
+    listing = json.dumps({
+        "workflows": [{"name": "test-workflow", "version": 1}],
+        "steps": [{"name": "0001-first-step", "version": 1}, {"name": "0002-second-step", "version": 1}]
+    })
     
-    with patch("subprocess.run") as mock_run:
-        mock_run.return_value.returncode = 0
-        mock_run.return_value.stdout = "[]"
-        
-        from sync_to_sandgarden import find_workflows
-        workflows = find_workflows(mock_workflows_dir.parent, changed_files)
+    from sync_to_sandgarden import find_workflows, RemoteState, CliBackend
+    for changed_files, updated in (
+        (["workflows/test-workflow/workflow.json"], True),
+        (["workflows/test-workflow/steps/0002-second-step/prompts/notes.md"], False),
+        ([], False)
+    ):
+        with patch("subprocess.run") as mock_run:
+            mock_run.return_value.returncode = 0
+            mock_run.return_value.stdout = listing
+            workflows = find_workflows(mock_workflows_dir.parent, changed_files, RemoteState(CliBackend()))
         
         assert len(workflows) == 1
-        assert workflows[0]["updated"]
+        assert workflows[0]["updated"] == updated
+        assert not any(step["updated"] for step in workflows[0]["steps"])
 
 def test_find_workflows_with_schemas(mock_workflows_dir, mock_steps_dir):
     """Test workflows with input/output schemas."""
@@ -590,17 +841,17 @@ def test_post_pr_comment_success():
         "pull_request": {"number": 123},
         "repository": {"full_name": "org/repo"}
     }))), \
-    patch("requests.post") as mock_post:
-        mock_post.return_value.status_code = 201
+    patch("requests.Session.request") as mock_request:
+        mock_request.return_value = make_response(201)
         
-        from sync_to_sandgarden import post_pr_comment
+        from sync_to_sandgarden import post_pr_comment, github_client
         post_pr_comment("Test comment")
         
         # Verify correct API call
-        mock_post.assert_called_once()
-        assert mock_post.call_args[0][0] == "https://api.github.com/repos/org/repo/issues/123/comments"
-        assert mock_post.call_args[1]["headers"]["Authorization"] == "token test-token"
-        assert mock_post.call_args[1]["json"]["body"] == "Test comment"
+        mock_request.assert_called_once()
+        assert mock_request.call_args[0] == ("POST", "https://api.github.com/repos/org/repo/issues/123/comments")
+        assert github_client("test-token").session.headers["Authorization"] == "token test-token"
+        assert mock_request.call_args[1]["json"]["body"] == "Test comment"
 
 def test_post_pr_comment_missing_token():
     """Test PR comment fails when GitHub token is missing."""
@@ -631,6 +882,25 @@ def test_post_pr_comment_invalid_event_data():
         with pytest.raises(ValueError, match="Invalid event data"):
             post_pr_comment("Test comment")
 
+def test_post_pr_comment_push_event():
+    """Test that the comment goes to the PR a push merged, and is skipped for a direct push."""
+    event_data = {"after": "abc123", "repository": {"full_name": "org/repo"}}
+    with patch.dict(os.environ, {
+        "GITHUB_TOKEN": "test-token",
+        "GITHUB_EVENT_PATH": "/path/to/event.json"
+    }), \
+    patch("builtins.open", mock_open(read_data=json.dumps(event_data))), \
+    patch("requests.Session.request") as mock_request:
+        from sync_to_sandgarden import post_pr_comment
+        mock_request.side_effect = [make_response(200, [{"number": 7, "merged_at": "2024-01-01T00:00:00Z"}]), make_response(201)]
+        post_pr_comment("Test comment")
+        assert mock_request.call_args[0] == ("POST", "https://api.github.com/repos/org/repo/issues/7/comments")
+        
+        mock_request.reset_mock()
+        mock_request.side_effect = [make_response(200, [])]
+        post_pr_comment("Test comment")
+        assert [call[0][0] for call in mock_request.call_args_list] == ["GET"]
+
 def test_post_pr_comment_api_error():
     """Test handling of GitHub API error."""
     with patch.dict(os.environ, {
@@ -641,9 +911,8 @@ def test_post_pr_comment_api_error():
         "pull_request": {"number": 123},
         "repository": {"full_name": "org/repo"}
     }))), \
-    patch("requests.post") as mock_post:
-        mock_post.return_value.status_code = 403
-        mock_post.return_value.text = "Forbidden"
+    patch("requests.Session.request") as mock_request:
+        mock_request.return_value = make_response(403, text="Forbidden")
         
         from sync_to_sandgarden import post_pr_comment
         with pytest.raises(Exception, match="Failed to post comment: Forbidden"):
@@ -659,7 +928,7 @@ def test_post_pr_comment_request_exception():
         "pull_request": {"number": 123},
         "repository": {"full_name": "org/repo"}
     }))), \
-    patch("requests.post", side_effect=requests.exceptions.RequestException("Network error")):
+    patch("requests.Session.request", side_effect=requests.exceptions.RequestException("Network error")):
         from sync_to_sandgarden import post_pr_comment
         with pytest.raises(Exception, match="Failed to post comment: Network error"):
             post_pr_comment("Test comment")
@@ -684,3 +953,1307 @@ def test_update_resource_dry_run():
         
         # Verify result indicates dry run
         assert result == {"version": 1, "dry_run": True}
+
+def make_workflow(path="wf", steps=None, updated=True):
+    return {"name": path, "path": path, "steps": steps or [], "updated": updated}
+
+def make_step(name, prompts=None, updated=True):
+    return {"name": name, "path": f"steps/{name}", "config": None, "prompts": prompts or [], "connectors": [], "updated": updated}
+
+def test_build_push_graph_dependencies():
+    """Test that prompts precede steps and steps precede workflows."""
+    prompt = {"name": "p1", "updated": True, "version": 0}
+    workflow = make_workflow(steps=[
+        make_step("s1", [prompt]),
+        make_step("s2", updated=False)
+    ])
+    
+    from sync_to_sandgarden import build_push_graph
+    nodes = {node["id"]: node for node in build_push_graph([workflow])}
+    
+    assert set(nodes) == {"prompts:wf/s1/p1", "steps:wf/s1", "workflows:wf"}
+    assert nodes["prompts:wf/s1/p1"]["deps"] == []
+    assert nodes["steps:wf/s1"]["deps"] == ["prompts:wf/s1/p1"]
+    assert nodes["workflows:wf"]["deps"] == ["steps:wf/s1"]
+
+def test_run_push_graph_order():
+    """Test that every node runs after the nodes it depends on."""
+    nodes = [
+        {"id": "a", "deps": []},
+        {"id": "b", "deps": []},
+        {"id": "c", "deps": ["a", "b"]},
+        {"id": "d", "deps": ["c"]}
+    ]
+    order = []
+    
+    from sync_to_sandgarden import run_push_graph
+    statuses = run_push_graph(nodes, lambda node: order.append(node["id"]), jobs=2)
+    
+    assert statuses == {"a": "synced", "b": "synced", "c": "synced", "d": "synced"}
+    assert order.index("c") > order.index("a")
+    assert order.index("c") > order.index("b")
+    assert order.index("d") > order.index("c")
+
+def test_run_push_graph_skips_only_dependents_of_failure():
+    """Test that a failed node only skips the nodes that depend on it."""
+    nodes = [
+        {"id": "bad", "deps": []},
+        {"id": "good", "deps": []},
+        {"id": "after-bad", "deps": ["bad"]},
+        {"id": "after-both", "deps": ["bad", "good"]},
+        {"id": "after-good", "deps": ["good"]}
+    ]
+    
+    def push(node):
+        if node["id"] == "bad":
+            raise ValueError("push failed")
+    
+    from sync_to_sandgarden import run_push_graph
+    statuses = run_push_graph(nodes, push, jobs=4)
+    
+    assert statuses == {
+        "bad": "failed",
+        "good": "synced",
+        "after-bad": "skipped",
+        "after-both": "skipped",
+        "after-good": "synced"
+    }
+
+def test_run_push_graph_runs_in_parallel():
+    """Test that independent nodes run at the same time."""
+    import threading
+    barrier = threading.Barrier(3, timeout=5)
+    nodes = [{"id": str(i), "deps": []} for i in range(3)]
+    
+    from sync_to_sandgarden import run_push_graph
+    statuses = run_push_graph(nodes, lambda node: barrier.wait(), jobs=3)
+    
+    assert set(statuses.values()) == {"synced"}
+
+def test_sync_to_sandgarden_dry_run(mock_workflows_dir, mock_steps_dir):
+    """Test a full dry-run sync of new resources."""
+    (mock_steps_dir / "0001-first-step" / "prompts" / "greeting.txt").write_text("Hello")
+    
+    with patch.dict(os.environ, {
+        "SAND_API_KEY": "test-key",
+        "GITHUB_WORKSPACE": str(mock_workflows_dir.parent)
+    }), patch("sync_to_sandgarden.get_changed_files", return_value=[]), \
+    patch_sand_cli() as mock_run:
+        mock_run.return_value.returncode = 1
+        
+        from sync_to_sandgarden import sync_to_sandgarden
+        synced = sync_to_sandgarden("main", dry_run=True, jobs=2)
+    
+    assert synced["prompts"] == ["greeting"]
+    assert sorted(synced["steps"]) == ["0001-first-step", "0002-second-step"]
+    assert synced["workflows"] == ["test-workflow"]
+
+def test_sync_manifest_round_trip(tmp_path):
+    """Test that recorded hashes are saved and loaded again."""
+    from sync_to_sandgarden import SyncManifest
+    path = tmp_path / "state" / "manifest.json"
+    manifest = SyncManifest(path)
+    assert manifest.is_current("prompts", "p1", "abc", 1) is None
+    
+    manifest.record("prompts", "p1", "abc", 1)
+    manifest.save()
+    
+    loaded = SyncManifest(path)
+    assert loaded.is_current("prompts", "p1", "abc", 1)
+    assert not loaded.is_current("prompts", "p1", "def", 1)
+    assert not loaded.is_current("prompts", "p1", "abc", 2)
+
+def test_find_prompts_manifest_overrides_changed_files(mock_prompts_dir, mock_step_dir):
+    """Test that the manifest decides what to push, and the changed files only for prompts it doesn't know."""
+    from sync_to_sandgarden import find_prompts, hash_tree, SyncManifest
+    (mock_prompts_dir / "test3.txt").write_text("Test prompt 3")
+    (mock_prompts_dir / "test4.txt").write_text("Test prompt 4")
+    manifest = SyncManifest()
+    # test1 is listed as changed but matches what was last pushed
+    manifest.record("prompts", "test1", hash_tree(mock_prompts_dir / "test1.txt"), 1)
+    # test2 is not listed as changed but differs from what was last pushed
+    manifest.record("prompts", "test2", "stale-hash", 1)
+    # test3 and test4 are not in the manifest, and listed without their content
+    prefix = "workflow/workflow_name/steps/0001-test-step/prompts"
+    changed_files = [f"{prefix}/test1.txt", f"{prefix}/test3.txt"]
+    
+    with patch("subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 0
+        mock_run.return_value.stdout = json.dumps({"prompts": [
+            {"name": "test1", "version": 1, "content": "Test prompt 1"},
+            {"name": "test2", "version": 1, "content": "Old prompt 2"},
+            {"name": "test3", "version": 1},
+            {"name": "test4", "version": 1}
+        ]})
+        prompts = {p["name"]: p for p in find_prompts(mock_step_dir, changed_files, manifest=manifest)}
+    
+    assert not prompts["test1"]["updated"]
+    assert prompts["test1"]["verified"]
+    assert prompts["test2"]["updated"]
+    assert prompts["test3"]["updated"]
+    assert not prompts["test4"]["updated"]
+    assert not prompts["test4"]["verified"]
+
+def test_find_steps_manifest_detects_remote_drift(mock_steps_dir, mock_workflow_dir):
+    """Test that a step is pushed again when the remote version moved on."""
+    from sync_to_sandgarden import find_steps, hash_tree, SyncManifest
+    manifest = SyncManifest()
+    for step_dir in mock_steps_dir.iterdir():
+        manifest.record("steps", step_dir.name, hash_tree(step_dir, exclude=("prompts",)), 1)
+    
+    with patch("subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 0
+        mock_run.return_value.stdout = json.dumps({"steps": [
+            {"name": "0001-first-step", "version": 1},
+            {"name": "0002-second-step", "version": 2}
+        ]})
+        steps = {s["name"]: s for s in find_steps(mock_workflow_dir, [], manifest=manifest)}
+    
+    assert not steps["0001-first-step"]["updated"]
+    assert steps["0002-second-step"]["updated"]
+
+def test_hash_tree_ignores_excluded_dir(mock_prompts_dir, mock_step_dir):
+    """Test that a step hash does not change with its prompts."""
+    from sync_to_sandgarden import hash_tree
+    before = hash_tree(mock_step_dir, exclude=("prompts",))
+    (mock_prompts_dir / "test1.txt").write_text("Changed prompt")
+    assert hash_tree(mock_step_dir, exclude=("prompts",)) == before
+    
+    (mock_step_dir / "main.py").write_text("def handler(input, sandgarden): pass")
+    assert hash_tree(mock_step_dir, exclude=("prompts",)) != before
+
+def test_sync_to_sandgarden_writes_manifest(mock_workflows_dir, mock_steps_dir, tmp_path):
+    """Test that pushed resources are recorded in the manifest."""
+    manifest_path = tmp_path / "manifest.json"
+    with patch.dict(os.environ, {
+        "SAND_API_KEY": "test-key",
+        "GITHUB_WORKSPACE": str(mock_workflows_dir.parent)
+    }), patch("sync_to_sandgarden.get_changed_files", return_value=[]), \
+    patch("sync_to_sandgarden.CliBackend.list_resources_async", return_value=[]), \
+    patch("sync_to_sandgarden.update_resource_async", return_value={"version": 7}):
+        from sync_to_sandgarden import sync_to_sandgarden
+        sync_to_sandgarden("main", manifest_path=str(manifest_path))
+    
+    resources = json.loads(manifest_path.read_text())["resources"]
+    assert resources["steps"]["0001-first-step"]["version"] == 7
+    assert resources["workflows"]["test-workflow"]["version"] == 7
+
+@pytest.fixture
+def git_repo(tmp_path):
+    """Create a git repository with one commit."""
+    import subprocess
+    def git(*args):
+        subprocess.run(["git", "-C", str(tmp_path), *args], check=True, capture_output=True)
+    git("init", "-q")
+    git("config", "user.email", "test@example.com")
+    git("config", "user.name", "Test")
+    step_dir = tmp_path / "workflows" / "test-workflow" / "steps" / "0001-first-step"
+    (step_dir / "prompts").mkdir(parents=True)
+    (step_dir / "main.py").write_text("def handler(input, sandgarden):\n    return input\n")
+    (step_dir / "prompts" / "old-name.txt").write_text("A prompt that is long enough to be detected as renamed\n" * 5)
+    (tmp_path / "README.md").write_text("readme")
+    git("add", "-A")
+    git("commit", "-q", "-m", "initial")
+    return tmp_path, git
+
+def test_get_changed_files_since(git_repo):
+    """Test change detection from the local git history."""
+    repo, git = git_repo
+    step_dir = repo / "workflows" / "test-workflow" / "steps" / "0001-first-step"
+    (step_dir / "main.py").write_text("def handler(input, sandgarden):\n    return {}\n")
+    git("mv", "workflows/test-workflow/steps/0001-first-step/prompts/old-name.txt",
+        "workflows/test-workflow/steps/0001-first-step/prompts/new-name.txt")
+    git("commit", "-q", "-am", "change")
+    (step_dir / "config.yml").write_text("description: untracked\n")
+    
+    from sync_to_sandgarden import get_changed_files_since
+    changed_files = get_changed_files_since("HEAD~1", repo)
+    
+    assert sorted(changed_files) == [
+        "workflows/test-workflow/steps/0001-first-step/config.yml",
+        "workflows/test-workflow/steps/0001-first-step/main.py",
+        "workflows/test-workflow/steps/0001-first-step/prompts/new-name.txt",
+        "workflows/test-workflow/steps/0001-first-step/prompts/old-name.txt"
+    ]
+
+def test_get_changed_files_since_unknown_ref(git_repo):
+    """Test that an unknown ref is an error."""
+    repo, _ = git_repo
+    from sync_to_sandgarden import get_changed_files_since
+    with pytest.raises(ValueError, match="Failed to diff against no-such-ref"):
+        get_changed_files_since("no-such-ref", repo)
+
+def test_sync_since_scopes_resources_missing_from_manifest(git_repo, tmp_path_factory):
+    """Test that --since decides what is pushed for steps and workflows the manifest doesn't know about."""
+    repo, git = git_repo
+    step_dir = repo / "workflows" / "test-workflow" / "steps" / "0001-first-step"
+    backend = MemoryBackend()
+    backend.resources["workflows"].append({"name": "test-workflow", "version": 1})
+    backend.resources["steps"].append({"name": "0001-first-step", "version": 1})
+    backend.resources["prompts"].append({"name": "old-name", "version": 1, "content": (step_dir / "prompts" / "old-name.txt").read_text()})
+    manifest_path = tmp_path_factory.mktemp("manifest") / "manifest.json"
+    
+    from sync_to_sandgarden import sync_to_sandgarden
+    with patch.dict(os.environ, {"SAND_API_KEY": "test-key", "GITHUB_WORKSPACE": str(repo)}):
+        sync_to_sandgarden("main", manifest_path=str(manifest_path), since="HEAD", backend=backend)
+        assert backend.pushes == []
+        
+        (step_dir / "main.py").write_text("def handler(input, sandgarden):\n    return {}\n")
+        git("commit", "-q", "-am", "change")
+        sync_to_sandgarden("main", manifest_path=str(manifest_path), since="HEAD~1", backend=backend)
+        assert sorted(backend.pushes) == [("steps", "0001-first-step"), ("workflows", "test-workflow")]
+
+@pytest.fixture
+def sand_api_server():
+    """Run a local stand-in for the Sandgarden REST API.
+    
+    Lists are served one resource per page, and pushes create a new version.
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs
+    
+    state = {"prompts": [], "workflows": [], "requests": []}
+    
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        
+        def log_message(self, *args):
+            pass
+        
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        
+        def do_GET(self):
+            url = urlparse(self.path)
+            resource_type = url.path.rsplit("/", 1)[-1]
+            state["requests"].append(("GET", self.path, self.headers["Authorization"]))
+            index = int(parse_qs(url.query).get("pageToken", ["0"])[0])
+            page = {resource_type: state[resource_type][index:index + 1]}
+            if index + 1 < len(state[resource_type]):
+                page["nextPageToken"] = str(index + 1)
+            self.send_json(200, page)
+        
+        def do_POST(self):
+            resource_type = self.path.rsplit("/", 1)[-1]
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            state["requests"].append(("POST", self.path, self.headers["Authorization"]))
+            version = 1 + sum(1 for r in state[resource_type] if r["name"] == body["name"])
+            resource = dict(body, version=version)
+            state[resource_type].append(resource)
+            self.send_json(201, resource)
+    
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/api/v1", state
+    server.shutdown()
+    server.server_close()
+
+def test_http_backend_push_and_list(sand_api_server):
+    """Test pushing and listing resources through the REST API."""
+    base_url, state = sand_api_server
+    from sync_to_sandgarden import HttpBackend, RemoteState
+    backend = HttpBackend("test-key", base_url)
+    
+    # Far larger than what fits in a single command line argument
+    content = "x" * (1024 * 1024)
+    assert backend.push("prompts", "big-prompt", {"content": content}, "main")["version"] == 1
+    assert backend.push("prompts", "big-prompt", {"content": content}, "main")["version"] == 2
+    assert backend.push("prompts", "other-prompt", {"content": "hi"}, "main")["version"] == 1
+    
+    remote = RemoteState(backend)
+    assert remote.latest("prompts", "big-prompt")["version"] == 2
+    assert remote.latest("prompts", "big-prompt")["content"] == content
+    assert remote.latest("prompts", "other-prompt")["version"] == 1
+    
+    # One request per page, all authenticated
+    assert [r[0] for r in state["requests"]] == ["POST", "POST", "POST", "GET", "GET", "GET"]
+    assert all(r[2] == "Bearer test-key" for r in state["requests"])
+
+def test_http_backend_push_workflow(sand_api_server):
+    """Test pushing a workflow through the REST API."""
+    base_url, state = sand_api_server
+    from sync_to_sandgarden import HttpBackend, update_resource
+    stages = [{"name": "stage1", "step": "step1:1", "input": "runInput"}]
+    
+    result = update_resource("workflows", "test-workflow", {"stages": stages}, "main", backend=HttpBackend("test-key", base_url))
+    
+    assert result["version"] == 1
+    assert state["workflows"][0]["stages"] == stages
+    assert state["workflows"][0]["tags"] == ["main"]
+
+def test_http_backend_push_step_uses_cli():
+    """Test that steps are still pushed with the CLI, which builds the image."""
+    from sync_to_sandgarden import HttpBackend
+    data = {"path": "steps/test-step", "prompts": [], "connectors": []}
+    with patch("subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 0
+        mock_run.return_value.stdout = '{"version": 3}'
+        
+        assert HttpBackend("test-key", "http://127.0.0.1:1").push("steps", "test-step", data, "main") == {"version": 3}
+        assert mock_run.call_args[0][0][1:4] == ["steps", "push", "docker"]
+
+def test_get_backend():
+    """Test backend selection."""
+    from sync_to_sandgarden import get_backend, CliBackend, HttpBackend
+    with patch.dict(os.environ, {"SAND_API_KEY": "test-key"}, clear=True):
+        assert isinstance(get_backend(), CliBackend)
+        assert isinstance(get_backend("http"), HttpBackend)
+    with patch.dict(os.environ, {"SAND_BACKEND": "http", "SAND_API_URL": "http://localhost:9000/api/v1/"}):
+        backend = get_backend()
+        assert isinstance(backend, HttpBackend)
+        assert backend.base_url == "http://localhost:9000/api/v1"
+    with pytest.raises(ValueError, match="Invalid backend: grpc"):
+        get_backend("grpc")
+
+def make_download(content, status_code=200):
+    """Build a mock streamed download response."""
+    response = Mock()
+    response.status_code = status_code
+    response.text = ""
+    response.iter_content.return_value = [content[i:i + 4] for i in range(0, len(content), 4)]
+    return response
+
+def test_download_sand_cli_caches_by_version(tmp_path):
+    """Test that a cached CLI is used without downloading it again."""
+    import hashlib
+    content = b"#!/bin/sh\necho sand\n"
+    checksum = hashlib.sha256(content).hexdigest()
+    
+    from sync_to_sandgarden import download_sand_cli
+    with patch("requests.get", return_value=make_download(content)) as mock_get:
+        path = download_sand_cli("1.2.3", tmp_path, sha256=checksum)
+        assert open(path, "rb").read() == content
+        assert os.access(path, os.X_OK)
+        assert "/1.2.3/" in path
+        assert mock_get.call_count == 1
+        
+        assert download_sand_cli("1.2.3", tmp_path, sha256=checksum) == path
+        assert mock_get.call_count == 1
+
+def test_download_sand_cli_rehashes_cached_binary(tmp_path):
+    """Test that a cached CLI changed since it was verified is downloaded again."""
+    import hashlib
+    content = b"#!/bin/sh\necho sand\n"
+    checksum = hashlib.sha256(content).hexdigest()
+    
+    from sync_to_sandgarden import download_sand_cli
+    with patch("requests.get", return_value=make_download(content)) as mock_get:
+        path = download_sand_cli("1.2.3", tmp_path, sha256=checksum)
+        with open(path, "wb") as f:
+            f.write(b"tampered")
+        assert download_sand_cli("1.2.3", tmp_path) == path
+        assert mock_get.call_count == 3
+    assert open(path, "rb").read() == content
+
+def test_download_sand_cli_warns_without_checksum(tmp_path, capsys):
+    """Test that a download with no checksum to verify it against is flagged."""
+    from sync_to_sandgarden import download_sand_cli
+    with patch("requests.get", side_effect=[Mock(status_code=404, text=""), make_download(b"binary")]):
+        download_sand_cli("1.2.3", tmp_path)
+    assert "can't be verified" in capsys.readouterr().out
+
+def test_download_sand_cli_checksum_mismatch(tmp_path):
+    """Test that a corrupt download is rejected and not cached."""
+    from sync_to_sandgarden import download_sand_cli
+    with patch("requests.get", return_value=make_download(b"corrupt")):
+        with pytest.raises(ValueError, match="Checksum mismatch"):
+            download_sand_cli("1.2.3", tmp_path, sha256="0" * 64)
+    
+    assert [p.name for p in tmp_path.rglob("*") if p.is_file()] == []
+
+def test_download_sand_cli_uses_published_checksum(tmp_path):
+    """Test that the checksum published next to the binary is verified."""
+    published = Mock(status_code=200, text="0" * 64 + "  sand_linux_amd64\n")
+    from sync_to_sandgarden import download_sand_cli
+    with patch("requests.get", side_effect=[published, make_download(b"binary")]):
+        with pytest.raises(ValueError, match="Checksum mismatch"):
+            download_sand_cli("1.2.3", tmp_path)
+
+def test_download_sand_cli_refreshes_latest(tmp_path):
+    """Test that a cached 'latest' CLI is downloaded again once it is too old."""
+    from sync_to_sandgarden import download_sand_cli
+    not_published = Mock(status_code=404, text="")
+    with patch("requests.get", side_effect=[not_published, make_download(b"v1"), not_published, make_download(b"v2")]) as mock_get:
+        path = download_sand_cli("latest", tmp_path)
+        assert download_sand_cli("latest", tmp_path) == path
+        assert mock_get.call_count == 2
+        
+        download_sand_cli("latest", tmp_path, max_age=-1)
+        assert mock_get.call_count == 4
+        assert open(path, "rb").read() == b"v2"
+
+def test_step_build_fingerprint(mock_prompts_dir, mock_step_dir):
+    """Test that only the build context changes the fingerprint."""
+    from sync_to_sandgarden import step_build_fingerprint
+    (mock_step_dir / "main.py").write_text("def handler(input, sandgarden): pass")
+    (mock_step_dir / "requirements.txt").write_text("requests")
+    before = step_build_fingerprint(mock_step_dir)
+    
+    # Prompts and bindings don't need a new image
+    (mock_prompts_dir / "test1.txt").write_text("Changed prompt")
+    (mock_step_dir / "config.yml").write_text("connectors: [other-connector]")
+    assert step_build_fingerprint(mock_step_dir) == before
+    
+    assert step_build_fingerprint(mock_step_dir, "python:3.12-slim") != before
+    (mock_step_dir / "requirements.txt").write_text("requests\npydantic")
+    assert step_build_fingerprint(mock_step_dir) != before
+
+def test_update_resource_step_with_image():
+    """Test that a step with a known image is registered without a build."""
+    with patch("subprocess.run") as mock_run:
+        mock_run.return_value.returncode = 0
+        mock_run.return_value.stdout = '{"version": 2}'
+        
+        data = {
+            "path": "steps/test-step",
+            "image": "registry.example.com/test-step@sha256:abc",
+            "prompts": [{"name": "prompt1", "version": 2}],
+            "connectors": ["connector1"]
+        }
+        
+        from sync_to_sandgarden import update_resource, sand_command
+        assert update_resource("steps", "test-step", data, "main") == {"version": 2}
+        
+        cmd = mock_run.call_args[0][0]
+        assert cmd[0:4] == [sand_command(), "steps", "create", "docker"]
+        assert cmd[cmd.index("--image") + 1] == "registry.example.com/test-step@sha256:abc"
+        assert "--file" not in cmd and "--sync" not in cmd
+        assert "prompt1:2" in cmd and "connector1" in cmd
+
+def test_sync_to_sandgarden_reuses_step_image(mock_workflows_dir, mock_steps_dir, tmp_path):
+    """Test that a step whose build context is unchanged reuses its image."""
+    manifest_path = tmp_path / "manifest.json"
+    pushes = []
+    
+    def update(resource_type, name, data, tag, dry_run=False, backend=None):
+        pushes.append((resource_type, name, data.get("image")))
+        return {"version": len(pushes), "image": f"image-of-{name}"}
+    
+    with patch.dict(os.environ, {
+        "SAND_API_KEY": "test-key",
+        "GITHUB_WORKSPACE": str(mock_workflows_dir.parent)
+    }), patch("sync_to_sandgarden.get_changed_files", return_value=[]), \
+    patch("sync_to_sandgarden.CliBackend.list_resources_async", return_value=[]), \
+    patch("sync_to_sandgarden.update_resource_async", side_effect=update):
+        from sync_to_sandgarden import sync_to_sandgarden
+        sync_to_sandgarden("main", manifest_path=str(manifest_path))
+        assert ("steps", "0001-first-step", None) in pushes
+        
+        # Only a prompt is added, the code stays the same
+        (mock_steps_dir / "0001-first-step" / "prompts" / "new.txt").write_text("New prompt")
+        pushes.clear()
+        sync_to_sandgarden("main", manifest_path=str(manifest_path))
+        assert ("steps", "0001-first-step", "image-of-0001-first-step") in pushes
+
+def test_sync_to_sandgarden_warns_without_step_image(mock_workflows_dir, mock_steps_dir, tmp_path, capsys):
+    """Test that a step push that reports no image is warned about, and nothing is recorded for reuse."""
+    manifest_path = tmp_path / "manifest.json"
+    
+    def update(resource_type, name, data, tag, dry_run=False, backend=None):
+        return {"version": 1}
+    
+    with patch.dict(os.environ, {
+        "SAND_API_KEY": "test-key",
+        "GITHUB_WORKSPACE": str(mock_workflows_dir.parent)
+    }), patch("sync_to_sandgarden.get_changed_files", return_value=[]), \
+    patch("sync_to_sandgarden.CliBackend.list_resources_async", return_value=[]), \
+    patch("sync_to_sandgarden.update_resource_async", side_effect=update):
+        from sync_to_sandgarden import sync_to_sandgarden
+        sync_to_sandgarden("main", manifest_path=str(manifest_path))
+    
+    assert "Warning: the push of step 0001-first-step didn't report its image" in capsys.readouterr().out
+    assert "images" not in json.loads(manifest_path.read_text())["resources"]
+
+def test_changed_file_index():
+    """Test file and directory lookups in the changed file index."""
+    from sync_to_sandgarden import ChangedFileIndex
+    index = ChangedFileIndex([
+        "workflows/wf/config.yml",
+        "workflows/wf/steps/0001-step/prompts/p.txt",
+        "workflows/wf/steps/0002-step/main.py",
+        "README.md"
+    ])
+    
+    assert len(index) == 4
+    assert "workflows/wf/config.yml" in index
+    assert "workflows/wf" not in index
+    assert "workflows/wf/steps/0001-step/prompts/other.txt" not in index
+    
+    assert index.has_changes_under("workflows/wf", exclude="steps")
+    assert not index.has_changes_under("workflows/wf/steps/0001-step", exclude="prompts")
+    assert index.has_changes_under("workflows/wf/steps/0001-step")
+    assert index.has_changes_under("workflows/wf/steps/0002-step", exclude="prompts")
+    assert not index.has_changes_under("workflows/other")
+
+def test_changed_file_index_matches_whole_segments():
+    """Test that a directory doesn't match a sibling sharing its prefix."""
+    from sync_to_sandgarden import ChangedFileIndex
+    index = ChangedFileIndex(["workflows/wf/steps/0001-step-two/main.py"])
+    
+    assert not index.has_changes_under("workflows/wf/steps/0001-step")
+    assert index.has_changes_under("workflows/wf/steps/0001-step-two")
+
+def test_find_workflows_builds_index_once(mock_workflows_dir, mock_steps_dir):
+    """Test that the changed files are indexed once for the whole tree."""
+    (mock_steps_dir / "0001-first-step" / "prompts" / "p.txt").write_text("prompt")
+    from sync_to_sandgarden import find_workflows, ChangedFileIndex
+    add = ChangedFileIndex.add
+    with patch("subprocess.run") as mock_run, \
+         patch.object(ChangedFileIndex, "add", autospec=True, side_effect=add) as mock_add:
+        mock_run.return_value.returncode = 0
+        mock_run.return_value.stdout = json.dumps({
+            "workflows": [{"name": "test-workflow", "version": 1}],
+            "steps": [{"name": "0001-first-step", "version": 1}, {"name": "0002-second-step", "version": 1}],
+            "prompts": [{"name": "p", "version": 1, "content": "prompt"}]
+        })
+        workflows = find_workflows(mock_workflows_dir.parent, ["workflows/test-workflow/config.yml"])
+        
+        assert mock_add.call_count == 1
+    # The index, not a scan of the list, marked the workflow and nothing below it
+    assert workflows[0]["updated"]
+    assert not any(step["updated"] for step in workflows[0]["steps"])
+
+def test_scan_workspace(mock_workflows_dir, mock_steps_dir):
+    """Test the typed model built from one walk of the workspace."""
+    (mock_steps_dir.parent / "config.yml").write_text(yaml.dump({"name": "Renamed", "step_version": "stable"}))
+    (mock_steps_dir / "0001-first-step" / "prompts" / "b.txt").write_text("Prompt B")
+    (mock_steps_dir / "0001-first-step" / "prompts" / "a.txt").write_text("Prompt A")
+    
+    from sync_to_sandgarden import scan_workspace, hash_tree
+    workspace = scan_workspace(mock_workflows_dir.parent)
+    
+    assert len(workspace.workflows) == 1
+    workflow = workspace.workflows[0]
+    assert workflow.name == "Renamed"
+    assert workflow.config["step_version"] == "stable"
+    assert workflow.hash == hash_tree(mock_steps_dir.parent, exclude=("steps",))
+    
+    assert [step.name for step in workflow.steps] == ["0001-first-step", "0002-second-step"]
+    first, second = workflow.steps
+    assert first.config["connectors"] == ["connector1", "connector2"]
+    assert first.input_schema == '{"type": "object"}'
+    assert first.output_schema is None
+    assert second.output_schema == '{"type": "object"}'
+    assert first.hash == hash_tree(first.path, exclude=("prompts",))
+    assert [(p.name, p.content) for p in first.prompts] == [("a", "Prompt A"), ("b", "Prompt B")]
+    
+    # Slotted, so the model stays compact
+    assert not hasattr(first, "__dict__")
+
+def test_scan_workspace_reads_each_file_once(mock_workflows_dir, mock_steps_dir):
+    """Test that discovery opens every file a single time."""
+    import builtins
+    from collections import Counter
+    (mock_steps_dir / "0001-first-step" / "prompts" / "p.txt").write_text("Prompt")
+    opened = Counter()
+    real_open = builtins.open
+    
+    def counting_open(file, *args, **kwargs):
+        opened[str(file)] += 1
+        return real_open(file, *args, **kwargs)
+    
+    from sync_to_sandgarden import find_workflows
+    with patch("subprocess.run") as mock_run, patch("builtins.open", counting_open), \
+         patch("pathlib.Path.read_bytes", lambda self: counting_open(self, "rb").read()):
+        mock_run.return_value.returncode = 1
+        workflows = find_workflows(mock_workflows_dir.parent, [])
+    
+    assert workflows[0]["config"] == {}
+    assert opened and max(opened.values()) == 1
+
+def test_profiler_records_phases(tmp_path):
+    """Test that phases are timed and written as JSON and Chrome traces."""
+    from sync_to_sandgarden import Profiler
+    profiler = Profiler()
+    with profiler.phase("list prompts", "remote lookups", resource_type="prompts") as record:
+        record["bytes"] = 120
+    with pytest.raises(ValueError):
+        with profiler.phase("steps:wf/s1", "push"):
+            raise ValueError("push failed")
+    
+    assert [r["result"] for r in profiler.phases] == ["ok", "error: push failed"]
+    summary = {total["category"]: total for total in profiler.summary()}
+    assert summary["remote lookups"]["bytes"] == 120
+    assert summary["push"]["errors"] == 1
+    assert "| remote lookups | 1 |" in profiler.summary_table()
+    
+    profiler.write(str(tmp_path / "profile.json"))
+    data = json.loads((tmp_path / "profile.json").read_text())
+    assert [p["name"] for p in data["phases"]] == ["list prompts", "steps:wf/s1"]
+    
+    profiler.write(str(tmp_path / "trace.json"), "chrome")
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert events[0]["ph"] == "X"
+    assert events[0]["args"] == {"resource_type": "prompts", "bytes": 120, "result": "ok"}
+
+def test_sync_to_sandgarden_profiles_phases(mock_workflows_dir, mock_steps_dir, tmp_path):
+    """Test that a sync records discovery, remote lookups and pushes."""
+    with patch.dict(os.environ, {
+        "SAND_API_KEY": "test-key",
+        "GITHUB_WORKSPACE": str(mock_workflows_dir.parent)
+    }), patch("sync_to_sandgarden.get_changed_files", return_value=[]), \
+    patch_sand_cli() as mock_run:
+        mock_run.return_value.returncode = 0
+        mock_run.return_value.stdout = '{"version": 1}'
+        
+        from sync_to_sandgarden import sync_to_sandgarden, profiler
+        sync_to_sandgarden("main", manifest_path=str(tmp_path / "manifest.json"))
+    
+    categories = {total["category"]: total for total in profiler.summary()}
+    assert set(categories) == {"changed files", "discovery", "remote lookups", "cli", "push"}
+    # Every resource type is listed up front
+    assert categories["remote lookups"]["calls"] == 3
+    assert categories["push"]["calls"] == 3
+
+def test_benchmark_against_fake_sand():
+    """Test that the benchmark syncs a synthetic workspace with the fake sand CLI."""
+    from benchmark_sync import benchmark, find_regressions
+    
+    cold, warm = benchmark(["1x2x1"], latency=0, jobs=2, change_fraction=0.5)
+    
+    assert cold["synced"] == {"prompts": 2, "steps": 2, "workflows": 1}
+    assert warm["changed_steps"] == 1
+    assert warm["synced"] == {"prompts": 0, "steps": 1, "workflows": 1}
+    assert "remote lookups" in {phase["category"] for phase in cold["phases"]}
+    
+    baseline = [dict(cold, seconds=cold["seconds"] / 10)]
+    assert find_regressions([cold, warm], baseline, 0.25) == [
+        f"1x2x1 cold: {cold['seconds'] / 10:.2f}s -> {cold['seconds']:.2f}s"
+    ]
+
+def test_sync_to_sandgarden_overlaps_lookups(mock_workflows_dir, mock_steps_dir, tmp_path):
+    """Test that change detection and every remote listing run at the same time."""
+    import threading
+    from sync_to_sandgarden import sync_to_sandgarden
+    # Only passes once all four calls are waiting on it together
+    barrier = threading.Barrier(4, timeout=5)
+    
+    class Backend(MemoryBackend):
+        def list_resources(self, resource_type, name=None):
+            barrier.wait()
+            return []
+    
+    def get_changed_files():
+        barrier.wait()
+        return []
+    
+    with patch.dict(os.environ, {
+        "SAND_API_KEY": "test-key",
+        "GITHUB_WORKSPACE": str(mock_workflows_dir.parent)
+    }), patch("sync_to_sandgarden.get_changed_files", side_effect=get_changed_files):
+        synced = sync_to_sandgarden("main", dry_run=True, backend=Backend(), manifest_path=str(tmp_path / "manifest.json"))
+    
+    assert synced["workflows"] == ["test-workflow"]
+
+def test_sand_backend_is_abstract():
+    """Test that a backend must implement listing, pushing and describing."""
+    class ListOnly(SandBackend):
+        def list_resources(self, resource_type, name=None):
+            return []
+    
+    with pytest.raises(TypeError, match="describe, push"):
+        ListOnly()
+
+class MemoryBackend(SandBackend):
+    """Sandgarden stand-in that keeps every pushed version in memory."""
+    
+    def __init__(self):
+        self.resources = {resource_type: [] for resource_type in RESOURCE_TYPES}
+        self.pushes = []
+        self.lookups = []
+    
+    def list_resources(self, resource_type, name=None):
+        self.lookups.append((resource_type, name))
+        return [r for r in self.resources[resource_type] if name in (None, r["name"])]
+    
+    def push(self, resource_type, name, data, tag):
+        version = 1 + sum(r["name"] == name for r in self.resources[resource_type])
+        self.resources[resource_type].append({"name": name, "version": version, "data": data})
+        self.pushes.append((resource_type, name))
+        return {"version": version}
+    
+    def describe(self, resource_type, name, data, tag):
+        return name
+
+def test_sync_pushes_drift_without_manifest(mock_workflows_dir, mock_steps_dir, tmp_path):
+    """Test that a prompt that differs from Sandgarden is pushed, and only then recorded, without a manifest."""
+    from sync_to_sandgarden import sync_to_sandgarden, SyncManifest, hash_tree
+    prompt_file = mock_steps_dir / "0001-first-step" / "prompts" / "greeting.txt"
+    prompt_file.write_text("NEW content")
+    backend = MemoryBackend()
+    backend.resources["prompts"].append({"name": "greeting", "version": 1, "content": "OLD content"})
+    manifest_path = tmp_path / "manifest.json"
+    
+    with patch.dict(os.environ, {
+        "SAND_API_KEY": "test-key",
+        "GITHUB_WORKSPACE": str(mock_workflows_dir.parent)
+    }), patch("sync_to_sandgarden.get_changed_files", return_value=[]):
+        sync_to_sandgarden("main", manifest_path=str(manifest_path), backend=backend)
+        assert ("prompts", "greeting") in backend.pushes
+        assert SyncManifest(manifest_path).is_current("prompts", "greeting", hash_tree(prompt_file), 2)
+        
+        backend.pushes.clear()
+        sync_to_sandgarden("main", manifest_path=str(manifest_path), backend=backend)
+        assert backend.pushes == []
+
+def test_plan_then_apply(mock_workflows_dir, mock_steps_dir, tmp_path):
+    """Test that an applied plan pushes what was planned without discovering it again."""
+    from sync_to_sandgarden import plan_sync, apply_plan, write_plan, read_plan, planned_resources
+    backend = MemoryBackend()
+    with patch.dict(os.environ, {
+        "SAND_API_KEY": "test-key",
+        "GITHUB_WORKSPACE": str(mock_workflows_dir.parent)
+    }), patch("sync_to_sandgarden.get_changed_files", return_value=[]):
+        plan = plan_sync("main", manifest_path=str(tmp_path / "manifest.json"), backend=backend)
+        assert backend.pushes == []
+        assert plan["remote_versions"]["steps"] == {"0001-first-step": None, "0002-second-step": None}
+        assert [node["id"] for node in plan["graph"]][-1] == "workflows:test-workflow"
+        
+        write_plan(plan, str(tmp_path / "plan.json"))
+        with patch("sync_to_sandgarden.scan_workspace", side_effect=AssertionError("rediscovered")), \
+             patch("sync_to_sandgarden.get_changed_files", side_effect=AssertionError("rediscovered")):
+            synced = apply_plan(read_plan(str(tmp_path / "plan.json")), manifest_path=str(tmp_path / "manifest.json"), backend=backend)
+    
+    assert synced == planned_resources(plan)
+    assert backend.pushes[-1] == ("workflows", "test-workflow")
+    resources = json.loads((tmp_path / "manifest.json").read_text())["resources"]
+    assert resources["steps"]["0001-first-step"]["version"] == 1
+
+def test_apply_refuses_drifted_plan(mock_workflows_dir, mock_steps_dir, tmp_path):
+    """Test that a plan is not applied once Sandgarden or the steps changed."""
+    from sync_to_sandgarden import plan_sync, apply_plan
+    backend = MemoryBackend()
+    with patch.dict(os.environ, {
+        "SAND_API_KEY": "test-key",
+        "GITHUB_WORKSPACE": str(mock_workflows_dir.parent)
+    }), patch("sync_to_sandgarden.get_changed_files", return_value=[]):
+        plan = plan_sync("main", manifest_path=str(tmp_path / "manifest.json"), backend=backend)
+        backend.resources["steps"].append({"name": "0002-second-step", "version": 1})
+        (mock_steps_dir / "0001-first-step" / "main.py").write_text("changed")
+        
+        with pytest.raises(ValueError) as error:
+            apply_plan(plan, manifest_path=str(tmp_path / "manifest.json"), backend=backend)
+    
+    assert "steps 0002-second-step is at version 1 in Sandgarden, the plan expected None" in str(error.value)
+    assert "steps 0001-first-step" in str(error.value)
+    assert backend.pushes == []
+
+def shard_workflow(name, steps):
+    """Build a discovered workflow using the given step and prompt names."""
+    return {"name": name, "steps": [
+        {"name": step, "prompts": [{"name": prompt} for prompt in prompts]}
+        for step, prompts in steps.items()
+    ]}
+
+def test_assign_shards_keeps_shared_resources_together():
+    """Test that workflows sharing a step or prompt land in the same shard."""
+    from sync_to_sandgarden import assign_shards, workflow_components
+    workflows = [
+        shard_workflow("a", {"a-step": ["shared-prompt"]}),
+        shard_workflow("b", {"b-step": ["shared-prompt"]}),
+        shard_workflow("c", {"shared-step": []}),
+        shard_workflow("d", {"shared-step": [], "d-step": []}),
+        shard_workflow("e", {"e-step": []})
+    ]
+    
+    assert [[w["name"] for w in c] for c in workflow_components(workflows)] == [["a", "b"], ["c", "d"], ["e"]]
+    
+    assignment = assign_shards(workflows, 2)
+    assert assignment["a"] == assignment["b"]
+    assert assignment["c"] == assignment["d"]
+    assert set(assignment.values()) == {1, 2}
+    # Every runner computes the same assignment, whatever the order
+    assert assign_shards(list(reversed(workflows)), 2) == assignment
+
+def test_assign_shards_balances_with_timings():
+    """Test that previous push times decide how workflows are spread."""
+    from sync_to_sandgarden import assign_shards
+    workflows = [shard_workflow(name, {f"{name}-step": []}) for name in "abcd"]
+    
+    assignment = assign_shards(workflows, 2, {"a": 30.0, "b": 10.0, "c": 10.0, "d": 10.0})
+    assert {name for name, shard in assignment.items() if shard == assignment["a"]} == {"a"}
+
+def test_assign_shards_warns_when_one_group_dominates(capsys):
+    """Test that a shared resource pulling most workflows into one shard is reported."""
+    from sync_to_sandgarden import assign_shards
+    workflows = [shard_workflow(name, {f"{name}-step": ["shared-prompt"]}) for name in "abc"]
+    workflows.append(shard_workflow("d", {"d-step": []}))
+    
+    assignment = assign_shards(workflows, 2)
+    assert assignment["a"] == assignment["b"] == assignment["c"] != assignment["d"]
+    assert "Warning: workflows a, b, c share steps or prompts and take 86% of the sync" in capsys.readouterr().out
+    
+    assign_shards([shard_workflow(name, {f"{name}-step": []}) for name in "abcd"], 2)
+    assert "Warning" not in capsys.readouterr().out
+
+def test_parse_shard():
+    """Test parsing of --shard values."""
+    from sync_to_sandgarden import parse_shard
+    assert parse_shard("2/4") == (2, 4)
+    for value in ("0/4", "5/4", "2", "a/b"):
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+def test_sharded_sync_pushes_each_resource_once(mock_workflows_dir, mock_steps_dir, tmp_path):
+    """Test that the shards of a sync together push every resource exactly once."""
+    import shutil
+    from sync_to_sandgarden import sync_to_sandgarden, build_report, merge_reports, merge_timings
+    for name in ("other-workflow", "third-workflow"):
+        shutil.copytree(mock_workflows_dir / "test-workflow", mock_workflows_dir / name)
+    (mock_workflows_dir / "third-workflow" / "steps" / "0001-first-step").rename(mock_workflows_dir / "third-workflow" / "steps" / "0001-third-step")
+    (mock_workflows_dir / "third-workflow" / "steps" / "0002-second-step").rename(mock_workflows_dir / "third-workflow" / "steps" / "0002-fourth-step")
+    backend = MemoryBackend()
+    
+    reports = []
+    pushed_by = []
+    with patch.dict(os.environ, {
+        "SAND_API_KEY": "test-key",
+        "GITHUB_WORKSPACE": str(mock_workflows_dir.parent)
+    }), patch("sync_to_sandgarden.get_changed_files", return_value=[]):
+        for shard in (1, 2):
+            backend.pushes.clear()
+            synced = sync_to_sandgarden("main", manifest_path=str(tmp_path / f"manifest-{shard}.json"), backend=backend, shard=(shard, 2))
+            reports.append(build_report(synced, (shard, 2)))
+            pushed_by.append(set(backend.pushes))
+    
+    # test-workflow and other-workflow share their steps, so one shard pushes both
+    assert not pushed_by[0] & pushed_by[1]
+    assert len(pushed_by[0] | pushed_by[1]) == 7
+    
+    message, succeeded = merge_reports(reports)
+    assert succeeded
+    assert "| 1/2 |" in message and "| 2/2 |" in message
+    assert set(merge_timings({"gone": 1.0}, reports)) == {"gone", "test-workflow", "other-workflow", "third-workflow"}
+
+@pytest.fixture
+def shared_step_workspace(mock_workflows_dir, mock_steps_dir):
+    """Add a second workflow with the same steps and prompts as test-workflow."""
+    import shutil
+    (mock_steps_dir / "0001-first-step" / "prompts" / "greeting.txt").write_text("Hello")
+    shutil.copytree(mock_workflows_dir / "test-workflow", mock_workflows_dir / "other-workflow")
+    with patch.dict(os.environ, {
+        "SAND_API_KEY": "test-key",
+        "GITHUB_WORKSPACE": str(mock_workflows_dir.parent)
+    }), patch("sync_to_sandgarden.get_changed_files", return_value=[]):
+        yield mock_workflows_dir
+
+def assert_shared_once(backend):
+    """Check that shared steps and prompts were pushed once and referenced at one version."""
+    assert sorted(backend.pushes) == sorted(set(backend.pushes))
+    assert ("prompts", "greeting") in backend.pushes
+    stages = [r["data"]["stages"] for r in backend.resources["workflows"]]
+    assert len(stages) == 2 and stages[0] == stages[1]
+    assert stages[0][0]["step"] == "0001-first-step:1"
+
+def test_sync_pushes_shared_resources_once(shared_step_workspace, tmp_path):
+    """Test that steps and prompts shared by two workflows are pushed once."""
+    from sync_to_sandgarden import sync_to_sandgarden
+    backend = MemoryBackend()
+    sync_to_sandgarden("main", manifest_path=str(tmp_path / "manifest.json"), backend=backend)
+    
+    assert_shared_once(backend)
+
+def test_applied_plan_pushes_shared_resources_once(shared_step_workspace, tmp_path):
+    """Test that a plan read back from JSON still pushes shared resources once."""
+    from sync_to_sandgarden import plan_sync, apply_plan, write_plan, read_plan
+    backend = MemoryBackend()
+    plan = plan_sync("main", manifest_path=str(tmp_path / "manifest.json"), backend=backend)
+    write_plan(plan, str(tmp_path / "plan.json"))
+    apply_plan(read_plan(str(tmp_path / "plan.json")), manifest_path=str(tmp_path / "manifest.json"), backend=backend)
+    
+    assert_shared_once(backend)
+
+def test_retry_policy_backs_off_and_honors_retry_after():
+    """Test that retries wait with backoff, or as long as the service asked."""
+    from sync_to_sandgarden import RetryPolicy, RetryableError
+    policy = RetryPolicy("test", attempts=4, base_delay=1, max_delay=3)
+    errors = [RetryableError("busy", retry_after=7), RetryableError("down"), RetryableError("down")]
+    
+    def attempt():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+    
+    with patch("sync_to_sandgarden.time.sleep") as mock_sleep:
+        assert policy.call(attempt) == "ok"
+    
+    waits = [c[0][0] for c in mock_sleep.call_args_list]
+    assert waits[0] == 7
+    assert 0 <= waits[1] <= 2 and 0 <= waits[2] <= 3
+
+def test_retry_policy_gives_up_with_last_result():
+    """Test that the result of the last try is returned once retries run out."""
+    from sync_to_sandgarden import RetryPolicy, RetryableError
+    policy = RetryPolicy("test", attempts=3)
+    calls = []
+    
+    def attempt():
+        calls.append(1)
+        raise RetryableError("down", result="last response")
+    
+    with patch("sync_to_sandgarden.time.sleep"):
+        assert policy.call(attempt) == "last response"
+    assert len(calls) == 3
+
+def test_retry_policy_circuit_breaker():
+    """Test that calls wait out the cooldown after calls failed in a row, and probe again."""
+    from sync_to_sandgarden import RetryPolicy, RetryableError
+    policy = RetryPolicy("test", attempts=3, breaker_threshold=2, breaker_cooldown=30)
+    clock = [100.0]
+    
+    def sleep(seconds):
+        clock[0] += seconds
+    
+    def failing():
+        raise RetryableError("down")
+    
+    with patch("sync_to_sandgarden.time.monotonic", side_effect=lambda: clock[0]), \
+         patch("sync_to_sandgarden.time.sleep", side_effect=sleep):
+        # One call running out of retries doesn't open the circuit
+        with pytest.raises(RetryableError):
+            policy.call(failing)
+        assert policy.circuit_wait() == 0
+        with pytest.raises(RetryableError):
+            policy.call(failing)
+        opened = clock[0]
+        assert policy.circuit_wait() == pytest.approx(30)
+        
+        # The next call waits for the cooldown instead of failing
+        assert policy.call(lambda: "ok") == "ok"
+        assert clock[0] >= opened + 30
+        assert policy.circuit_wait() == 0
+
+def test_retry_policy_failed_probe_reopens_circuit():
+    """Test that a failed probe after the cooldown pauses calls again."""
+    from sync_to_sandgarden import RetryPolicy, RetryableError
+    policy = RetryPolicy("test", attempts=1, breaker_threshold=1, breaker_cooldown=30)
+    
+    def failing():
+        raise RetryableError("down")
+    
+    with patch("sync_to_sandgarden.time.monotonic", return_value=100), \
+         patch("sync_to_sandgarden.time.sleep"):
+        with pytest.raises(RetryableError):
+            policy.call(failing)
+    with patch("sync_to_sandgarden.time.monotonic", return_value=131):
+        assert policy.circuit_wait() == 0
+        # Only one call probes, the others wait for it
+        assert policy.circuit_wait() > 0
+        policy.end_probe()
+        with pytest.raises(RetryableError):
+            policy.call(failing)
+        assert policy.circuit_wait() == pytest.approx(30)
+
+def test_cli_backend_retries_transient_failures():
+    """Test that a rate limited sand command is run again."""
+    from sync_to_sandgarden import CliBackend
+    results = [
+        Mock(returncode=1, stdout="", stderr="Error: 429 Too Many Requests"),
+        Mock(returncode=0, stdout=json.dumps({"prompts": [{"name": "a", "version": 1}]}), stderr="")
+    ]
+    with patch("subprocess.run", side_effect=results) as mock_run, \
+         patch("sync_to_sandgarden.time.sleep") as mock_sleep:
+        assert CliBackend().list_resources("prompts") == [{"name": "a", "version": 1}]
+        assert mock_run.call_count == 2
+        mock_sleep.assert_called_once()
+
+def test_cli_backend_does_not_retry_other_failures():
+    """Test that a command failing for another reason is not run again."""
+    from sync_to_sandgarden import CliBackend
+    with patch("subprocess.run") as mock_run:
+        mock_run.return_value = Mock(returncode=1, stdout="", stderr="Error: invalid prompt name")
+        with pytest.raises(ValueError):
+            CliBackend().push("prompts", "bad name", {"content": "x"}, "main")
+        assert mock_run.call_count == 1
+
+def test_cli_backend_does_not_retry_ambiguous_push_failures():
+    """Test that a push that timed out is not run again, since it may have created a version."""
+    from sync_to_sandgarden import CliBackend
+    with patch("subprocess.run") as mock_run, \
+         patch("sync_to_sandgarden.time.sleep"):
+        mock_run.return_value = Mock(returncode=1, stdout="", stderr="Error: request timed out")
+        with pytest.raises(ValueError):
+            CliBackend().push("prompts", "p", {"content": "x"}, "main")
+        assert mock_run.call_count == 1
+
+def test_http_backend_retries_unavailable():
+    """Test that a 503 from the API is retried after its Retry-After, but not for a push."""
+    from sync_to_sandgarden import HttpBackend
+    responses = [
+        make_response(503, headers={"Retry-After": "3"}),
+        make_response(200, {"prompts": [{"name": "p", "version": 1}]})
+    ]
+    for response in responses:
+        response.content = b""
+    backend = HttpBackend("key", "https://sand.example.com")
+    with patch("requests.Session.request", side_effect=responses), \
+         patch("sync_to_sandgarden.time.sleep") as mock_sleep:
+        assert backend.list_resources("prompts") == [{"name": "p", "version": 1}]
+        mock_sleep.assert_called_once_with(3.0)
+    
+    response = make_response(503, text="unavailable")
+    response.content = b""
+    with patch("requests.Session.request", return_value=response) as mock_request:
+        with pytest.raises(ValueError):
+            backend.push("prompts", "p", {"content": "Hello"}, "main")
+        assert mock_request.call_count == 1
+
+def test_http_backend_retries_rate_limited_push():
+    """Test that a rate limited push is retried after its Retry-After."""
+    from sync_to_sandgarden import HttpBackend
+    responses = [
+        make_response(429, headers={"Retry-After": "3"}),
+        make_response(201, {"name": "p", "version": 2})
+    ]
+    for response in responses:
+        response.content = b""
+    backend = HttpBackend("key", "https://sand.example.com")
+    with patch("requests.Session.request", side_effect=responses), \
+         patch("sync_to_sandgarden.time.sleep") as mock_sleep:
+        assert backend.push("prompts", "p", {"content": "Hello"}, "main") == {"name": "p", "version": 2}
+        mock_sleep.assert_called_once_with(3.0)
+    # Backed off under pressure, then grew again
+    assert backend.budget().limit == backend.budget().maximum // 2 + 1
+
+def test_github_client_retries_server_errors():
+    """Test that a GitHub 502 is retried."""
+    from sync_to_sandgarden import GitHubClient
+    responses = [make_response(502), make_response(200, [])]
+    with patch("requests.Session.request", side_effect=responses), \
+         patch("sync_to_sandgarden.time.sleep"):
+        assert GitHubClient("token").get("https://api.github.com/x").status_code == 200
+
+def test_concurrency_budget_adapts():
+    """Test that the budget bounds concurrent calls to its current limit."""
+    import asyncio
+    from sync_to_sandgarden import ConcurrencyBudget
+    budget = ConcurrencyBudget(4)
+    budget.shrink()
+    assert budget.limit == 2
+    running = []
+    peak = []
+    
+    async def call():
+        async with budget:
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+    
+    async def main():
+        await asyncio.gather(*(call() for _ in range(6)))
+    
+    asyncio.run(main())
+    assert max(peak) == 2
+    budget.grow()
+    budget.grow()
+    budget.grow()
+    assert budget.limit == 4
+
+def test_classify_change(tmp_path):
+    """Test that changed paths map to the smallest resource they belong to."""
+    from sync_to_sandgarden import classify_change
+    workflows = tmp_path / "workflows"
+    assert classify_change(str(workflows / "wf" / "steps" / "0001-step" / "prompts" / "greeting.txt"), tmp_path) == ("prompts", "wf", "0001-step", "greeting")
+    assert classify_change(str(workflows / "wf" / "steps" / "0001-step" / "main.py"), tmp_path) == ("steps", "wf", "0001-step", None)
+    assert classify_change(str(workflows / "wf" / "steps" / "0001-step" / "prompts" / "sub" / "x.txt"), tmp_path) == ("steps", "wf", "0001-step", None)
+    assert classify_change(str(workflows / "wf" / "config.yml"), tmp_path) == ("workflows", "wf", None, None)
+    for ignored in ("wf/steps/0001-step/.main.py.swp", "wf/config.yml~", "wf/steps/0001-step/__pycache__/main.pyc", "wf"):
+        assert classify_change(str(workflows / ignored), tmp_path) is None
+    assert classify_change(str(tmp_path / "README.md"), tmp_path) is None
+
+class FakeWatcher:
+    """Watcher returning prepared batches of changed paths, after saving the files they name."""
+    
+    def __init__(self, batches, save):
+        self.batches = list(batches)
+        self.save = save
+        self.closed = False
+    
+    def read(self, timeout):
+        if not self.batches:
+            return []
+        self.save()
+        return self.batches.pop(0)
+    
+    def close(self):
+        self.closed = True
+
+def test_watch_pushes_only_what_changed(shared_step_workspace, tmp_path):
+    """Test that a saved prompt pushes the prompt, its step and its workflow only."""
+    import asyncio
+    from sync_to_sandgarden import watch_async
+    backend = MemoryBackend()
+    prompt = shared_step_workspace / "test-workflow" / "steps" / "0001-first-step" / "prompts" / "greeting.txt"
+    # An editor swap file alone is not a change, then the prompt is saved twice within the debounce
+    watcher = FakeWatcher([[str(prompt.parent / ".greeting.txt.swp")], [str(prompt)], [str(prompt)]], lambda: prompt.write_text("Hello again"))
+    
+    asyncio.run(watch_async("main", manifest_path=str(tmp_path / "manifest.json"), backend=backend, debounce=0, watcher=watcher, rounds=1))
+    
+    # The initial sync pushes the shared prompt and steps once, and both workflows
+    assert len(backend.pushes) == 5 + 3
+    assert backend.pushes[5:] == [("prompts", "greeting"), ("steps", "0001-first-step"), ("workflows", "test-workflow")]
+    assert watcher.closed
+
+def test_watch_stops_while_waiting(shared_step_workspace, tmp_path):
+    """Test that cancelling the watch, as Ctrl-C does, ends it while it waits for changes."""
+    import asyncio
+    from sync_to_sandgarden import watch_async
+    watcher = FakeWatcher([], lambda: None)
+    
+    async def watch_then_cancel():
+        task = asyncio.create_task(watch_async("main", manifest_path=str(tmp_path / "manifest.json"), backend=MemoryBackend(), watcher=watcher))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(task, timeout=5)
+    
+    with patch("sync_to_sandgarden.WATCH_POLL_INTERVAL", 0.01):
+        asyncio.run(watch_then_cancel())
+    assert watcher.closed
+
+@pytest.mark.skipif(platform.system() != "Linux", reason="inotify is Linux only")
+def test_inotify_watcher_sees_new_directories(tmp_path):
+    """Test that files written in directories created after the watch started are seen."""
+    from sync_to_sandgarden import InotifyWatcher, wait_for_changes
+    watcher = InotifyWatcher(tmp_path)
+    try:
+        (tmp_path / "config.yml").write_text("name: x")
+        assert str(tmp_path / "config.yml") in wait_for_changes(watcher, debounce=0.05)
+        
+        step_dir = tmp_path / "steps" / "0001-step"
+        step_dir.mkdir(parents=True)
+        (step_dir / "main.py").write_text("pass")
+        changed = wait_for_changes(watcher, debounce=0.05)
+        # Either from the event or from scanning the new directory
+        assert str(step_dir / "main.py") in changed or str(step_dir) in changed
+        
+        (step_dir / "main.py").write_text("changed")
+        assert str(step_dir / "main.py") in wait_for_changes(watcher, debounce=0.05)
+    finally:
+        watcher.close()
+
+def test_parse_selector():
+    """Test parsing of --only selectors."""
+    from sync_to_sandgarden import parse_selector
+    assert parse_selector("prompt:greeting") == ("prompts", "greeting")
+    assert parse_selector("steps:0001-*") == ("steps", "0001-*")
+    assert parse_selector("test-workflow") == (None, "test-workflow")
+    for value in ("connector:x", "prompt:", ""):
+        with pytest.raises(ValueError):
+            parse_selector(value)
+
+@pytest.fixture
+def unrelated_workflow(shared_step_workspace):
+    """Add a third workflow sharing nothing with the other two."""
+    import shutil
+    unrelated = shared_step_workspace / "unrelated-workflow"
+    shutil.copytree(shared_step_workspace / "test-workflow", unrelated)
+    shutil.rmtree(unrelated / "steps" / "0001-first-step")
+    (unrelated / "steps" / "0002-second-step").rename(unrelated / "steps" / "0002-third-step")
+    return shared_step_workspace
+
+def test_select_workflows_closure(unrelated_workflow):
+    """Test that a prompt selects the steps binding it and every workflow using them."""
+    from sync_to_sandgarden import select_workflows
+    workspace_path = unrelated_workflow.parent
+    
+    dirs, names = select_workflows(workspace_path, [("prompts", "greet*")])
+    assert [d.name for d in dirs] == ["other-workflow", "test-workflow"]
+    assert names == {
+        "workflows": ["other-workflow", "test-workflow"],
+        "steps": ["0001-first-step", "0002-second-step"],
+        "prompts": ["greeting"]
+    }
+    
+    dirs, names = select_workflows(workspace_path, [("steps", "0002-third-step")])
+    assert [d.name for d in dirs] == ["unrelated-workflow"]
+    dirs, _ = select_workflows(workspace_path, [(None, "unrelated-workflow")])
+    assert [d.name for d in dirs] == ["unrelated-workflow"]
+    
+    with pytest.raises(ValueError):
+        select_workflows(workspace_path, [("prompts", "missing")])
+
+def test_sync_only_looks_up_the_closure(unrelated_workflow, tmp_path):
+    """Test that a selected sync scans and looks up nothing outside its closure."""
+    from sync_to_sandgarden import sync_to_sandgarden, scan_workflow
+    backend = MemoryBackend()
+    scanned = []
+    
+    def scan(workflow_dir):
+        scanned.append(workflow_dir.name)
+        return scan_workflow(workflow_dir)
+    
+    with patch("sync_to_sandgarden.scan_workflow", side_effect=scan):
+        synced = sync_to_sandgarden("main", manifest_path=str(tmp_path / "manifest.json"), backend=backend, only=[("prompts", "greeting")])
+    
+    assert sorted(scanned) == ["other-workflow", "test-workflow"]
+    assert sorted(synced["workflows"]) == ["other-workflow", "test-workflow"]
+    assert ("prompts", "greeting") in backend.lookups
+    assert all(name is not None and "third" not in name and "unrelated" not in name for _, name in backend.lookups)
+    assert_shared_once(backend)
+
+def test_warm_sync_reads_remote_state_from_cache(shared_step_workspace, tmp_path):
+    """Test that a sync within the TTL of the remote cache lists nothing."""
+    from sync_to_sandgarden import sync_to_sandgarden, RemoteStateCache
+    backend = MemoryBackend()
+    sync_to_sandgarden("main", manifest_path=str(tmp_path / "manifest.json"), backend=backend, remote_cache=RemoteStateCache(tmp_path / "remote.json"))
+    assert len(backend.lookups) == 3
+    
+    backend.lookups.clear()
+    backend.pushes.clear()
+    (shared_step_workspace / "test-workflow" / "steps" / "0001-first-step" / "prompts" / "greeting.txt").write_text("Hi")
+    (shared_step_workspace / "other-workflow" / "steps" / "0001-first-step" / "prompts" / "greeting.txt").write_text("Hi")
+    sync_to_sandgarden("main", manifest_path=str(tmp_path / "manifest.json"), backend=backend, remote_cache=RemoteStateCache(tmp_path / "remote.json"))
+    
+    assert backend.lookups == []
+    assert sorted(backend.pushes) == [("prompts", "greeting"), ("steps", "0001-first-step"), ("workflows", "other-workflow"), ("workflows", "test-workflow")]
+    # The versions pushed by the first sync were remembered
+    assert [r["version"] for r in backend.resources["prompts"]] == [1, 2]
+    cached = json.loads((tmp_path / "remote.json").read_text())["types"]
+    assert cached["prompts"]["resources"]["greeting"]["version"] == 2
+
+def test_remote_cache_revalidates_with_etag(tmp_path):
+    """Test that a stale cache is revalidated with its ETag, and dropped after a foreign push."""
+    import asyncio
+    from sync_to_sandgarden import RemoteState, RemoteStateCache
+    
+    class Backend(MemoryBackend):
+        etags = []
+        
+        def list_resources_if_changed(self, resource_type, etag=None):
+            self.etags.append(etag)
+            return (None, etag) if etag == "v1" else (self.list_resources(resource_type), "v1")
+    
+    backend = Backend()
+    backend.resources["prompts"].append({"name": "greeting", "version": 3})
+    cache = RemoteStateCache(tmp_path / "remote.json", ttl=0)
+    asyncio.run(RemoteState(backend, cache).load_async(["prompts"]))
+    cache.save()
+    
+    cache = RemoteStateCache(tmp_path / "remote.json", ttl=0)
+    remote = RemoteState(backend, cache)
+    assert remote.latest("prompts", "greeting")["version"] == 3
+    assert backend.etags == [None, "v1"]
+    
+    # Someone else pushed version 4 in between
+    remote.remember("prompts", {"name": "greeting", "version": 5})
+    assert cache.etag("prompts") is None and cache.fresh("prompts") is None
+    cache.ttl = 60
+    assert cache.fresh("prompts") is None
+
+def test_http_backend_list_not_modified():
+    """Test that a listing with a matching ETag is reported as unchanged."""
+    from sync_to_sandgarden import HttpBackend
+    response = make_response(304)
+    response.content = b""
+    with patch("requests.Session.request", return_value=response) as mock_request:
+        assert HttpBackend("key", "https://sand.example.com").list_resources_if_changed("steps", '"abc"') == (None, '"abc"')
+    assert mock_request.call_args[1]["headers"] == {"If-None-Match": '"abc"'}
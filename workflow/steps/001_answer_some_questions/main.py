@@ -1,34 +1,296 @@
+import os
+import sys
 import json
+import math
+import mmap
 import random
+import struct
+import itertools
+import hashlib
+import tempfile
 import requests
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+DATASET_URL = "https://raw.githubusercontent.com/google-research-datasets/cf_triviaqa/refs/heads/main/har_dataset.jsonl"
+# Number of questions answered when the run input doesn't say
+DEFAULT_SAMPLE_SIZE = 20
+# Number of questions answered at the same time when the run input doesn't say
+DEFAULT_CONCURRENCY = 8
+# Run input the second step reads, passed on with the answers since it only sees this step's output
+JUDGE_SETTINGS = ("concurrency", "requests_per_minute", "tokens_per_minute")
+# Where downloaded datasets are kept between runs
+DATASET_CACHE = os.environ.get("TRIVIA_DATASET_CACHE", os.path.join(Path.home(), ".cache", "sandgarden-datasets"))
+# Header of dataset indexes: magic, rows, keys, size and mtime of the dataset they index.
+# Indexes are written in native byte order, they are only read where they are built.
+INDEX_MAGIC = b"TQAIDX01"
+INDEX_HEADER = struct.Struct("=8sQQQq")
+
+def fetch_dataset(source):
+    """Return a local path for the dataset, downloading it only if it changed.
+
+    The source can be a URL (the default dataset, or a mirror of it) or a
+    local file, which is used as is. Downloads are cached by URL and
+    revalidated with ETag / If-Modified-Since. If the network is
+    unavailable, the cached copy is used.
+    """
+    if not source.startswith(("http://", "https://")):
+        return Path(source)
+
+    cache_dir = Path(DATASET_CACHE)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    key = hashlib.sha256(source.encode()).hexdigest()[:16]
+    path = cache_dir / f"{key}.jsonl"
+    meta_path = cache_dir / f"{key}.json"
+    meta = json.loads(meta_path.read_text()) if meta_path.exists() and path.exists() else {}
+
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    try:
+        with requests.get(source, headers=headers, stream=True, timeout=30) as response:
+            if response.status_code == 304:
+                return path
+            response.raise_for_status()
+            # Write next to the cached copy and swap it in once complete
+            tmp = tempfile.NamedTemporaryFile(dir=cache_dir, delete=False)
+            try:
+                with tmp:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        tmp.write(chunk)
+                os.replace(tmp.name, path)
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
+            meta_path.write_text(json.dumps({
+                "url": source,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified")
+            }))
+            return path
+    except requests.RequestException as e:
+        if meta:
+            print(f"Could not revalidate {source} ({e}), using the cached copy")
+            return path
+        raise
+
+def sample_lines(f, k, rng):
+    """Pick k lines of a file uniformly at random, in one pass.
+
+    Keeps only the k chosen lines in memory, and skips ahead between
+    replacements instead of drawing a random number for every line
+    (reservoir sampling, Algorithm L).
+    """
+    lines = (line for line in f if line.strip())
+    reservoir = list(itertools.islice(lines, k))
+    if len(reservoir) < k or k == 0:
+        rng.shuffle(reservoir)
+        return reservoir
+
+    def uniform():
+        # In (0, 1), so the logs below are defined
+        return rng.random() or sys.float_info.min
+
+    w = math.exp(math.log(uniform()) / k)
+    while True:
+        skip = math.floor(math.log(uniform()) / math.log(1 - w))
+        line = next(itertools.islice(lines, skip, None), None)
+        if line is None:
+            break
+        reservoir[rng.randrange(k)] = line
+        w *= math.exp(math.log(uniform()) / k)
+    rng.shuffle(reservoir)
+    return reservoir
+
+def index_path(path):
+    """Return where the index of a dataset is kept: next to it, or in the cache if that is read-only."""
+    path = Path(path)
+    if os.access(path.parent, os.W_OK):
+        return path.with_name(path.name + ".idx")
+    return Path(DATASET_CACHE) / (hashlib.sha256(str(path.resolve()).encode()).hexdigest()[:16] + ".idx")
+
+def build_index(path, index_file):
+    """Index a JSONL dataset in one pass.
+
+    Records the byte offset of every line, and its question_id sorted with
+    the row it is on, so rows can be read and ids looked up without parsing
+    the dataset again. Layout after the header: the row offsets (uint64),
+    the offsets of the sorted ids in the id blob (uint64, one more than
+    there are ids), the row of each id (uint32) and the id blob.
+    """
+    stat = os.stat(path)
+    rows = array("Q")
+    keys = []
+    offset = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                question_id = json.loads(line).get("question_id")
+                if question_id is not None:
+                    keys.append((str(question_id).encode(), len(rows)))
+                rows.append(offset)
+            offset += len(line)
+    keys.sort()
+
+    key_offsets = array("Q")
+    key_rows = array("I")
+    blob = bytearray()
+    for key, row in keys:
+        key_offsets.append(len(blob))
+        key_rows.append(row)
+        blob += key
+    key_offsets.append(len(blob))
+
+    index_file = Path(index_file)
+    index_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = tempfile.NamedTemporaryFile(dir=index_file.parent, delete=False)
+    try:
+        with tmp:
+            tmp.write(INDEX_HEADER.pack(INDEX_MAGIC, len(rows), len(keys), stat.st_size, stat.st_mtime_ns))
+            for part in (rows, key_offsets, key_rows, blob):
+                tmp.write(part)
+        os.replace(tmp.name, index_file)
+    except BaseException:
+        os.unlink(tmp.name)
+        raise
+
+class DatasetIndex:
+    """Random access to the rows of a JSONL dataset, through its memory-mapped index."""
+
+    def __init__(self, path, index_file):
+        self._files = [open(path, "rb"), open(index_file, "rb")]
+        # mmap can't map empty files
+        self.data = mmap.mmap(self._files[0].fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+        self._index = mmap.mmap(self._files[1].fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._index)
+        _, row_count, key_count, _, _ = INDEX_HEADER.unpack_from(view)
+        start = INDEX_HEADER.size
+        sections = []
+        for length, fmt, size in ((row_count, "Q", 8), (key_count + 1, "Q", 8), (key_count, "I", 4)):
+            sections.append(view[start:start + length * size].cast(fmt))
+            start += length * size
+        self.rows, self._key_offsets, self._key_rows = sections
+        self._keys = view[start:]
+        self._views = [view, *sections, self._keys]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def line(self, row):
+        """Return the raw JSON of a row."""
+        start = self.rows[row]
+        end = self.data.find(b"\n", start)
+        return self.data[start:end if end != -1 else len(self.data)]
+
+    def _key(self, i):
+        return bytes(self._keys[self._key_offsets[i]:self._key_offsets[i + 1]])
+
+    def find(self, question_id):
+        """Return the row of a question, or None if there is no such question."""
+        key = str(question_id).encode()
+        i = bisect_left(range(len(self._key_rows)), key, key=self._key)
+        if i < len(self._key_rows) and self._key(i) == key:
+            return self._key_rows[i]
+        return None
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        self._index.close()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        for f in self._files:
+            f.close()
+
+def open_index(path):
+    """Open the index of a dataset, building it first if it is missing or older than the dataset."""
+    index_file = index_path(path)
+    stat = os.stat(path)
+    try:
+        with open(index_file, "rb") as f:
+            magic, _, _, size, mtime = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+        current = (magic, size, mtime) == (INDEX_MAGIC, stat.st_size, stat.st_mtime_ns)
+    except (OSError, struct.error):
+        current = False
+    if not current:
+        build_index(path, index_file)
+    return DatasetIndex(path, index_file)
 
 def handler(input, sandgarden):
+    input = input or {}
     # Initialize OpenAI connector
     openai = sandgarden.get_connector('trivia-openai')
    
-    # Load the dataset via HTTP
-    url = "https://raw.githubusercontent.com/google-research-datasets/cf_triviaqa/refs/heads/main/har_dataset.jsonl"
-    response = requests.get(url)
-    dataset = response.text
-    
-    # Parse the JSONL
-    questions = [json.loads(line) for line in dataset.splitlines()]
+    # Load the dataset, from the cache when it hasn't changed
+    path = fetch_dataset(input.get("dataset", DATASET_URL))
     
-    # Choose twenty questions at random
-    to_answer = random.sample(questions, 20)
+    # Jump straight to the requested or randomly chosen rows through the index,
+    # and only parse those
+    rng = random.Random(input.get("seed"))
+    sample_size = int(input.get("sample_size", DEFAULT_SAMPLE_SIZE))
+    question_ids = input.get("question_ids")
+    try:
+        index = open_index(path)
+    except OSError as e:
+        if question_ids:
+            raise
+        # Without an index, choose them while streaming the JSONL
+        print(f"Could not index {path} ({e}), streaming it instead")
+        with open(path, "rb") as f:
+            to_answer = [json.loads(line) for line in sample_lines(f, sample_size, rng)]
+    else:
+        with index:
+            if question_ids:
+                rows = [index.find(question_id) for question_id in question_ids]
+                missing = [question_id for question_id, row in zip(question_ids, rows) if row is None]
+                if missing:
+                    raise ValueError(f"Questions not found in the dataset: {', '.join(map(str, missing))}")
+            else:
+                rows = rng.sample(range(len(index)), min(sample_size, len(index)))
+            to_answer = [json.loads(index.line(row)) for row in rows]
     
-    # Generate answers
-    answers = []
+    # Render the prompts up front, the completions run on worker threads
+    prompts = []
     for question in to_answer:
         rag = {
             "question":question['question_text'], 
             "text":question['paragraph_text']
         }
-        res = openai.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "user", "content": sandgarden.render_prompt('answer-trivia',rag)}
-        ])
-        answers.append({"question": question, "answer": res.choices[0].message.content})
+        prompts.append(sandgarden.render_prompt('answer-trivia',rag))
+
+    def answer(question, prompt):
+        try:
+            res = openai.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "user", "content": prompt}
+            ])
+            return {"question": question, "answer": res.choices[0].message.content}
+        except Exception as e:
+            # One failed question doesn't fail the others
+            return {"question": question, "answer": None, "error": str(e)}
+
+    # Generate answers, a few at a time, in the order of the questions
+    concurrency = max(1, int(input.get("concurrency", DEFAULT_CONCURRENCY)))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        answers = list(executor.map(answer, to_answer, prompts))
         
-    return {"answers": answers}
\ No newline at end of file
+    output = {"answers": answers}
+    output.update({key: input[key] for key in JUDGE_SETTINGS if key in input})
+    return output
+
+if __name__ == "__main__":
+    # Index a dataset ahead of the first run: python main.py path/to/dataset.jsonl
+    for dataset in sys.argv[1:]:
+        with open_index(dataset) as index:
+            print(f"{dataset}: {len(index)} rows, index at {index_path(dataset)}")
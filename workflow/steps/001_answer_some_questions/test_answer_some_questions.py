@@ -0,0 +1,211 @@
+import json
+import random
+import threading
+import importlib.util
+from collections import Counter
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import Mock, MagicMock, patch
+import pytest
+import requests
+
+# Both steps are main.py, so load this one under its own name
+spec = importlib.util.spec_from_file_location("answer_some_questions", Path(__file__).parent / "main.py")
+main = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(main)
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    """Write a small dataset, and keep the cache in the test directory."""
+    monkeypatch.setattr(main, "DATASET_CACHE", str(tmp_path / "cache"))
+    path = tmp_path / "dataset.jsonl"
+    path.write_text("".join(
+        json.dumps({"question_id": f"q{i}", "question_text": f"Question {i}?", "paragraph_text": f"Paragraph {i}"}) + "\n"
+        for i in range(10)
+    ))
+    return path
+
+def make_sandgarden(create):
+    openai = Mock()
+    openai.chat.completions.create.side_effect = create
+    sandgarden = Mock()
+    sandgarden.get_connector.return_value = openai
+    sandgarden.render_prompt.side_effect = lambda name, rag: rag["question"]
+    return sandgarden, openai
+
+def completion(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+def test_handler_passes_judge_settings_on(dataset):
+    """Test that the settings of the second step are passed on with the answers, since it only sees this output."""
+    sandgarden, _ = make_sandgarden(lambda model, messages: completion("Answer"))
+
+    result = main.handler({
+        "dataset": str(dataset),
+        "question_ids": ["q1"],
+        "concurrency": 2,
+        "requests_per_minute": 60,
+        "tokens_per_minute": 30000
+    }, sandgarden)
+
+    assert [answer["question"]["question_id"] for answer in result["answers"]] == ["q1"]
+    assert {key: value for key, value in result.items() if key != "answers"} == {
+        "concurrency": 2,
+        "requests_per_minute": 60,
+        "tokens_per_minute": 30000
+    }
+
+    result = main.handler({"dataset": str(dataset), "question_ids": ["q1"]}, sandgarden)
+    assert list(result) == ["answers"]
+
+def make_download(status_code=200, body=b"", headers=None):
+    """Build a mock streamed requests response."""
+    response = MagicMock()
+    response.__enter__.return_value = response
+    response.status_code = status_code
+    response.headers = headers or {}
+    response.iter_content.return_value = [body]
+    return response
+
+def test_fetch_dataset_local_path(dataset):
+    """Test that a local dataset is used as is."""
+    with patch.object(main.requests, "get") as mock_get:
+        assert main.fetch_dataset(str(dataset)) == dataset
+        mock_get.assert_not_called()
+
+def test_fetch_dataset_revalidates_cached_copy(dataset):
+    """Test that a downloaded dataset is cached, and only revalidated with its ETag afterwards."""
+    url = "https://example.com/dataset.jsonl"
+    with patch.object(main.requests, "get", return_value=make_download(200, b"line\n", {"ETag": '"v1"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"})) as mock_get:
+        path = main.fetch_dataset(url)
+    assert path.read_bytes() == b"line\n"
+    assert mock_get.call_args[1]["headers"] == {}
+
+    with patch.object(main.requests, "get", return_value=make_download(304)) as mock_get:
+        assert main.fetch_dataset(url) == path
+    assert mock_get.call_args[1]["headers"] == {"If-None-Match": '"v1"', "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT"}
+    assert path.read_bytes() == b"line\n"
+
+    # A changed dataset replaces the cached copy
+    with patch.object(main.requests, "get", return_value=make_download(200, b"new\n", {"ETag": '"v2"'})):
+        assert main.fetch_dataset(url) == path
+    assert path.read_bytes() == b"new\n"
+
+def test_fetch_dataset_offline(dataset, capsys):
+    """Test that the cached copy is used when the network is unavailable, and the error raised without one."""
+    url = "https://example.com/dataset.jsonl"
+    with patch.object(main.requests, "get", side_effect=requests.ConnectionError("offline")):
+        with pytest.raises(requests.ConnectionError):
+            main.fetch_dataset(url)
+
+    with patch.object(main.requests, "get", return_value=make_download(200, b"line\n", {"ETag": '"v1"'})):
+        path = main.fetch_dataset(url)
+    with patch.object(main.requests, "get", side_effect=requests.ConnectionError("offline")):
+        assert main.fetch_dataset(url) == path
+    assert "using the cached copy" in capsys.readouterr().out
+
+def test_sample_lines_small_file():
+    """Test that every line is kept when there are no more than asked for, and blank lines are skipped."""
+    lines = [b"a\n", b"\n", b"b\n", b"c\n"]
+    assert sorted(main.sample_lines(iter(lines), 5, random.Random(1))) == [b"a\n", b"b\n", b"c\n"]
+    assert main.sample_lines(iter(lines), 0, random.Random(1)) == []
+
+def test_sample_lines_uniform():
+    """Test that every line is about as likely to be picked, and the same seed picks the same lines."""
+    lines = [f"{i}\n".encode() for i in range(20)]
+    rng = random.Random(7)
+    counts = Counter()
+    for _ in range(4000):
+        sample = main.sample_lines(iter(lines), 5, rng)
+        assert len(set(sample)) == 5
+        counts.update(sample)
+
+    # 4000 samples of 5 out of 20 lines pick each line 1000 times on average
+    assert set(counts) == set(lines)
+    assert all(800 < count < 1200 for count in counts.values())
+    assert main.sample_lines(iter(lines), 5, random.Random(3)) == main.sample_lines(iter(lines), 5, random.Random(3))
+
+def test_handler_streams_without_index(dataset, monkeypatch, capsys):
+    """Test that questions are sampled while streaming the dataset when it can't be indexed."""
+    def open_index(path):
+        raise PermissionError("read-only")
+    monkeypatch.setattr(main, "open_index", open_index)
+    sandgarden, _ = make_sandgarden(lambda model, messages: completion("Answer"))
+
+    result = main.handler({"dataset": str(dataset), "sample_size": 3, "seed": 1}, sandgarden)
+
+    assert len({answer["question"]["question_id"] for answer in result["answers"]}) == 3
+    assert "streaming it instead" in capsys.readouterr().out
+
+def test_dataset_index(tmp_path):
+    """Test reading rows and finding questions through the index."""
+    path = tmp_path / "dataset.jsonl"
+    path.write_bytes(b'{"question_id": "b", "n": 0}\n\n{"n": 1}\n{"question_id": 10, "n": 2}\n{"question_id": "a", "n": 3}')
+    main.build_index(path, tmp_path / "dataset.idx")
+
+    with main.DatasetIndex(path, tmp_path / "dataset.idx") as index:
+        # Blank lines are not rows, and the last row has no newline
+        assert len(index) == 4
+        assert [json.loads(index.line(row))["n"] for row in range(4)] == [0, 1, 2, 3]
+        assert index.find("a") == 3
+        assert index.find("b") == 0
+        assert index.find(10) == 2
+        assert index.find("c") is None
+
+def test_dataset_index_empty(tmp_path):
+    """Test that an empty dataset can be indexed."""
+    path = tmp_path / "dataset.jsonl"
+    path.write_bytes(b"")
+
+    with main.open_index(path) as index:
+        assert len(index) == 0
+        assert index.find("a") is None
+
+def test_open_index_rebuilds_changed_dataset(dataset, monkeypatch):
+    """Test that the index is built once, and again when the dataset changes."""
+    builds = []
+    build_index = main.build_index
+    def build(path, index_file):
+        builds.append(path)
+        build_index(path, index_file)
+    monkeypatch.setattr(main, "build_index", build)
+
+    with main.open_index(dataset) as index:
+        assert len(index) == 10
+    with main.open_index(dataset) as index:
+        assert len(index) == 10
+    assert len(builds) == 1
+
+    with open(dataset, "a") as f:
+        f.write(json.dumps({"question_id": "q10", "question_text": "Question 10?", "paragraph_text": "Paragraph 10"}) + "\n")
+    with main.open_index(dataset) as index:
+        assert len(index) == 11
+        assert index.find("q10") == 10
+    assert len(builds) == 2
+
+def test_handler_unknown_question_ids(dataset):
+    """Test that asking for questions that aren't in the dataset fails before answering anything."""
+    sandgarden, openai = make_sandgarden(lambda model, messages: completion("Answer"))
+
+    with pytest.raises(ValueError, match="Questions not found in the dataset: q99"):
+        main.handler({"dataset": str(dataset), "question_ids": ["q1", "q99"]}, sandgarden)
+    openai.chat.completions.create.assert_not_called()
+
+def test_handler_answers_concurrently(dataset):
+    """Test that questions are answered at the same time, in order, with a failed one not failing the others."""
+    # Only passes once three completions are waiting on it together
+    barrier = threading.Barrier(3, timeout=5)
+    def create(model, messages):
+        barrier.wait()
+        question = messages[0]["content"]
+        if question == "Question 2?":
+            raise ValueError("Bad request")
+        return completion(f"Answer to {question}")
+    sandgarden, openai = make_sandgarden(create)
+
+    result = main.handler({"dataset": str(dataset), "question_ids": ["q3", "q2", "q1"], "concurrency": 3}, sandgarden)
+
+    assert [answer["question"]["question_id"] for answer in result["answers"]] == ["q3", "q2", "q1"]
+    assert [answer["answer"] for answer in result["answers"]] == ["Answer to Question 3?", None, "Answer to Question 1?"]
+    assert result["answers"][1]["error"] == "Bad request"
+    assert openai.chat.completions.create.call_count == 3
@@ -1,16 +1,76 @@
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pydantic import BaseModel
 
+# Defaults when the run input doesn't say: answers judged at the same time,
+# and the provider's rate limits per minute
+DEFAULT_CONCURRENCY = 8
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 200000
+# Tokens the judgment itself may take, on top of the prompt
+JUDGMENT_TOKENS = 300
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+
 class Judgment(BaseModel):
     question_id: str
     correct: bool
     explanation: str
 
+class TokenBucket:
+    """Rate limit shared by worker threads, refilled continuously up to one minute's worth."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount):
+        """Wait until amount can be taken from the bucket, and take it."""
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) * 60 / self.capacity
+            time.sleep(wait)
+
+    def adjust(self, amount):
+        """Correct what was taken by amount, once the real cost is known."""
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+def retry_after(error):
+    """Return how long a rate limit error asks to wait, if it says."""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def is_rate_limit(error):
+    return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
 def handler(input, sandgarden):
     # Initialize the OpenAI connectors
     openai = sandgarden.get_connector('trivia-openai')
     system_prompt = sandgarden.get_prompt('judge-system-prompt')
-    judgements = []
+    request_bucket = TokenBucket(int(input.get('requests_per_minute', DEFAULT_REQUESTS_PER_MINUTE)))
+    token_bucket = TokenBucket(int(input.get('tokens_per_minute', DEFAULT_TOKENS_PER_MINUTE)))
+
+    # Render the prompts up front, the judging runs on worker threads
+    to_judge = []
     for response in input['answers']:
+        # Questions the first step failed to answer have nothing to judge
+        if response.get('error'):
+            continue
         id = response['question']['question_id']
         question = response['question']['question_text']
         reference_text = response['question']['paragraph_text']
@@ -26,15 +86,37 @@ def handler(input, sandgarden):
         }
         
         prompt = sandgarden.render_prompt('check-answers', rag)   
-        res = openai.beta.chat.completions.parse(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt}
-            ],
-            response_format=Judgment
-        )     
-        judgment = res.choices[0].message.parsed.dict()
-        judgements.append(judgment)
+        to_judge.append((id, prompt))
+
+    def judge(id, prompt):
+        # Roughly 4 characters per token, corrected with the real usage afterwards
+        estimate = (len(system_prompt) + len(prompt)) // 4 + JUDGMENT_TOKENS
+        for attempt in range(RETRY_ATTEMPTS):
+            request_bucket.take(1)
+            token_bucket.take(estimate)
+            try:
+                res = openai.beta.chat.completions.parse(
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": prompt}
+                    ],
+                    response_format=Judgment
+                )
+            except Exception as e:
+                if not is_rate_limit(e) or attempt == RETRY_ATTEMPTS - 1:
+                    # One failed judgment doesn't fail the others
+                    return {"question_id": id, "error": str(e)}
+                time.sleep(retry_after(e) or random.uniform(0, RETRY_BASE_DELAY * 2 ** attempt))
+                continue
+            usage = getattr(res, 'usage', None)
+            if usage is not None and getattr(usage, 'total_tokens', None):
+                token_bucket.adjust(usage.total_tokens - estimate)
+            return res.choices[0].message.parsed.dict()
+
+    # Judge a few answers at a time, within the rate limits, in the order of the answers
+    concurrency = max(1, int(input.get('concurrency', DEFAULT_CONCURRENCY)))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        judgements = list(executor.map(lambda item: judge(*item), to_judge))
 
     return { "judgments": judgements }
\ No newline at end of file
@@ -0,0 +1,147 @@
+import importlib.util
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import Mock
+import pytest
+
+# Both steps are main.py, so load this one under its own name
+spec = importlib.util.spec_from_file_location("check_your_work", Path(__file__).parent / "main.py")
+main = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(main)
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replace time in the step with a clock that only moves when slept on."""
+    clock = SimpleNamespace(now=0.0, sleeps=[])
+    def sleep(seconds):
+        clock.sleeps.append(seconds)
+        clock.now += seconds
+    monkeypatch.setattr(main, "time", SimpleNamespace(monotonic=lambda: clock.now, sleep=sleep))
+    return clock
+
+def make_answer(question_id, error=None):
+    answer = {
+        "question": {
+            "question_id": question_id,
+            "question_text": f"Question {question_id}?",
+            "paragraph_text": "Reference",
+            "annotation": {"answer": [{"paragraph_reference": {"string": "Answer"}}]}
+        },
+        "answer": "Given"
+    }
+    if error:
+        answer["error"] = error
+    return answer
+
+def make_judgment(question_id, total_tokens=100):
+    parsed = Mock()
+    parsed.dict.return_value = {"question_id": question_id, "correct": True, "explanation": "Right"}
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(parsed=parsed))], usage=SimpleNamespace(total_tokens=total_tokens))
+
+def make_sandgarden(parse):
+    openai = Mock()
+    openai.beta.chat.completions.parse.side_effect = parse
+    sandgarden = Mock()
+    sandgarden.get_connector.return_value = openai
+    sandgarden.get_prompt.return_value = "You are a judge"
+    sandgarden.render_prompt.side_effect = lambda name, rag: f"Judge {rag['id']}"
+    return sandgarden, openai
+
+class RateLimitError(Exception):
+    status_code = 429
+
+    def __init__(self, retry_after=None):
+        super().__init__("Rate limit reached")
+        self.response = SimpleNamespace(headers={"retry-after": retry_after} if retry_after else {})
+
+def test_token_bucket_takes_without_waiting_within_capacity(clock):
+    """Test that a full bucket hands out a minute's worth at once."""
+    bucket = main.TokenBucket(60)
+    for _ in range(60):
+        bucket.take(1)
+    assert clock.sleeps == []
+
+def test_token_bucket_waits_for_refill(clock):
+    """Test that an empty bucket waits as long as it takes to refill what is asked for."""
+    bucket = main.TokenBucket(60)
+    bucket.take(60)
+    bucket.take(5)
+    assert clock.sleeps == [pytest.approx(5)]
+
+    # Refilled while nothing was taken, up to the capacity
+    clock.now += 600
+    bucket.take(60)
+    assert len(clock.sleeps) == 1
+
+def test_token_bucket_caps_amount_at_capacity(clock):
+    """Test that taking more than the capacity waits for a full bucket instead of forever."""
+    bucket = main.TokenBucket(60)
+    bucket.take(1)
+    bucket.take(1000)
+    assert clock.sleeps == [pytest.approx(1)]
+
+def test_token_bucket_adjust(clock):
+    """Test that correcting the estimate gives back or takes more tokens."""
+    bucket = main.TokenBucket(60)
+    bucket.take(30)
+    # The call cost 20 more than estimated
+    bucket.adjust(20)
+    bucket.take(20)
+    assert clock.sleeps == [pytest.approx(10)]
+
+def test_retry_after():
+    """Test reading the wait a rate limit error asks for."""
+    assert main.retry_after(RateLimitError("2.5")) == 2.5
+    assert main.retry_after(RateLimitError()) is None
+    assert main.retry_after(ValueError("no response")) is None
+
+def test_handler_retries_rate_limits(clock):
+    """Test that a 429 is retried after the wait the API asks for."""
+    sandgarden, openai = make_sandgarden([RateLimitError("3"), make_judgment("q1")])
+
+    result = main.handler({"answers": [make_answer("q1")]}, sandgarden)
+
+    assert result == {"judgments": [{"question_id": "q1", "correct": True, "explanation": "Right"}]}
+    assert openai.beta.chat.completions.parse.call_count == 2
+    assert clock.sleeps == [3.0]
+
+def test_handler_gives_up_after_retries(clock):
+    """Test that a judgment still rate limited after every attempt gets an error."""
+    sandgarden, openai = make_sandgarden(RateLimitError("1"))
+
+    result = main.handler({"answers": [make_answer("q1")]}, sandgarden)
+
+    assert result == {"judgments": [{"question_id": "q1", "error": "Rate limit reached"}]}
+    assert openai.beta.chat.completions.parse.call_count == main.RETRY_ATTEMPTS
+
+def test_handler_keeps_order_and_isolates_errors(clock):
+    """Test that a failed judgment doesn't fail the others, and unanswered questions are skipped."""
+    def parse(model, messages, response_format):
+        question_id = messages[1]["content"].split()[-1]
+        if question_id == "q2":
+            raise ValueError("Invalid response")
+        return make_judgment(question_id)
+    sandgarden, openai = make_sandgarden(parse)
+    answers = [make_answer("q1"), make_answer("q2"), make_answer("q3", error="No answer"), make_answer("q4")]
+
+    result = main.handler({"answers": answers, "concurrency": 3}, sandgarden)
+
+    assert [judgment["question_id"] for judgment in result["judgments"]] == ["q1", "q2", "q4"]
+    assert result["judgments"][1] == {"question_id": "q2", "error": "Invalid response"}
+    # Errors other than rate limits are not retried
+    assert openai.beta.chat.completions.parse.call_count == 3
+
+def test_handler_reads_rate_limits_from_input(clock, monkeypatch):
+    """Test that the rate limits passed on by the first step size the buckets."""
+    sizes = []
+    class TokenBucket(main.TokenBucket):
+        def __init__(self, per_minute):
+            sizes.append(per_minute)
+            super().__init__(per_minute)
+    monkeypatch.setattr(main, "TokenBucket", TokenBucket)
+    sandgarden, _ = make_sandgarden(lambda **kwargs: make_judgment("q1"))
+
+    main.handler({"answers": [], "requests_per_minute": "60", "tokens_per_minute": 30000}, sandgarden)
+    main.handler({"answers": []}, sandgarden)
+
+    assert sizes == [60, 30000, main.DEFAULT_REQUESTS_PER_MINUTE, main.DEFAULT_TOKENS_PER_MINUTE]